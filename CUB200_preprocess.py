@@ -1,38 +1,75 @@
 import cv2
 import numpy as np
 import os
+import argparse
+from multiprocessing import Pool
+from numpy.lib.format import open_memmap
 
-os.chdir("cub2002011")
-image = open('images.txt', 'r')
-bbox = open('bounding_boxes.txt', 'r')
-
-images = []
-classes = []
-i = 1
-for line in image:
-	# Extract bounding box conditions
-	split = [int(float(x))for x in bbox.readline().split()]
-	x, y, w, h = split[1], split[2], split[3], split[4]
-	
-	# Read and process image #line = image.readline()
-	path = 'images/'+line.split()[1]
-	classnumber = int(line.split('/')[0].split()[1].split('.')[0])
+# Crops every CUB-200-2011 image to its bounding box, resizes it and writes it straight into the
+# preallocated, memory-mapped train or test array (the split cubdivide.py used to do in a second pass).
+
+outputs = {}
+
+def openoutputs(paths):
+	# each worker maps the output files once and writes its images in place
+	for split, path in paths.items():
+		outputs[split] = np.load(path, mmap_mode='r+')
+
+def processimage(job):
+	path, x, y, w, h, split, position, size = job
 	img = cv2.imread(path)
 	img = img[y: y+h, x: x+w]
-	img = cv2.resize(img, (80,80))
-	
-	#Append to list	
-	classes.append(classnumber)
-	images.append(img)
-	if i % 500 == 0:
-		print(i)
-	i = i+1
-
-#Convert to numpy array and save to file
-images = np.array(images)
-clases = np.array(classes)
-
-os.chdir("..")
-
-np.save("datasets/cubimgArr", images)
-np.save("datasets/cubclassArr", classes)
+	outputs[split][position] = cv2.resize(img, (size, size))
+	return 1
+
+def readmetadata(root):
+	image = open(os.path.join(root, 'images.txt'), 'r')
+	bbox = open(os.path.join(root, 'bounding_boxes.txt'), 'r')
+	traintestsplit = open(os.path.join(root, 'train_test_split.txt'), 'r')
+	for line in image:
+		# Extract bounding box conditions
+		split = [int(float(x))for x in bbox.readline().split()]
+		x, y, w, h = split[1], split[2], split[3], split[4]
+		path = os.path.join(root, 'images', line.split()[1])
+		classnumber = int(line.split('/')[0].split()[1].split('.')[0])
+		istrain = traintestsplit.readline().split()[1] == '1'
+		yield path, x, y, w, h, istrain, classnumber
+
+def preprocess(root='cub2002011', out='datasets', size=80, workers=None, chunksize=64):
+	metadata = list(readmetadata(root))
+	positions = {'train': 0, 'test': 0}
+	classes = {'train': [], 'test': []}
+	jobs = []
+	for path, x, y, w, h, istrain, classnumber in metadata:
+		split = 'train' if istrain else 'test'
+		jobs.append((path, x, y, w, h, split, positions[split], size))
+		classes[split].append(classnumber)
+		positions[split] += 1
+
+	paths = {'train': os.path.join(out, 'xcub.npy'), 'test': os.path.join(out, 'xcubtest.npy')}
+	for split, path in paths.items():
+		open_memmap(path, mode='w+', dtype=np.uint8, shape=(positions[split], size, size, 3)).flush()
+
+	pool = Pool(workers, initializer=openoutputs, initargs=(paths,))
+	done = 0
+	for n in pool.imap_unordered(processimage, jobs, chunksize):
+		done = done+n
+		if done % 500 == 0:
+			print(done)
+	pool.close()
+	pool.join()
+
+	np.save(os.path.join(out, 'ycub'), np.array(classes['train']))
+	np.save(os.path.join(out, 'ycubtest'), np.array(classes['test']))
+	print("Wrote "+str(positions['train'])+" train and "+str(positions['test'])+" test images")
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Crop, resize and split CUB-200-2011 into datasets/")
+	parser.add_argument('--root', default='cub2002011')
+	parser.add_argument('--out', default='datasets')
+	parser.add_argument('--size', type=int, default=80)
+	parser.add_argument('--workers', type=int, default=None, help="defaults to the number of cores")
+	parser.add_argument('--chunksize', type=int, default=64)
+	args = parser.parse_args()
+	preprocess(args.root, args.out, args.size, args.workers, args.chunksize)
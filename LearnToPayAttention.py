@@ -1,24 +1,27 @@
-import tensorflow as tf
-import keras
-import numpy as np
-from keras import backend as K
-from keras.models import Model
-from keras.engine.topology import Layer
-from keras.layers import Input
-from keras.layers.core import Dense, Lambda, Activation, Flatten, Reshape
-from keras.layers.convolutional import Conv2D
-from keras.layers.merge import Concatenate, Add
-from keras.layers.pooling import MaxPooling2D, AveragePooling2D
-from keras.layers.normalization import BatchNormalization
-from keras.callbacks import Callback, LearningRateScheduler, ModelCheckpoint, LambdaCallback, TensorBoard, EarlyStopping, ReduceLROnPlateau
-from keras.optimizers import SGD
-import winsound
 import os
+import numpy as np
+
+# TensorFlow and Keras are only imported when a model is built or trained, so importing this module is cheap.
+# The models build their graph on first use of .model. The attention layers live in attentionlayers.py and the
+# callbacks in callbacks.py, the old names are still importable from here.
+
+MOVED = {'ParametrisedCompatibility': 'attentionlayers', 'DotProductCompatibility': 'attentionlayers', 'AttentionPooling': 'attentionlayers',
+         'dotproductcompatibility': 'attentionlayers', 'parametrisedcompatibility': 'attentionlayers', 'custom_objects': 'attentionlayers',
+         'LearningRateScaler': 'callbacks', 'Beeper': 'callbacks'}
 
 
+def __getattr__(name):
+    if name in MOVED:
+        return getattr(__import__(MOVED[name]), name)
+    raise AttributeError("module 'LearnToPayAttention' has no attribute "+repr(name))
+
 
 class StandardVGG:
     def __init__(self):
+        import keras
+        from keras.models import Model
+        from keras.layers import Input, Dense, Flatten, Conv2D, MaxPooling2D
+        from keras.optimizers import SGD
         inp = Input(shape=(32, 32, 3))
         regularizer = keras.regularizers.l2(0.0005)
         x = Conv2D(64, (3, 3), activation='relu', padding='same', name='block1_conv1', kernel_regularizer=regularizer)(inp)
@@ -65,6 +68,9 @@ class StandardVGG:
         self.model.compile(optimizer=optimizer, loss=loss, metrics=metrics)
     
     def StandardFit(self, datasetname=None, X=[], Y=[], beep=False):
+        import keras
+        from keras.callbacks import ModelCheckpoint, LambdaCallback, TensorBoard
+        from callbacks import LearningRateScaler, Beeper
         Y = keras.utils.to_categorical(Y,self.outputclasses)
         if datasetname==None:
             datasetname=self.datasetname
@@ -93,39 +99,129 @@ class StandardVGG:
                     pass
         return self.model
 
-class AttentionVGG:
+class AttentionNet:
+    # lazy building and inference shared by AttentionVGG and AttentionRN. The constructors only record the
+    # configuration, build() makes the graph and sets self.attentionmaps/self.attentionlocals to [a1, a2, a3]/[l1, l2, l3].
+
+    _model = None
+    monitor = 'val_acc'  # what StandardFit's EarlyStopping watches
+
+    @property
+    def model(self):
+        # built on first use, and compiled then unless the constructor got compileonbuild=False
+        if self._model is None:
+            self._build()
+            if self.compileonbuild:
+                self.compile()
+        return self._model
+
+    def _build(self):
+        # the graph, built once and not compiled: compile() builds through here, so it never compiles twice
+        if self._model is None:
+            if self.precision is not None:  # the session has to change before the first weight exists
+                from mixedprecision import enable
+                enable(self.precision)
+            self._model = self.build()
+        return self._model
+
+    @model.setter
+    def model(self, model):
+        self._model = model
+        self._attentionmodel = None
+
+    def filters(self, layername, default):
+        return self.widths.get(layername, default)
+
+    def compiled(self):
+        return getattr(self._model, 'optimizer', None) is not None
+
+    def compile(self):
+        # compiles self.model with the optimizer given to the constructor, or a fresh default one for this instance
+        model = self._build()
+        optimizer = self.optimizer if self.optimizer is not None else self.defaultoptimizer()
+        if getattr(self, 'checkpointing', False):
+            from recompute import checkpointed
+            optimizer = checkpointed(optimizer, *self.recomputation)
+        if self.precision == 'mixed_float16':
+            from mixedprecision import lossscaled
+            optimizer = lossscaled(optimizer)  # float16 gradients underflow without loss scaling
+        model.compile(optimizer=optimizer, loss=self.loss, metrics=self.metrics)
+        return model
+
+    def activeheads(self):
+        # the attention heads (1-3) the classifier reads: g3 for att1, g2 and g3 for att2, all three for att3. The
+        # other heads are in the graph but untrained, their maps mean nothing
+        return activeheads(self.att)
+
+    def attentionmodel(self):
+        # same layers and weights as self.model, the maps of the active heads are extra outputs of the one forward pass
+        if getattr(self, '_attentionmodel', None) is None:
+            from keras.models import Model
+            model = self.model
+            self._attentionmodel = Model(inputs=model.inputs, outputs=model.outputs+[self.attentionmaps[head-1] for head in self.activeheads()])
+        return self._attentionmodel
+
+    def predict_stream(self, X, batch_size=128, attention=False, chunksize=None):
+        # yields the predictions for X chunk by chunk, X may be a memmap far larger than memory
+        from keras import backend as K
+        chunksize = chunksize or batch_size*64
+        model = self.attentionmodel() if attention else self.model
+        outputs = len(self.model.outputs)  # one per classifier head, several for MultiHeadVGG
+        attended = [self.attentionlocals[head-1] for head in self.activeheads()]
+        for i in range(0, len(X), chunksize):
+            predictions = model.predict(np.asarray(X[i:i+chunksize], dtype=K.floatx()), batch_size=batch_size)
+            if attention:  # batch*xy -> batch*x*y
+                predictions = predictions[:outputs] + [a.reshape((-1,)+K.int_shape(l)[1:3]) for a, l in zip(predictions[outputs:], attended)]
+            yield predictions
+
+    def predict(self, X, batch_size=128, attention=False, chunksize=None):
+        # returns the class probabilities (a list with one array per classifier head for a MultiHeadVGG), or with
+        # attention=True (probabilities, maps) where maps are those of activeheads(): [a3] for att1, [a2, a3] for att2
+        chunks = list(self.predict_stream(X, batch_size, attention, chunksize))
+        if not isinstance(chunks[0], list):
+            return np.concatenate(chunks)
+        columns = [np.concatenate([c[i] for c in chunks]) for i in range(len(chunks[0]))]
+        outputs = len(self.model.outputs)
+        probabilities = columns[0] if outputs == 1 else columns[:outputs]
+        if not attention:
+            return probabilities
+        return (probabilities, columns[outputs:])
+
+
+class AttentionVGG(AttentionNet):
     
     def VGGBlock(self, x, regularizer = None, batchnorm = False):
+        from keras.layers import Dense, Activation, Flatten, Conv2D, MaxPooling2D, BatchNormalization
         if batchnorm:
-            x = Conv2D(64, (3, 3), padding='same', kernel_regularizer=regularizer, name='conv1')(x)
+            x = Conv2D(self.filters('conv1', 64), (3, 3), padding='same', kernel_regularizer=regularizer, name='conv1')(x)
             x = BatchNormalization()(x)
             x = Activation('relu')(x)
-            x = Conv2D(64, (3, 3), padding='same', kernel_regularizer=regularizer, name='conv2')(x)
+            x = Conv2D(self.filters('conv2', 64), (3, 3), padding='same', kernel_regularizer=regularizer, name='conv2')(x)
             x = BatchNormalization()(x)
             x = Activation('relu')(x)
 
-            x = Conv2D(128, (3, 3), padding='same', kernel_regularizer=regularizer, name='conv3')(x)
+            x = Conv2D(self.filters('conv3', 128), (3, 3), padding='same', kernel_regularizer=regularizer, name='conv3')(x)
             x = BatchNormalization()(x)
             x = Activation('relu')(x)
-            x = Conv2D(128, (3, 3), padding='same', kernel_regularizer=regularizer, name='conv4')(x)
+            x = Conv2D(self.filters('conv4', 128), (3, 3), padding='same', kernel_regularizer=regularizer, name='conv4')(x)
             x = BatchNormalization()(x)
             x = Activation('relu')(x)
 
-            x = Conv2D(256, (3, 3), padding='same', kernel_regularizer=regularizer, name='conv5')(x)
+            x = Conv2D(self.filters('conv5', 256), (3, 3), padding='same', kernel_regularizer=regularizer, name='conv5')(x)
             x = BatchNormalization()(x)
             x = Activation('relu')(x)
-            x = Conv2D(256, (3, 3), padding='same', kernel_regularizer=regularizer, name='conv6')(x)
+            x = Conv2D(self.filters('conv6', 256), (3, 3), padding='same', kernel_regularizer=regularizer, name='conv6')(x)
             x = BatchNormalization()(x)
             x = Activation('relu')(x)
-            x = Conv2D(256, (3, 3), padding='same', kernel_regularizer=regularizer, name='conv7')(x)
+            x = Conv2D(self.filters('conv7', 256), (3, 3), padding='same', kernel_regularizer=regularizer, name='conv7')(x)
             x = BatchNormalization()(x)
             local1 = Activation('relu')(x)  # batch*x*y*channel
             x = MaxPooling2D((2, 2), strides=(2, 2), name='pool1')(x)
 
-            x = Conv2D(512, (3, 3), padding='same', kernel_regularizer=regularizer, name='conv8')(x)
+            x = Conv2D(self.filters('conv8', 512), (3, 3), padding='same', kernel_regularizer=regularizer, name='conv8')(x)
             x = BatchNormalization()(x)
             x = Activation('relu')(x)
-            x = Conv2D(512, (3, 3), padding='same', kernel_regularizer=regularizer, name='conv9')(x)
+            x = Conv2D(self.filters('conv9', 512), (3, 3), padding='same', kernel_regularizer=regularizer, name='conv9')(x)
             x = BatchNormalization()(x)
             x = Activation('relu')(x)
             x = Conv2D(512, (3, 3), padding='same', kernel_regularizer=regularizer, name='conv10')(x)
@@ -133,10 +229,10 @@ class AttentionVGG:
             local2 = Activation('relu')(x)
             x = MaxPooling2D((2, 2), strides=(2, 2), name='pool2')(local2)
 
-            x = Conv2D(512, (3, 3), padding='same', kernel_regularizer=regularizer, name='conv11')(x)
+            x = Conv2D(self.filters('conv11', 512), (3, 3), padding='same', kernel_regularizer=regularizer, name='conv11')(x)
             x = BatchNormalization()(x)
             x = Activation('relu')(x)
-            x = Conv2D(512, (3, 3), padding='same', kernel_regularizer=regularizer, name='conv12')(x)
+            x = Conv2D(self.filters('conv12', 512), (3, 3), padding='same', kernel_regularizer=regularizer, name='conv12')(x)
             x = BatchNormalization()(x)
             x = Activation('relu')(x)
             x = Conv2D(512, (3, 3), padding='same', kernel_regularizer=regularizer, name='conv13')(x)
@@ -144,11 +240,11 @@ class AttentionVGG:
             local3 = Activation('relu')(x)
             x = MaxPooling2D((2, 2), strides=(2, 2), name='pool3')(local3)
 
-            x = Conv2D(512, (3, 3), padding='same', kernel_regularizer=regularizer, name='conv14')(x)
+            x = Conv2D(self.filters('conv14', 512), (3, 3), padding='same', kernel_regularizer=regularizer, name='conv14')(x)
             x = BatchNormalization()(x)
             x = Activation('relu')(x)
             x = MaxPooling2D((2, 2), strides=(2, 2), name='pool4')(x)
-            x = Conv2D(512, (3, 3), padding='same', kernel_regularizer=regularizer, name='conv15')(x)
+            x = Conv2D(self.filters('conv15', 512), (3, 3), padding='same', kernel_regularizer=regularizer, name='conv15')(x)
             x = BatchNormalization()(x)
             x = Activation('relu')(x)
             x = MaxPooling2D((2, 2), strides=(2, 2), name='pool5')(x)
@@ -156,75 +252,136 @@ class AttentionVGG:
             g = Dense(512, activation='relu', kernel_regularizer=regularizer, name='globalg')(x)  # batch*512
             return (g, local1, local2, local3)
         else:            
-            x = Conv2D(64, (3, 3), activation='relu', padding='same', kernel_regularizer=regularizer, name='conv1')(x)
-            x = Conv2D(64, (3, 3), activation='relu', padding='same', kernel_regularizer=regularizer, name='conv2')(x)
+            x = Conv2D(self.filters('conv1', 64), (3, 3), activation='relu', padding='same', kernel_regularizer=regularizer, name='conv1')(x)
+            x = Conv2D(self.filters('conv2', 64), (3, 3), activation='relu', padding='same', kernel_regularizer=regularizer, name='conv2')(x)
 
-            x = Conv2D(128, (3, 3), activation='relu', padding='same', kernel_regularizer=regularizer, name='conv3')(x)
-            x = Conv2D(128, (3, 3), activation='relu', padding='same', kernel_regularizer=regularizer, name='conv4')(x)
+            x = Conv2D(self.filters('conv3', 128), (3, 3), activation='relu', padding='same', kernel_regularizer=regularizer, name='conv3')(x)
+            x = Conv2D(self.filters('conv4', 128), (3, 3), activation='relu', padding='same', kernel_regularizer=regularizer, name='conv4')(x)
 
-            x = Conv2D(256, (3, 3), activation='relu', padding='same', kernel_regularizer=regularizer, name='conv5')(x)
-            x = Conv2D(256, (3, 3), activation='relu', padding='same', kernel_regularizer=regularizer, name='conv6')(x)
-            local1 = Conv2D(256, (3, 3), activation='relu', padding='same', kernel_regularizer=regularizer, name='conv7')(x)  # batch*x*y*channel
+            x = Conv2D(self.filters('conv5', 256), (3, 3), activation='relu', padding='same', kernel_regularizer=regularizer, name='conv5')(x)
+            x = Conv2D(self.filters('conv6', 256), (3, 3), activation='relu', padding='same', kernel_regularizer=regularizer, name='conv6')(x)
+            local1 = Conv2D(self.filters('conv7', 256), (3, 3), activation='relu', padding='same', kernel_regularizer=regularizer, name='conv7')(x)  # batch*x*y*channel
             x = MaxPooling2D((2, 2), strides=(2, 2), name='pool1')(local1)
 
-            x = Conv2D(512, (3, 3), activation='relu', padding='same', kernel_regularizer=regularizer, name='conv8')(x)
-            x = Conv2D(512, (3, 3), activation='relu', padding='same', kernel_regularizer=regularizer, name='conv9')(x)
+            x = Conv2D(self.filters('conv8', 512), (3, 3), activation='relu', padding='same', kernel_regularizer=regularizer, name='conv8')(x)
+            x = Conv2D(self.filters('conv9', 512), (3, 3), activation='relu', padding='same', kernel_regularizer=regularizer, name='conv9')(x)
             local2 = Conv2D(512, (3, 3), activation='relu', padding='same', kernel_regularizer=regularizer, name='conv10')(x)
             x = MaxPooling2D((2, 2), strides=(2, 2), name='pool2')(local2)
 
-            x = Conv2D(512, (3, 3), activation='relu', padding='same', kernel_regularizer=regularizer, name='conv11')(x)
-            x = Conv2D(512, (3, 3), activation='relu', padding='same', kernel_regularizer=regularizer, name='conv12')(x)
+            x = Conv2D(self.filters('conv11', 512), (3, 3), activation='relu', padding='same', kernel_regularizer=regularizer, name='conv11')(x)
+            x = Conv2D(self.filters('conv12', 512), (3, 3), activation='relu', padding='same', kernel_regularizer=regularizer, name='conv12')(x)
             local3 = Conv2D(512, (3, 3), activation='relu', padding='same', kernel_regularizer=regularizer, name='conv13')(x)
             x = MaxPooling2D((2, 2), strides=(2, 2), name='pool3')(local3)
 
-            x = Conv2D(512, (3, 3), activation='relu', padding='same', kernel_regularizer=regularizer, name='conv14')(x)
+            x = Conv2D(self.filters('conv14', 512), (3, 3), activation='relu', padding='same', kernel_regularizer=regularizer, name='conv14')(x)
             x = MaxPooling2D((2, 2), strides=(2, 2), name='pool4')(x)
-            x = Conv2D(512, (3, 3), activation='relu', padding='same', kernel_regularizer=regularizer, name='conv15')(x)
+            x = Conv2D(self.filters('conv15', 512), (3, 3), activation='relu', padding='same', kernel_regularizer=regularizer, name='conv15')(x)
             x = MaxPooling2D((2, 2), strides=(2, 2), name='pool5')(x)
             x = Flatten(name='pregflatten')(x)
             g = Dense(512, activation='relu', kernel_regularizer=regularizer, name='globalg')(x)  # batch*512
             return (g, local1, local2, local3)
 
-    def __init__(self, att='att3', gmode='concat', compatibilityfunction='pc', datasetname="cifar100", height=32, width=32, channels=3, outputclasses=10, batchnorm=True, batchnormalizeinput=True, weight_decay=0.0005, optimizer=SGD(lr=0.01, momentum=0.9, decay=0.0000001), loss='categorical_crossentropy', metrics=['accuracy']):
-        inp = Input(shape=(height, width, channels))
-        input = inp
-        if batchnormalizeinput:
-            input = BatchNormalization()(input)
-        regularizer = keras.regularizers.l2(weight_decay)
+    def __init__(self, att='att3', gmode='concat', compatibilityfunction='pc', datasetname="cifar100", height=32, width=32, channels=3, outputclasses=10, batchnorm=True, batchnormalizeinput=True, weight_decay=0.0005, optimizer=None, loss='categorical_crossentropy', metrics=['accuracy'], precision=None, compileonbuild=True, widths=None):
+        # optimizer=None gives each instance its own SGD(lr=0.01, momentum=0.9, decay=1e-7)
+        # widths maps conv layer names to filter counts (see pruning.py), conv10/conv13 stay at the 512 of g
+        self.att = att
+        self.gmode = gmode
+        self.compatibilityfunction = compatibilityfunction
         self.datasetname = datasetname
-        self.outputclasses=outputclasses
-
-        (g, local1, local2, local3) = self.VGGBlock(input,regularizer,batchnorm)
-
-        l1 = Dense(512, kernel_regularizer=regularizer, name='l1connectordense')(local1)  # batch*x*y*512
-        c1 = ParametrisedCompatibility(kernel_regularizer=regularizer, name='cpc1')([l1, g])  # batch*x*y
-        if compatibilityfunction == 'dp':
-            c1 = Lambda(lambda lam: K.squeeze(K.map_fn(lambda xy: K.dot(xy[0], xy[1]), elems=(lam[0], K.expand_dims(lam[1], -1)), dtype='float32'), 3), name='cdp1')([l1, g])  # batch*x*y
-        flatc1 = Flatten(name='flatc1')(c1)  # batch*xy
-        a1 = Activation('softmax', name='softmax1')(flatc1)  # batch*xy
-        reshaped1 = Reshape((-1,512), name='reshape1')(l1)  # batch*xy*512.
-        g1 = Lambda(lambda lam: K.squeeze(K.batch_dot(K.expand_dims(lam[0], 1), lam[1]), 1), name='g1')([a1, reshaped1])  # batch*512.
+        self.height, self.width, self.channels = height, width, channels
+        self.outputclasses = outputclasses
+        self.batchnorm = batchnorm
+        self.batchnormalizeinput = batchnormalizeinput
+        self.weight_decay = weight_decay
+        self.optimizer = optimizer
+        self.loss = loss
+        self.metrics = metrics
+        self.precision = precision
+        self.compileonbuild = compileonbuild
+        self.widths = widths or {}
+        self.name = ("(VGG-"+att+")-"+gmode+"-"+compatibilityfunction).replace('att)', 'att1)')
+
+    def defaultoptimizer(self):
+        from keras.optimizers import SGD
+        return SGD(lr=0.01, momentum=0.9, decay=0.0000001)
+
+    def build(self):
+        import keras
+        from keras.models import Model
+        regularizer = keras.regularizers.l2(self.weight_decay)
+        inp, (g1, g2, g3) = self.attentionfeatures(regularizer)
+        out = self.classifier(g1, g2, g3, self.att, self.gmode, regularizer)
+        model = Model(inputs=inp, outputs=out)
+        print("Generated "+self.name)
+        return model
 
-            
-        l2 = local2
-        c2 = ParametrisedCompatibility(kernel_regularizer=regularizer, name='cpc2')([l2, g])
-        if compatibilityfunction == 'dp':
-            c2 = Lambda(lambda lam: K.squeeze(K.map_fn(lambda xy: K.dot(xy[0], xy[1]), elems=(lam[0], K.expand_dims(lam[1], -1)), dtype='float32'), 3), name='cdp2')([l2, g])
-        flatc2 = Flatten(name='flatc2')(c2)
-        a2 = Activation('softmax', name='softmax2')(flatc2)
-        reshaped2 =  Reshape((-1,512), name='reshape2')(l2)
-        g2 = Lambda(lambda lam: K.squeeze(K.batch_dot(K.expand_dims(lam[0], 1), lam[1]), 1), name='g2')([a2, reshaped2])
+    def attentionfeatures(self, regularizer):
+        # input, backbone and the three attention heads: returns (input, [g1, g2, g3]) and sets the attention maps and locals
+        from keras.layers import Input, BatchNormalization
+        inp = Input(shape=(self.height, self.width, self.channels))
+        input = inp
+        if self.batchnormalizeinput:
+            input = BatchNormalization()(input)
 
-        
-        l3 = local3
-        c3 = ParametrisedCompatibility(kernel_regularizer=regularizer, name='cpc3')([l3, g])
-        if compatibilityfunction == 'dp':
-            c3 = Lambda(lambda lam: K.squeeze(K.map_fn(lambda xy: K.dot(xy[0], xy[1]), elems=(lam[0], K.expand_dims(lam[1], -1)), dtype='float32'), 3), name='cdp3')([l3, g])
-        flatc3 = Flatten(name='flatc3')(c3)
-        a3 = Activation('softmax', name='softmax3')(flatc3)
-        reshaped3 = Reshape((-1,512), name='reshape3')(l3)
-        g3 = Lambda(lambda lam: K.squeeze(K.batch_dot(K.expand_dims(lam[0], 1), lam[1]), 1), name='g3')([a3, reshaped3])
- 
+        (g, local1, local2, local3) = self.VGGBlock(input,regularizer,self.batchnorm)
+        self.backboneoutputs = [local1, local2, local3, g]
+
+        gs, self.attentionmaps, self.attentionlocals = self.attentionheads(local1, local2, local3, g, regularizer)
+        return inp, gs
+
+    def attentionheads(self, local1, local2, local3, g, regularizer):
+        # returns [g1, g2, g3], the attention maps [a1, a2, a3] and the attended locals [l1, l2, l3]; a head whose
+        # local is None is left out and None in all three
+        from keras.layers import Dense
+        from attentionlayers import AttentionPooling, attentionname
+        compatibilityfunction = self.compatibilityfunction
+        gs, maps, attended = [None]*3, [None]*3, [None]*3
+        for i, local in enumerate([local1, local2, local3]):
+            if local is None:
+                continue
+            if i == 0:
+                local = Dense(512, kernel_regularizer=regularizer, name='l1connectordense')(local)  # batch*x*y*512
+            gs[i], maps[i] = AttentionPooling(compatibilityfunction, kernel_regularizer=regularizer, return_attention=True, name=attentionname(compatibilityfunction, i+1))([local, g])  # batch*512, batch*xy
+            attended[i] = local
+        return gs, maps, attended
+
+    def backbonefeatures(self):
+        # the names of backbone()'s outputs: the locals of the active heads, then pregflatten
+        return ['local'+str(head) for head in self.activeheads()]+['pregflatten']
+
+    def backbone(self):
+        # self.model up to the attention heads, without globalg: image -> the locals of the active heads and pregflatten,
+        # sharing its layers and weights. globalg's input grows with the image size, so it stays with the heads: a
+        # source trained at another resolution has no globalg that fits
+        from keras.models import Model
+        model = self.model
+        return Model(inputs=model.inputs, outputs=[self.backboneoutputs[head-1] for head in self.activeheads()]+[model.get_layer('pregflatten').output])
+
+    def headmodel(self):
+        # a new model from the backbone() outputs through globalg and the active attention heads to the prediction, with
+        # the weights of globalg, the heads and classifier of self.model; its layer names match self.model, so weights
+        # map back by name
+        import keras
+        from keras import backend as K
+        from keras.models import Model
+        from keras.layers import Input, Dense
+        model = self.model
+        regularizer = keras.regularizers.l2(self.weight_decay)
+        heads = self.activeheads()
+        inputs = [Input(shape=K.int_shape(t)[1:]) for t in [self.backboneoutputs[head-1] for head in heads]+[model.get_layer('pregflatten').output]]
+        g = Dense.from_config(model.get_layer('globalg').get_config())(inputs[-1])
+        cached = dict(zip(heads, inputs))
+        (g1, g2, g3), _, _ = self.attentionheads(cached.get(1), cached.get(2), cached.get(3), g, regularizer)
+        headmodel = Model(inputs=inputs, outputs=self.classifier(g1, g2, g3, self.att, self.gmode, regularizer))
+        for layer in headmodel.layers:
+            if layer.weights:
+                layer.set_weights(model.get_layer(layer.name).get_weights())
+        return headmodel
+
+    def classifier(self, g1, g2, g3, att, gmode, regularizer, prefix=''):
+        # the classifier on the attended features for one att/gmode, prefix keeps layer names unique when several share a model
+        from keras.layers import Dense, Activation, Concatenate, Average
+        outputclasses = self.outputclasses
         out = ''
         if gmode == 'concat':
             glist = [g3]
@@ -235,78 +392,143 @@ class AttentionVGG:
                 glist.append(g1)
             predictedG = g3
             if att != 'att1' and att != 'att':
-                predictedG = Concatenate(axis=1, name='ConcatG')(glist)
-            x = Dense(outputclasses, kernel_regularizer=regularizer, name=str(outputclasses)+'ConcatG')(predictedG)
-            out = Activation("softmax", name='concatsoftmaxout')(x)
+                predictedG = Concatenate(axis=1, name=prefix+'ConcatG')(glist)
+            x = Dense(outputclasses, kernel_regularizer=regularizer, name=prefix+str(outputclasses)+'ConcatG')(predictedG)
+            out = Activation("softmax", name=prefix+'concatsoftmaxout')(x)
         else:
-            gd3 = Dense(outputclasses, activation='softmax', name=str(outputclasses)+'indepsoftmaxg3')(g3)
+            gd3 = Dense(outputclasses, activation='softmax', name=prefix+str(outputclasses)+'indepsoftmaxg3')(g3)
             if att == 'att' or att == 'att1':
                 out = gd3
             elif att == 'att2':
-                gd2 = Dense(outputclasses, activation='softmax', kernel_regularizer=regularizer, name=str(outputclasses)+'indepsoftmaxg2')(g2)
-                out = Add(name='addg3g2')([gd3, gd2])
-                out = Lambda(lambda lam: lam/2, name='2average')(out)
+                gd2 = Dense(outputclasses, activation='softmax', kernel_regularizer=regularizer, name=prefix+str(outputclasses)+'indepsoftmaxg2')(g2)
+                out = Average(name=prefix+'2average')([gd3, gd2])
             else:
-                gd2 = Dense(outputclasses, activation='softmax', kernel_regularizer=regularizer, name=str(outputclasses)+'indepsoftmaxg2')(g2)
-                gd1 = Dense(outputclasses, activation='softmax', kernel_regularizer=regularizer, name=str(outputclasses)+'indepsoftmaxg2')(g1)
-                out = Add(name='addg3g2g1')([gd1, gd2, gd3])
-                out = Lambda(lambda lam: lam/3, name='3average')(out)
-
-        model = Model(inputs=inp, outputs=out)
-        model.compile(optimizer=optimizer, loss=loss, metrics=metrics)
-        name = ("(VGG-"+att+")-"+gmode+"-"+compatibilityfunction).replace('att)', 'att1)')
-        print("Generated "+name)
-        self.name = name
-        self.model = model
-
-    def StandardFit(self, datasetname=None, X=[], Y=[], transfer=False, beep=False, initial_lr=0.01, min_delta=None, patience=7, validation_data=None, lrplateaufactor=None, lrplateaupatience=4):
-        Y = keras.utils.to_categorical(Y,self.outputclasses)
+                gd2 = Dense(outputclasses, activation='softmax', kernel_regularizer=regularizer, name=prefix+str(outputclasses)+'indepsoftmaxg2')(g2)
+                gd1 = Dense(outputclasses, activation='softmax', kernel_regularizer=regularizer, name=prefix+str(outputclasses)+'indepsoftmaxg1')(g1)
+                out = Average(name=prefix+'3average')([gd1, gd2, gd3])
+        return out
+
+    def StandardFit(self, datasetname=None, X=[], Y=[], transfer=False, beep=False, initial_lr=0.01, min_delta=None, patience=7, validation_data=None, lrplateaufactor=None, lrplateaupatience=4, stream=False, workers=4, prefetch=10, shufflebuffer=None, augment=None, keep_last=3, checkpointperiod=1, distributed=False, batch_size=128, epochs=300, profile=False):
+        from keras.callbacks import LearningRateScheduler, TensorBoard, EarlyStopping, ReduceLROnPlateau
+        from checkpoints import CheckpointManager, AsyncCheckpoint
+        from callbacks import LearningRateScaler, Beeper
+        from metrics import MetricsSink
+        from profiling import Profiler
+        import distributed as distributedtraining
+        if transfer == 'frozen':
+            return self.FrozenTransferFit(datasetname, X, Y, validation_data=validation_data, initial_lr=initial_lr, min_delta=min_delta, patience=patience, keep_last=keep_last, batch_size=batch_size, epochs=epochs, workers=workers, prefetch=prefetch)
         if datasetname==None:
             datasetname=self.datasetname
-        if os.path.isfile("weights/"+self.name+"-"+datasetname+" early.hdf5"):
+        checkpoints = CheckpointManager("weights", self.name+"-"+datasetname, keep_last=keep_last)
+        if distributed:
+            hvd = distributedtraining.init()
+        # rank 0's checkpoints decide for every worker (agree), the others need not share its weights directory
+        if distributedtraining.agree(checkpoints.early() is not None):
             print("Found early-stopped weights for "+self.name+"-"+datasetname)
             return
-        scheduler = LearningRateScaler(25, 0.5, initial_lr)
-        startingepoch = 0
-        pastepochs = list(map(int, [x.replace(".hdf5", "").replace(self.name+"-"+datasetname, "").replace(" ", "") for x in os.listdir("weights") if (self.name+"-"+datasetname in x) & ("early" not in x)]))
-        if len(pastepochs):
-            if max(pastepochs) == 300:                
+        if not self.compiled():
+            self.compile()
+        workercount = 1
+        if distributed:
+            workercount = hvd.size()
+            distributedtraining.distribute(self.model)
+        scheduler = LearningRateScaler(25, 0.5, initial_lr, scale=workercount)  # linear lr scaling with the global batch
+        startingepoch = distributedtraining.agree(checkpoints.latest() or 0)
+        if startingepoch:
+            if startingepoch == epochs:
                 print("Found completely trained weights for "+self.name+"-"+datasetname)
                 return
-            self.model.load_weights("weights/"+self.name+"-"+datasetname+" "+str(max(pastepochs))+".hdf5")
-            startingepoch = max(pastepochs)
+            if distributedtraining.ischief():  # BroadcastGlobalVariablesCallback hands rank 0's weights to the others
+                self.model.load_weights(checkpoints.path(startingepoch))
         elif transfer:
-            if os.path.isfile("weights/"+self.name+"-"+datasetname+" early.hdf5"):
-                self.model.load_weights("weights/"+self.name+"-"+datasetname+" early.hdf5", by_name=True)
-            else:
-                self.model.load_weights("weights/"+self.name+"-cifar100 300.hdf5", by_name=True)
-            scheduler = LearningRateScheduler(transfer_schedule)
+            if distributedtraining.ischief():
+                # globalg mismatches when the image size differs from the source's and is trained from scratch
+                self.model.load_weights(CheckpointManager("weights", self.name+"-cifar100").trained(), by_name=True, skip_mismatch=True)
+            scheduler = LearningRateScheduler(lambda epoch: AttentionVGG.transfer_schedule(epoch)*workercount)
         tboardcb = TensorBoard(log_dir='./logs', histogram_freq=0, batch_size=3, write_graph=True, write_grads=False, write_images=False, embeddings_freq=0, embeddings_layer_names=None, embeddings_metadata=None)
-        checkpoint = ModelCheckpoint("weights/"+self.name+"-"+datasetname+" {epoch}.hdf5", save_weights_only=True)
-        epochprint = LambdaCallback(on_epoch_end=lambda epoch, logs: print("Passed epoch "+str(epoch)))
-        callbackslist = [scheduler, checkpoint, epochprint, tboardcb]
+        checkpoint = AsyncCheckpoint(checkpoints, period=checkpointperiod)
+        metricsink = MetricsSink(os.path.join('./logs', self.name+"-"+datasetname+"-metrics.jsonl"))
+        callbackslist = [scheduler, checkpoint, tboardcb, metricsink]
+        shard = None
+        if distributed:  # only rank 0 writes checkpoints and logs, every worker trains on its own shard
+            callbackslist = distributedtraining.callbacks() + [scheduler]
+            if distributedtraining.ischief():
+                callbackslist += [checkpoint, tboardcb, metricsink]
+            shard = (distributedtraining.rank(), workercount)
         if beep:
             callbackslist.append(Beeper(1))
-        if validation_data == None:
-            self.model.fit(X, Y, 128, 300, callbacks=callbackslist, initial_epoch=startingepoch,shuffle=True)
-        else:
-            if min_delta != None:
-                callbackslist.append(EarlyStopping(monitor='val_acc', min_delta=min_delta, patience=patience))        
-            if lrplateaufactor != None:
-                callbackslist.append(ReduceLROnPlateau(monitor='loss', factor = lrplateaufactor, patience = lrplateaupatience))
-            self.model.fit(X, Y, 128, 300, callbacks=callbackslist, initial_epoch=startingepoch,shuffle=True,validation_data=(validation_data[0], keras.utils.to_categorical(validation_data[1],self.outputclasses)))            
-            self.model.save_weights("weights/"+self.name+"-"+datasetname+" early.hdf5")
-        pastepochs = list(map(int, [x.replace(".hdf5", "").replace(self.name+"-"+datasetname, "").replace(" ", "") for x in os.listdir("weights") if (self.name+"-"+datasetname in x) & ("early" not in x)]))
-        if max(pastepochs) > 290:
-            for filenum in range(1,297):  #delete most of the lower weight files
-                try:
-                    os.remove("weights/"+self.name+"-"+datasetname+" "+str(filenum)+".hdf5")
-                except OSError:
-                    pass
+        if profile and distributedtraining.ischief():  # summary table at the end, trace next to the TensorBoard logs
+            callbackslist.append(Profiler(trace=os.path.join('./logs', self.name+"-"+datasetname+"-trace.json")))
+        try:
+            if validation_data == None:
+                fitmodel(self.model, X, Y, batch_size, epochs, self.outputclasses, callbackslist, startingepoch, stream=stream, workers=workers, prefetch=prefetch, shufflebuffer=shufflebuffer, augment=augment, shard=shard)
+            else:
+                if min_delta != None:
+                    callbackslist.append(EarlyStopping(monitor=self.monitor, min_delta=min_delta, patience=patience))        
+                if lrplateaufactor != None:
+                    callbackslist.append(ReduceLROnPlateau(monitor='loss', factor = lrplateaufactor, patience = lrplateaupatience))
+                fitmodel(self.model, X, Y, batch_size, epochs, self.outputclasses, callbackslist, startingepoch, validation_data, stream=stream, workers=workers, prefetch=prefetch, shufflebuffer=shufflebuffer, augment=augment, shard=shard)
+                if distributedtraining.ischief():
+                    checkpoints.saveearly(self.model)
+        finally:
+            metricsink.close()  # on_train_end never comes when fit raises, the queued events are written anyway
+            checkpoint.close()  # the last snapshot is on disk before StandardFit returns
         return self.model
 
-    
 
+    def FrozenTransferFit(self, datasetname=None, X=[], Y=[], source="cifar100", validation_data=None, initial_lr=0.01, min_delta=None, patience=7, keep_last=3, batch_size=128, epochs=300, workers=4, prefetch=10, cachedirectory="features", cachelimit=None):
+        # transfer with the backbone frozen (StandardFit(transfer='frozen')): loads the weights trained on source, runs the
+        # backbone once over X (and the validation images) into a featurecache.FeatureCache, then trains only
+        # globalg, the attention heads and the classifier from the cached features. No augmentation, the features are fixed.
+        # Only the locals of the active heads are cached: local1, by far the largest, only for att3. cachelimit (GB)
+        # stops before extracting a split that would take more.
+        from keras.callbacks import EarlyStopping
+        from checkpoints import CheckpointManager, AsyncCheckpoint
+        from callbacks import LearningRateScaler
+        from metrics import MetricsSink
+        from featurecache import FeatureCache, weightshash
+        if datasetname==None:
+            datasetname=self.datasetname
+        checkpoints = CheckpointManager("weights", self.name+"-"+datasetname, keep_last=keep_last)
+        if checkpoints.early() is not None:
+            print("Found early-stopped weights for "+self.name+"-"+datasetname)
+            return
+        sourcecheckpoints = CheckpointManager("weights", self.name+"-"+source)
+        # between image sizes globalg (and the classifier, by class count) mismatch and keep their initialisation,
+        # both train in the head model
+        self.model.load_weights(sourcecheckpoints.trained(), by_name=True, skip_mismatch=True)
+        backbone = self.backbone()
+        cache = FeatureCache(cachedirectory, datasetname, weightshash(backbone), names=self.backbonefeatures())
+        limit = None if cachelimit is None else cachelimit*2**30
+        features = cache.extract(backbone, X, 'train', batch_size, limit=limit)
+        validation = None
+        if validation_data is not None:
+            validation = (cache.extract(backbone, validation_data[0], 'test', batch_size, limit=limit), validation_data[1])
+
+        heads = self.headmodel()
+        optimizer = self.defaultoptimizer() if self.optimizer is None else self.optimizer.__class__.from_config(self.optimizer.get_config())
+        heads.compile(optimizer=optimizer, loss=self.loss, metrics=self.metrics)
+        headcheckpoints = CheckpointManager("weights", self.name+"-"+datasetname+"-heads", keep_last=keep_last)
+        startingepoch = 0
+        latest = headcheckpoints.latest()
+        if latest is not None:
+            heads.load_weights(headcheckpoints.path(latest))
+            startingepoch = latest
+        checkpoint = AsyncCheckpoint(headcheckpoints)
+        metricsink = MetricsSink(os.path.join('./logs', self.name+"-"+datasetname+"-heads-metrics.jsonl"))
+        callbackslist = [LearningRateScaler(25, 0.5, initial_lr), checkpoint, metricsink]
+        if validation is not None and min_delta is not None:
+            callbackslist.append(EarlyStopping(monitor=self.monitor, min_delta=min_delta, patience=patience))
+        try:
+            fitmodel(heads, features, Y, batch_size, epochs, self.outputclasses, callbackslist, startingepoch, validation, stream=True, workers=workers, prefetch=prefetch)
+        finally:
+            metricsink.close()
+            checkpoint.close()
+        for layer in heads.layers:  # trained heads back into the full model
+            if layer.weights:
+                self.model.get_layer(layer.name).set_weights(layer.get_weights())
+        checkpoints.saveearly(self.model)
+        return self.model
 
     def transfer_schedule(epoch):
             if epoch < 30:
@@ -328,108 +550,154 @@ class AttentionVGG:
             if epoch < 270:
                 return 0.00625
             return 0.003125
-    
-class AttentionRN:
-    def __init__(self, att='att2', gmode='concat', compatibilityfunction='pc', datasetname="cifar10", height=32, width=32, channels=3, outputclasses=100, weight_decay=0.0005, optimizer=SGD(lr=0.01, momentum=0.9), loss='categorical_crossentropy', metrics=['accuracy']):
-        inp = Input(shape=(height, width, channels)) #batch*x*y*3
-        regularizer = keras.regularizers.l2(weight_decay)
+
+
+class MultiHeadVGG(AttentionVGG):
+    # one VGG backbone and one set of attention heads shared by several classifier heads (att1/att2/att3, concat/indep),
+    # trained jointly with one loss per head, so an ablation over the heads costs about one training instead of one each.
+    # head(att, gmode) turns a trained head into a standalone AttentionVGG, saveheads() stores all of them as
+    # early-stopped weights where AttentionVGG(att, gmode).StandardFit and experiments.py look for them.
+
+    HEADS = [(att, gmode) for gmode in ('concat', 'indep') for att in ('att1', 'att2', 'att3')]
+    monitor = 'val_loss'  # the sum over the heads
+
+    def __init__(self, heads=None, **kwargs):
+        kwargs.pop('att', None)
+        kwargs.pop('gmode', None)
+        self.options = dict((key, value) for key, value in kwargs.items() if key not in ('optimizer', 'compileonbuild'))
+        AttentionVGG.__init__(self, **kwargs)
+        self.heads = [('att1' if att == 'att' else att, gmode) for att, gmode in (heads or MultiHeadVGG.HEADS)]
+        self.name = "(VGG-multihead)-"+self.compatibilityfunction
+
+    def headname(self, att, gmode):
+        return att+gmode
+
+    def activeheads(self):
+        return sorted(set(head for att, _ in self.heads for head in activeheads(att)))
+
+    def build(self):
+        import keras
+        from keras.models import Model
+        regularizer = keras.regularizers.l2(self.weight_decay)
+        inp, (g1, g2, g3) = self.attentionfeatures(regularizer)
+        self.headoutputs = [self.classifier(g1, g2, g3, att, gmode, regularizer, prefix=self.headname(att, gmode)+'_') for att, gmode in self.heads]
+        model = Model(inputs=inp, outputs=self.headoutputs)
+        print("Generated "+self.name+" with heads "+", ".join(self.headname(att, gmode) for att, gmode in self.heads))
+        return model
+
+    def head(self, att, gmode):
+        # the trained head as an AttentionVGG(att, gmode) with its own graph: the head's subgraph of the shared model
+        # has the same layers in the same order as the standalone model, only the classifier layers are prefixed
+        from keras.models import Model
+        if att == 'att':
+            att = 'att1'
+        if (att, gmode) not in self.heads:
+            raise ValueError('no '+self.headname(att, gmode)+' head, the heads are '+str(self.heads))
+        model = self.model
+        subgraph = Model(inputs=model.inputs, outputs=self.headoutputs[self.heads.index((att, gmode))])
+        net = AttentionVGG(att=att, gmode=gmode, compileonbuild=False, **self.options)
+        prefix = self.headname(att, gmode)+'_'
+        sources = [layer for layer in subgraph.layers if layer.weights]
+        targets = [layer for layer in net.model.layers if layer.weights]
+        if len(sources) != len(targets):
+            raise ValueError('head '+prefix[:-1]+' has '+str(len(sources))+' weighted layers, '+net.name+' has '+str(len(targets)))
+        for source, target in zip(sources, targets):
+            shapes = [w.shape for w in source.get_weights()]
+            if type(source) is not type(target) or shapes != [w.shape for w in target.get_weights()] or (source.name.startswith(prefix) and source.name[len(prefix):] != target.name):
+                raise ValueError('layer '+source.name+' of head '+prefix[:-1]+' does not match '+target.name+' of '+net.name)
+            target.set_weights(source.get_weights())
+        return net
+
+    def saveheads(self, datasetname=None):
+        from checkpoints import CheckpointManager
+        datasetname = datasetname or self.datasetname
+        nets = []
+        for att, gmode in self.heads:
+            net = self.head(att, gmode)
+            CheckpointManager("weights", net.name+"-"+datasetname).saveearly(net.model)
+            nets.append(net)
+        return nets
+
+
+class AttentionRN(AttentionNet):
+    def __init__(self, att='att2', gmode='concat', compatibilityfunction='pc', datasetname="cifar10", height=32, width=32, channels=3, outputclasses=100, weight_decay=0.0005, optimizer=None, loss='categorical_crossentropy', metrics=['accuracy'], precision=None, compileonbuild=True, widths=None, blocks=18, widthmultiplier=1, checkpointing=False):
+        # optimizer=None gives each instance its own SGD(lr=0.01, momentum=0.9)
+        # blocks (bottleneck blocks per stage) and widthmultiplier (all filter counts and g) size down a student for distillation.py
+        # widths maps conv layer names to filter counts (see pruning.py), the residual streams (conv3, dimchangeconv) keep theirs
+        # checkpointing keeps only the residual block boundaries for backprop and recomputes inside the blocks (recompute.py),
+        # trading about one extra forward pass per step for the activation memory of larger batches and 80x80 inputs
+        self.att = att
+        self.gmode = gmode
+        self.compatibilityfunction = compatibilityfunction
         self.datasetname = datasetname
-        self.outputclasses=outputclasses
+        self.height, self.width, self.channels = height, width, channels
+        self.outputclasses = outputclasses
+        self.weight_decay = weight_decay
+        self.optimizer = optimizer
+        self.loss = loss
+        self.metrics = metrics
+        self.precision = precision
+        self.compileonbuild = compileonbuild
+        self.widths = widths or {}
+        self.blocks = blocks
+        self.widthmultiplier = widthmultiplier
+        if checkpointing and precision is not None:
+            raise ValueError('checkpointing and precision="'+str(precision)+'" are not supported together, use one or the other')
+        self.checkpointing = checkpointing
+        self.name = ("(RN-"+att+")-"+gmode+"-"+compatibilityfunction).replace('att)', 'att1)')
+        if blocks != 18 or widthmultiplier != 1:
+            self.name += "-b"+str(blocks)+"w"+str(widthmultiplier)
+
+    def scaled(self, filters):
+        return max(1, int(round(filters*self.widthmultiplier)))
+
+    def defaultoptimizer(self):
+        from keras.optimizers import SGD
+        return SGD(lr=0.01, momentum=0.9)
+
+    def build(self):
+        import keras
+        from keras.models import Model
+        from keras.layers import Input, Dense, Activation, Flatten, Conv2D, Concatenate, Average, MaxPooling2D, BatchNormalization
+        from attentionlayers import AttentionPooling, attentionname
+        att, gmode, compatibilityfunction, outputclasses = self.att, self.gmode, self.compatibilityfunction, self.outputclasses
+        inp = Input(shape=(self.height, self.width, self.channels)) #batch*x*y*3
+        regularizer = keras.regularizers.l2(self.weight_decay)
         x = BatchNormalization()(inp)
 
         #block1, out batch*(x)*(y)*16
-        x = Conv2D(16, (3, 3), padding='same', kernel_regularizer=regularizer, name='block1conv1')(x)
+        x = Conv2D(self.filters('block1conv1', self.scaled(16)), (3, 3), padding='same', kernel_regularizer=regularizer, name='block1conv1')(x)
         x = BatchNormalization()(x)
         x = Activation('relu')(x)
-        x = Conv2D(16, (3, 3), padding='same', kernel_regularizer=regularizer, name='block1conv2')(x) #batch*x*y*16
+        x = Conv2D(self.filters('block1conv2', self.scaled(16)), (3, 3), padding='same', kernel_regularizer=regularizer, name='block1conv2')(x) #batch*x*y*16
         x = BatchNormalization()(x)
         
+        stem = x
+        segments = []  # (block input, block, block output) per residual block, recomputed by recompute.py
+
         #block2, out batch*(x/2)*(y/2)*64
-        for i in range(0,18):
-            identity = x
-            if i == 0:
-                identity=Conv2D(64,(2,2), padding='same', kernel_regularizer=regularizer, name='block2dimchangeconv')(identity)
-            x = Conv2D(16, (1, 1), padding='same', kernel_regularizer=regularizer, name='block2resblock'+str((i+1))+'conv1')(x)
-            x = BatchNormalization()(x)
-            x = Activation('relu')(x)
-            x = Conv2D(16, (3, 3), padding='same', kernel_regularizer=regularizer, name='block2resblock'+str((i+1))+'conv2')(x)
-            x = BatchNormalization()(x)
-            x = Activation('relu')(x)
-            x = Conv2D(64, (1, 1), padding='same', kernel_regularizer=regularizer, name='block2resblock'+str((i+1))+'conv3')(x)
-            x = BatchNormalization()(x)
-            x = Add()([identity,x])
-            x = Activation('relu')(x)
+        x = self.resstage(x, 2, 16, 64, regularizer, segments)
         l1 = x #16 filters, 32x32 resolution
-        x = MaxPooling2D((2, 2), strides=(2, 2), name='block2pool')(x)
 
         #block3, out batch*(x/4)*(y/4)*128
-        for i in range(0,18):
-            identity = x
-            if i == 0:
-                identity=Conv2D(128, (2,2), padding='same', kernel_regularizer=regularizer, name='block3dimchangeconv')(identity)            
-            x = Conv2D(32, (1, 1), padding='same', kernel_regularizer=regularizer, name='block3resblock'+str((i+1))+'conv1')(x)
-            x = BatchNormalization()(x)
-            x = Activation('relu')(x)
-            x = Conv2D(32, (3, 3), padding='same', kernel_regularizer=regularizer, name='block3resblock'+str((i+1))+'conv2')(x)
-            x = BatchNormalization()(x)
-            x = Activation('relu')(x)
-            x = Conv2D(128, (1, 1), padding='same', kernel_regularizer=regularizer, name='block3resblock'+str((i+1))+'conv3')(x)
-            x = BatchNormalization()(x)
-            x = Add()([identity,x])
-            x = Activation('relu')(x)
+        x = self.resstage(x, 3, 32, 128, regularizer, segments, MaxPooling2D((2, 2), strides=(2, 2), name='block2pool'))
         l2 = x #256 filters, 16x16 resolution
-        x = MaxPooling2D((2, 2), strides=(2, 2), name='block3pool')(x)
 
         #block4, out batch*(x/4)*(y/4)*256
-        for i in range(0,18):
-            identity = x
-            if i == 0:
-                identity=Conv2D(256, (2,2), padding='same', kernel_regularizer=regularizer, name='block4dimchangeconv')(identity)            
-            x = Conv2D(64, (1, 1), padding='same', kernel_regularizer=regularizer, name='block4resblock'+str((i+1))+'conv1')(x)
-            x = BatchNormalization()(x)
-            x = Activation('relu')(x)
-            x = Conv2D(64, (3, 3), padding='same', kernel_regularizer=regularizer, name='block4resblock'+str((i+1))+'conv2')(x)
-            x = BatchNormalization()(x)
-            x = Activation('relu')(x)
-            x = Conv2D(256, (1, 1), padding='same', kernel_regularizer=regularizer, name='block4resblock'+str((i+1))+'conv3')(x)
-            x = BatchNormalization()(x)
-            x = Add()([identity,x])
-            x = Activation('relu')(x)
+        x = self.resstage(x, 4, 64, 256, regularizer, segments, MaxPooling2D((2, 2), strides=(2, 2), name='block3pool'))
         l3 = x #512 filters, 8x8 resolution
         
-        x = Conv2D(256, (3, 3), padding='same', kernel_regularizer=regularizer, name='outconv')(x) 
+        x = Conv2D(self.filters('outconv', self.scaled(256)), (3, 3), padding='same', kernel_regularizer=regularizer, name='outconv')(x) 
         x = BatchNormalization()(x)
         x = MaxPooling2D((2,2), strides=(2,2), name="gpool")(x)
         gbase = Flatten(name='pregflatten')(x)
         
-        g64 = Dense(64, kernel_regularizer=regularizer, name='globalg64')(gbase)
-        g128 = Dense(128, kernel_regularizer=regularizer, name='globalg128')(gbase)
-        g256 = Dense(256, kernel_regularizer=regularizer, name='globalg256')(gbase)        
-
-
-        c1 = ParametrisedCompatibility(kernel_regularizer=regularizer, name='cpc1')([l1, g64])  # batch*x*y
-        if compatibilityfunction == 'dp':
-            c1 = Lambda(lambda lam: K.squeeze(K.map_fn(lambda xy: K.dot(xy[0], xy[1]), elems=(lam[0], K.expand_dims(lam[1], -1)), dtype='float32'), 3), name='cdp1')([l1, g64])  # batch*x*y
-        flatc1 = Flatten(name='flatc1')(c1)  # batch*xy
-        a1 = Activation('softmax', name='softmax1')(flatc1)  # batch*xy
-        reshaped1 = Reshape((-1,64), name='reshape1')(l1)  # batch*xy*256.
-        g1 = Lambda(lambda lam: K.squeeze(K.batch_dot(K.expand_dims(lam[0], 1), lam[1]), 1), name='g1')([a1, reshaped1])  # batch*256.
-        
-        c2 = ParametrisedCompatibility(kernel_regularizer=regularizer, name='cpc2')([l2, g128])
-        if compatibilityfunction == 'dp':
-            c2 = Lambda(lambda lam: K.squeeze(K.map_fn(lambda xy: K.dot(xy[0], xy[1]), elems=(lam[0], K.expand_dims(lam[1], -1)), dtype='float32'), 3), name='cdp2')([l2, g128])
-        flatc2 = Flatten(name='flatc2')(c2)
-        a2 = Activation('softmax', name='softmax2')(flatc2)
-        reshaped2 =  Reshape((-1,128), name='reshape2')(l2)
-        g2 = Lambda(lambda lam: K.squeeze(K.batch_dot(K.expand_dims(lam[0], 1), lam[1]), 1), name='g2')([a2, reshaped2])
-
-        c3 = ParametrisedCompatibility(kernel_regularizer=regularizer, name='cpc3')([l3, g256])
-        if compatibilityfunction == 'dp':
-            c3 = Lambda(lambda lam: K.squeeze(K.map_fn(lambda xy: K.dot(xy[0], xy[1]), elems=(lam[0], K.expand_dims(lam[1], -1)), dtype='float32'), 3), name='cdp3')([l3, g256])
-        flatc3 = Flatten(name='flatc3')(c3)
-        a3 = Activation('softmax', name='softmax3')(flatc3)
-        reshaped3 = Reshape((-1,256), name='reshape3')(l3)
-        g3 = Lambda(lambda lam: K.squeeze(K.batch_dot(K.expand_dims(lam[0], 1), lam[1]), 1), name='g3')([a3, reshaped3])
+        g64 = Dense(self.scaled(64), kernel_regularizer=regularizer, name='globalg64')(gbase)
+        g128 = Dense(self.scaled(128), kernel_regularizer=regularizer, name='globalg128')(gbase)
+        g256 = Dense(self.scaled(256), kernel_regularizer=regularizer, name='globalg256')(gbase)        
+        g1, a1 = AttentionPooling(compatibilityfunction, kernel_regularizer=regularizer, return_attention=True, name=attentionname(compatibilityfunction, 1))([l1, g64])  # batch*64, batch*xy
+        g2, a2 = AttentionPooling(compatibilityfunction, kernel_regularizer=regularizer, return_attention=True, name=attentionname(compatibilityfunction, 2))([l2, g128])
+        g3, a3 = AttentionPooling(compatibilityfunction, kernel_regularizer=regularizer, return_attention=True, name=attentionname(compatibilityfunction, 3))([l3, g256])
 
         out = ''
         if gmode == 'concat':
@@ -451,125 +719,146 @@ class AttentionRN:
                 out = gd3
             elif att == 'att2':
                 gd2 = Dense(outputclasses, activation='softmax', kernel_regularizer=regularizer, name=str(outputclasses)+'indepsoftmaxg2')(g2)
-                out = Add(name='addg3g2')([gd3, gd2])
-                out = Lambda(lambda lam: lam/2, name='2average')(out)
+                out = Average(name='2average')([gd3, gd2])
             else:
                 gd2 = Dense(outputclasses, activation='softmax', kernel_regularizer=regularizer, name=str(outputclasses)+'indepsoftmaxg2')(g2)
-                gd1 = Dense(outputclasses, activation='softmax', kernel_regularizer=regularizer, name=str(outputclasses)+'indepsoftmaxg2')(g1)
-                out = Add(name='addg3g2g1')([gd1, gd2, gd3])
-                out = Lambda(lambda lam: lam/3, name='3average')(out)
+                gd1 = Dense(outputclasses, activation='softmax', kernel_regularizer=regularizer, name=str(outputclasses)+'indepsoftmaxg1')(g1)
+                out = Average(name='3average')([gd1, gd2, gd3])
 
         model = Model(inputs=inp, outputs=out)
-        model.compile(optimizer=optimizer, loss=loss, metrics=metrics)
-        name = ("(RN-"+att+")-"+gmode+"-"+compatibilityfunction).replace('att)', 'att1)')
-        print("Generated "+name)
-        self.name = name
-        self.model = model
-    
-    def StandardFit(self, datasetname=None, X=[], Y=[], beep=False, initial_lr=0.01, min_delta=None, patience=3, validation_data=None, lrplateaufactor=None, lrplateaupatience=4):
-        Y = keras.utils.to_categorical(Y,self.outputclasses)
+        self.attentionmaps = [a1, a2, a3]
+        self.attentionlocals = [l1, l2, l3]
+        self.recomputation = (stem, segments)
+        print("Generated "+self.name)
+        return model
+
+    def resblock(self, stage, i, bottleneck, outfilters, regularizer):
+        # the layers of one bottleneck block as a function input -> output, which can be applied again to another
+        # tensor with the same weights; the first block of a stage changes the shortcut's depth with a 2x2 conv
+        from keras.layers import Conv2D, BatchNormalization, Activation, Add
+        prefix = 'block'+str(stage)+'resblock'+str(i+1)
+        dimchange = None
+        if i == 0:
+            dimchange = Conv2D(self.scaled(outfilters), (2,2), padding='same', kernel_regularizer=regularizer, name='block'+str(stage)+'dimchangeconv')
+        layers = [Conv2D(self.filters(prefix+'conv1', self.scaled(bottleneck)), (1, 1), padding='same', kernel_regularizer=regularizer, name=prefix+'conv1'),
+                  BatchNormalization(), Activation('relu'),
+                  Conv2D(self.filters(prefix+'conv2', self.scaled(bottleneck)), (3, 3), padding='same', kernel_regularizer=regularizer, name=prefix+'conv2'),
+                  BatchNormalization(), Activation('relu'),
+                  Conv2D(self.scaled(outfilters), (1, 1), padding='same', kernel_regularizer=regularizer, name=prefix+'conv3'),
+                  BatchNormalization()]
+        add, relu = Add(), Activation('relu')
+        def block(x):
+            identity = x if dimchange is None else dimchange(x)
+            for layer in layers:
+                x = layer(x)
+            return relu(add([identity, x]))
+        return block
+
+    def resstage(self, x, stage, bottleneck, outfilters, regularizer, segments, pool=None):
+        # self.blocks bottleneck blocks, each recorded in segments; the pooling from the previous stage is part of the first
+        for i in range(0,self.blocks):
+            block = self.resblock(stage, i, bottleneck, outfilters, regularizer)
+            if i == 0 and pool is not None:
+                block = (lambda block: lambda t: block(pool(t)))(block)
+            output = block(x)
+            segments.append((x, block, output))
+            x = output
+        return x
+
+    def StandardFit(self, datasetname=None, X=[], Y=[], beep=False, initial_lr=0.01, min_delta=None, patience=3, validation_data=None, lrplateaufactor=None, lrplateaupatience=4, stream=False, workers=4, prefetch=10, shufflebuffer=None, augment=None, keep_last=3, checkpointperiod=1, distributed=False, batch_size=64, epochs=200, profile=False):
+        from keras.callbacks import TensorBoard, EarlyStopping, ReduceLROnPlateau
+        from checkpoints import CheckpointManager, AsyncCheckpoint
+        from callbacks import LearningRateScaler, Beeper
+        from metrics import MetricsSink
+        from profiling import Profiler
+        import distributed as distributedtraining
         if datasetname==None:
             datasetname=self.datasetname
-        if os.path.isfile("weights/"+self.name+"-"+datasetname+" early.hdf5"):
+        checkpoints = CheckpointManager("weights", self.name+"-"+datasetname, keep_last=keep_last)
+        if distributed:
+            hvd = distributedtraining.init()
+        # rank 0's checkpoints decide for every worker (agree), the others need not share its weights directory
+        if distributedtraining.agree(checkpoints.early() is not None):
             print("Found early-stopped weights for "+self.name+"-"+datasetname)
             return
-        scheduler = LearningRateScaler([60, 120, 160], 0.2, initial_lr)
-        startingepoch = 0
-        pastepochs = list(map(int, [x.replace(".hdf5", "").replace(self.name+"-"+datasetname, "").replace(" ", "") for x in os.listdir("weights") if (self.name+"-"+datasetname in x) & ("early" not in x)]))
-        if pastepochs:
-            if max(pastepochs) == 200:
+        if not self.compiled():
+            self.compile()
+        workercount = 1
+        if distributed:
+            workercount = hvd.size()
+            distributedtraining.distribute(self.model)
+        scheduler = LearningRateScaler([60, 120, 160], 0.2, initial_lr, scale=workercount)
+        startingepoch = distributedtraining.agree(checkpoints.latest() or 0)
+        if startingepoch:
+            if startingepoch == epochs:
                 print("Found completely trained weights for "+self.name+"-"+datasetname)
                 return
-            self.model.load_weights("weights/"+self.name+"-"+datasetname+" "+str(max(pastepochs))+".hdf5")
-            startingepoch = max(pastepochs)
+            if distributedtraining.ischief():  # BroadcastGlobalVariablesCallback hands rank 0's weights to the others
+                self.model.load_weights(checkpoints.path(startingepoch))
         tboardcb = TensorBoard(log_dir='./logs', histogram_freq=0, batch_size=3, write_graph=True, write_grads=False, write_images=False, embeddings_freq=0, embeddings_layer_names=None, embeddings_metadata=None)
-        checkpoint = ModelCheckpoint("weights/"+self.name+"-"+datasetname+" {epoch}.hdf5", save_weights_only=True)
-        epochprint = LambdaCallback(on_epoch_end=lambda epoch, logs: print("Passed epoch "+str(epoch)))
-        callbackslist = [scheduler, checkpoint, epochprint, tboardcb]
+        checkpoint = AsyncCheckpoint(checkpoints, period=checkpointperiod)
+        metricsink = MetricsSink(os.path.join('./logs', self.name+"-"+datasetname+"-metrics.jsonl"))
+        callbackslist = [scheduler, checkpoint, tboardcb, metricsink]
+        shard = None
+        if distributed:  # only rank 0 writes checkpoints and logs, every worker trains on its own shard
+            callbackslist = distributedtraining.callbacks() + [scheduler]
+            if distributedtraining.ischief():
+                callbackslist += [checkpoint, tboardcb, metricsink]
+            shard = (distributedtraining.rank(), workercount)
         if beep:
             callbackslist.append(Beeper(1))
-        if validation_data == None:
-            self.model.fit(X, Y, 64, 200, callbacks=callbackslist, initial_epoch=startingepoch,shuffle=True)
-        else:
-            if min_delta != None:
-                callbackslist.append(EarlyStopping(monitor='val_acc', min_delta=min_delta, patience=patience))
-            if lrplateaufactor != None:
-                callbackslist.append(ReduceLROnPlateau(monitor='acc', factor = lrplateaufactor, patience = lrplateaupatience))
-            self.model.fit(X, Y, 64, 200, callbacks=callbackslist, initial_epoch=startingepoch,shuffle=True,validation_data=(validation_data[0], keras.utils.to_categorical(validation_data[1],self.outputclasses)))    
-            self.model.save_weights("weights/"+self.name+"-"+datasetname+" early.hdf5")
-        pastepochs = list(map(int, [x.replace(".hdf5", "").replace(self.name+"-"+datasetname, "").replace(" ", "") for x in os.listdir("weights") if (self.name+"-"+datasetname in x) & ("early" not in x)]))
-        if max(pastepochs) > 190:
-            for filenum in range(1,197):
-                try:
-                    os.remove("weights/"+self.name+"-"+datasetname+" "+str(filenum)+".hdf5")
-                except OSError:
-                    pass
+        if profile and distributedtraining.ischief():  # summary table at the end, trace next to the TensorBoard logs
+            callbackslist.append(Profiler(trace=os.path.join('./logs', self.name+"-"+datasetname+"-trace.json")))
+        try:
+            if validation_data == None:
+                fitmodel(self.model, X, Y, batch_size, epochs, self.outputclasses, callbackslist, startingepoch, stream=stream, workers=workers, prefetch=prefetch, shufflebuffer=shufflebuffer, augment=augment, shard=shard)
+            else:
+                if min_delta != None:
+                    callbackslist.append(EarlyStopping(monitor=self.monitor, min_delta=min_delta, patience=patience))
+                if lrplateaufactor != None:
+                    callbackslist.append(ReduceLROnPlateau(monitor='acc', factor = lrplateaufactor, patience = lrplateaupatience))
+                fitmodel(self.model, X, Y, batch_size, epochs, self.outputclasses, callbackslist, startingepoch, validation_data, stream=stream, workers=workers, prefetch=prefetch, shufflebuffer=shufflebuffer, augment=augment, shard=shard)
+                if distributedtraining.ischief():
+                    checkpoints.saveearly(self.model)
+        finally:
+            metricsink.close()  # on_train_end never comes when fit raises, the queued events are written anyway
+            checkpoint.close()  # the last snapshot is on disk before StandardFit returns
         return self.model
         
 
-class ParametrisedCompatibility(Layer):
-
-    def __init__(self, kernel_regularizer=None, **kwargs):
-        super(ParametrisedCompatibility, self).__init__(**kwargs)
-        self.regularizer = kernel_regularizer
-
-    def build(self, input_shape):
-        self.u = self.add_weight(name='u', shape=(input_shape[0][3], 1), initializer='uniform', regularizer=self.regularizer, trainable=True)
-        super(ParametrisedCompatibility, self).build(input_shape)
-
-    def call(self, x):  # add l and g. Dot the sum with u.
-        return K.dot(K.map_fn(lambda lam: (lam[0]+lam[1]),elems=(x),dtype='float32'), self.u)
-
-    def compute_output_shape(self, input_shape):
-        return (input_shape[0][0], input_shape[0][1], input_shape[0][2])
-
-
-class LearningRateScaler(Callback):
-    
-    def __init__(self, epochs, multiplier, initial_lr=None):
-        self.multiplier = multiplier
-        self.epochs = epochs
-        self.initial_lr = initial_lr
-        self.startingepoch = True
-    
-    def on_train_begin(self, logs=None):
-        if self.initial_lr == None:
-            self.initial_lr = K.get_value(self.model.optimizer.lr)
-        print("Initial lr="+str(self.initial_lr))
-
-    def on_epoch_begin(self, epoch, logs=None):
-        if not hasattr(self.model.optimizer, 'lr'):
-            raise ValueError('Optimizer must have a "lr" attribute.')
-        print("Current lr: " + str(K.get_value(self.model.optimizer.lr)))
-        lr = self.initial_lr
-        if (epoch > 0 and epoch % self.epochs == 0) or self.startingepoch:
-            for i in range(0, epoch // self.epochs):
-                lr = lr * self.multiplier
-            K.set_value(self.model.optimizer.lr, lr)
-            print("Updated learning rate to "+str(lr))
-            self.startingepoch = False
-        elif isinstance(self.epochs, list):
-            if epoch>0 and epoch in self.epochs.sort():
-                for i in range(0, self.epochs.sort().index(epoch)+1):
-                    lr = lr * self.multiplier
-                K.set_value(self.model.optimizer.lr, lr)
-                print("Updated learning rate to "+str(lr))    
-        
-    
-    def on_epoch_end(self, epoch, logs=None):
-        startingepoch = False
-    
-        
-
-
-class Beeper(Callback):
-
-    def __init__(self, batches):
-        self.batches = batches
-    
-    def on_batch_end(self, batch, logs={}):
-        if batch > 0 and batch % self.batches == 0:
-            winsound.Beep(440,150)
+def activeheads(att):
+    return {'att': [3], 'att1': [3], 'att2': [2, 3]}.get(att, [1, 2, 3])
+
+
+def fitmodel(model, X, Y, batchsize, epochs, outputclasses, callbacks, initial_epoch, validation_data=None, stream=False, workers=4, prefetch=10, shufflebuffer=None, augment=None, shard=None):
+    # X can also be a keras Sequence yielding one-hot batches, which implies stream.
+    # augment (True for the default crop+flip Augmenter, or any batch transform) also implies stream,
+    # it runs inside the Sequence so the workers augment upcoming batches while the model trains.
+    import keras
+    from keras.utils import Sequence
+    from datapipeline import ArraySequence
+    from augmentation import Augmenter
+    if augment is True:
+        augment = Augmenter()
+    if augment is not None and isinstance(X, Sequence):
+        raise ValueError('augment needs array inputs, set the transform on the Sequence instead')
+    outputs = len(model.outputs)
+    replicate = None
+    if outputs > 1 and not isinstance(X, Sequence):  # a multi-head model gets one copy of the labels per classifier head
+        transform = augment
+        replicate = lambda x, y: (x, [y]*outputs)
+        augment = replicate if transform is None else (lambda x, y: replicate(*transform(x, y)))
+    # shard=(rank, workers) streams only this worker's share of the data.
+    if stream or augment is not None or shard is not None or isinstance(X, Sequence):
+        train = X if isinstance(X, Sequence) else ArraySequence(X, Y, batchsize, outputclasses, shufflebuffer=shufflebuffer, transform=augment, shard=shard)
+        validation = validation_data
+        if validation_data is not None and not isinstance(validation_data, Sequence):
+            validation = ArraySequence(validation_data[0], validation_data[1], batchsize, outputclasses, shuffle=False, transform=replicate, shard=shard)
+        return model.fit_generator(train, epochs=epochs, callbacks=callbacks, validation_data=validation, workers=workers, max_queue_size=prefetch, initial_epoch=initial_epoch, shuffle=False)
+    Y = keras.utils.to_categorical(Y, outputclasses)
+    if validation_data is not None:
+        validation_data = (validation_data[0], keras.utils.to_categorical(validation_data[1], outputclasses))
+    return model.fit(X, Y, batchsize, epochs, callbacks=callbacks, initial_epoch=initial_epoch, shuffle=True, validation_data=validation_data)
 
 
 if __name__ == "__main__":
@@ -1,36 +1,17 @@
-from LearnToPayAttention import AttentionVGG,AttentionRN,StandardVGG
-import numpy as np
-import scipy.io as sio
-from keras.datasets import cifar10
-from keras.datasets import cifar100
-  
-x10 = np.load("datasets/x10.npy")
-x10test = np.load("datasets/x10test.npy")
-x100 = np.load("datasets/x100.npy")
-x100test = np.load("datasets/x100test.npy")
-y10 = np.load("datasets/y10.npy")
-y10test = np.load("datasets/y10test.npy")
-y100 = np.load("datasets/y100.npy")
-y100test = np.load("datasets/y100test.npy")
-xsvhn = np.load("datasets/xsvhn.npy")  
-xsvhntest = np.load("datasets/xsvhntest.npy")  
-ysvhn = np.load("datasets/ysvhn.npy") - 1  
-ysvhntest = np.load("datasets/ysvhntest.npy") - 1  
-xcub = np.load("datasets/xcub.npy")
-xcubtest = np.load("datasets/xcubtest.npy")
-ycub = np.load("datasets/ycub.npy")
-ycubtest = np.load("datasets/ycubtest.npy")
+import experiments
 
-
-vggatt3concatpcCIFAR10 = AttentionVGG().StandardFit("cifar10",x10,y10,beep=True, min_delta=0.01, patience=3, validation_data=(x10test,y10test))
-vggatt3concatpcCIFAR100 = AttentionVGG(outputclasses=100).StandardFit("cifar100",x100,y100,beep=True, min_delta=0.01, patience=3, validation_data=(x100test,y100test))
-vggatt3concatpcSVHN = AttentionVGG().StandardFit("svhn",xsvhn,ysvhn,beep=True, min_delta=0.01, validation_data=(xsvhntest,ysvhntest), patience=7, lrplateaufactor=0.5, lrplateaupatience=3, initial_lr=0.0025)
-
-vggatt2concatpcCIFAR10 = AttentionVGG(att='att2').StandardFit("cifar10",x10,y10,beep=True, min_delta=0.01, patience=3, validation_data=(x10test,y10test))
-vggatt2concatpcCUB = AttentionVGG(att='att2', height=80, width=80, outputclasses=200).StandardFit("cub2002011",xcub,ycub,True,beep=True, min_delta=0.01, validation_data=(xcubtest,ycubtest))
-
-RNatt2concatpcCIFAR10 = AttentionRN().StandardFit("cifar10",x10,y10,beep=True, min_delta=0, validation_data=(x10test,y10test))
-RNatt2concatpcCIFAR100 = AttentionRN(outputclasses=100).StandardFit("cifar100",x100,y100,beep=True, min_delta=0, validation_data=(x100test,y100test))
-    
+# Every run of the original sequential script, as one grid. Runs go concurrently through experiments.run,
+# finished ones are skipped and interrupted ones resume from their checkpoints. The CUB run transfers from
+# the same architecture trained on cifar100, so that run is part of the grid and has to finish first.
+EARLYSTOP = {'beep': True, 'min_delta': 0.01, 'patience': 3}
+JOBS = [
+    {'model': 'vgg', 'att': ['att3', 'att2'], 'dataset': 'cifar10', 'fit_args': EARLYSTOP},
+    {'model': 'vgg', 'att': ['att3', 'att2'], 'dataset': 'cifar100', 'fit_args': EARLYSTOP},
+    {'model': 'vgg', 'att': 'att3', 'dataset': 'svhn', 'fit_args': {'beep': True, 'min_delta': 0.01, 'patience': 7, 'lrplateaufactor': 0.5, 'lrplateaupatience': 3, 'initial_lr': 0.0025}},
+    {'model': 'vgg', 'att': 'att2', 'dataset': 'cub2002011', 'model_args': {'height': 80, 'width': 80}, 'fit_args': {'transfer': True, 'beep': True, 'min_delta': 0.01}, 'after': '(VGG-att2)-concat-pc-cifar100'},
+    {'model': 'rn', 'att': 'att2', 'dataset': ['cifar10', 'cifar100'], 'fit_args': {'beep': True, 'min_delta': 0}},
+]
 
 
+if __name__ == "__main__":
+    experiments.run(JOBS)
@@ -0,0 +1,111 @@
+import tensorflow as tf
+import keras
+from keras import backend as K
+from keras.engine.topology import Layer
+
+# The attention layers of AttentionVGG and AttentionRN. Load saved models with custom_objects.
+
+
+class ParametrisedCompatibility(Layer):
+    # standalone pc scores, kept for models saved before AttentionPooling
+
+    def __init__(self, kernel_regularizer=None, **kwargs):
+        kwargs.pop('vectorized', None)  # in the configs of models saved while the map_fn form was still selectable
+        super(ParametrisedCompatibility, self).__init__(**kwargs)
+        self.regularizer = keras.regularizers.get(kernel_regularizer)
+
+    def build(self, input_shape):
+        self.u = self.add_weight(name='u', shape=(input_shape[0][3], 1), initializer='uniform', regularizer=self.regularizer, trainable=True)
+        super(ParametrisedCompatibility, self).build(input_shape)
+
+    def call(self, x):  # add l and g. Dot the sum with u.
+        return parametrisedcompatibility(x[0], x[1], self.u)
+
+    def compute_output_shape(self, input_shape):
+        return (input_shape[0][0], input_shape[0][1], input_shape[0][2])
+
+    def get_config(self):
+        config = {'kernel_regularizer': keras.regularizers.serialize(self.regularizer)}
+        base_config = super(ParametrisedCompatibility, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+class DotProductCompatibility(Layer):
+
+    def call(self, x):  # dot every local feature vector with g, whole batch at once
+        return dotproductcompatibility(x[0], x[1])
+
+    def compute_output_shape(self, input_shape):
+        return (input_shape[0][0], input_shape[0][1], input_shape[0][2])
+
+
+class AttentionPooling(Layer):
+    # compatibility, softmax over x*y and the attention-weighted sum of l in one layer: [l, g] -> g_a (and a)
+
+    def __init__(self, compatibilityfunction='pc', kernel_regularizer=None, return_attention=False, **kwargs):
+        super(AttentionPooling, self).__init__(**kwargs)
+        if compatibilityfunction not in ('pc', 'dp'):
+            raise ValueError('compatibilityfunction must be "pc" or "dp", got ' + str(compatibilityfunction))
+        self.compatibilityfunction = compatibilityfunction
+        self.regularizer = keras.regularizers.get(kernel_regularizer)
+        self.return_attention = return_attention
+
+    def build(self, input_shape):
+        if self.compatibilityfunction == 'pc':
+            self.u = self.add_weight(name='u', shape=(input_shape[0][3], 1), initializer='uniform', regularizer=self.regularizer, trainable=True)
+        super(AttentionPooling, self).build(input_shape)
+
+    def call(self, x):
+        l, g = x
+        if self.compatibilityfunction == 'pc':
+            c = parametrisedcompatibility(l, g, self.u)
+        else:
+            c = dotproductcompatibility(l, g)
+        c = K.batch_flatten(c)  # batch*xy
+        c = c - K.max(c, axis=-1, keepdims=True)  # stable softmax
+        a = K.exp(c)
+        a = a / K.sum(a, axis=-1, keepdims=True)
+        ga = tf.einsum('bn,bnc->bc', a, K.reshape(l, (K.shape(l)[0], -1, K.int_shape(l)[3])))  # batch*channel
+        if self.return_attention:
+            return [ga, a]
+        return ga
+
+    def compute_output_shape(self, input_shape):
+        ga_shape = (input_shape[0][0], input_shape[0][3])
+        if not self.return_attention:
+            return ga_shape
+        positions = None
+        if input_shape[0][1] is not None and input_shape[0][2] is not None:
+            positions = input_shape[0][1]*input_shape[0][2]
+        return [ga_shape, (input_shape[0][0], positions)]
+
+    def compute_mask(self, inputs, mask=None):
+        if self.return_attention:
+            return [None, None]
+        return None
+
+    def get_config(self):
+        config = {'compatibilityfunction': self.compatibilityfunction, 'kernel_regularizer': keras.regularizers.serialize(self.regularizer), 'return_attention': self.return_attention}
+        base_config = super(AttentionPooling, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
+def attentionname(compatibilityfunction, head):
+    # AttentionPooling layers keep the names of the compatibility layers they replaced (cpc1-3 holding u, cdp1-3),
+    # so weights saved before the fused layer, and by_name transfers from them, still find their u
+    return ('cdp' if compatibilityfunction == 'dp' else 'cpc')+str(head)
+
+
+def dotproductcompatibility(l, g):
+    return tf.einsum('bxyc,bc->bxy', l, g)  # batch*x*y
+
+
+def parametrisedcompatibility(l, g, u):
+    # (l+g).u == l.u + g.u, so g only has to be projected once per sample and broadcast over x*y
+    lu = K.squeeze(K.dot(l, u), -1)  # batch*x*y
+    gu = K.dot(g, u)  # batch*1
+    return lu + K.expand_dims(gu, 1)
+
+
+# pass to keras.models.load_model / model_from_json when restoring a saved attention model
+custom_objects = {'ParametrisedCompatibility': ParametrisedCompatibility, 'DotProductCompatibility': DotProductCompatibility, 'AttentionPooling': AttentionPooling}
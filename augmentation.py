@@ -0,0 +1,54 @@
+import numpy as np
+
+# Whole-batch augmentation with NumPy indexing, no per-image Python loop.
+# An Augmenter is passed as the transform of a datapipeline.ArraySequence, so it runs in
+# fit_generator's background workers while the model trains on the previous batches.
+
+
+def randomcrop(x, padding=4, random=np.random):
+    # zero-pad every image by padding pixels and take a random crop of the original size
+    n, h, w = x.shape[0], x.shape[1], x.shape[2]
+    padded = np.pad(x, ((0, 0), (padding, padding), (padding, padding), (0, 0)), mode='constant')
+    oy = random.randint(0, 2*padding+1, n)
+    ox = random.randint(0, 2*padding+1, n)
+    rows = (oy[:, None]+np.arange(h))[:, :, None]  # n*h*1
+    cols = (ox[:, None]+np.arange(w))[:, None, :]  # n*1*w
+    return padded[np.arange(n)[:, None, None], rows, cols]
+
+
+def horizontalflip(x, probability=0.5, random=np.random):
+    flip = random.rand(len(x)) < probability
+    x = x.copy()
+    x[flip] = x[flip, :, ::-1]
+    return x
+
+
+def cutout(x, size=8, random=np.random):
+    # zero one size*size square per image, centred anywhere (it may be clipped by the border)
+    n, h, w = x.shape[0], x.shape[1], x.shape[2]
+    cy = random.randint(0, h, n)[:, None]
+    cx = random.randint(0, w, n)[:, None]
+    dy = np.arange(h)[None, :]-(cy-size//2)  # n*h, offset from the top edge of the square
+    dx = np.arange(w)[None, :]-(cx-size//2)  # n*w
+    ys = (dy >= 0) & (dy < size)
+    xs = (dx >= 0) & (dx < size)
+    mask = ys[:, :, None] & xs[:, None, :]
+    return x*(~mask)[:, :, :, None].astype(x.dtype)
+
+
+class Augmenter:
+
+    def __init__(self, padding=4, flip=True, cutoutsize=None, seed=None):
+        self.padding = padding
+        self.flip = flip
+        self.cutoutsize = cutoutsize
+        self.random = np.random.RandomState(seed)
+
+    def __call__(self, x, y):
+        if self.padding:
+            x = randomcrop(x, self.padding, self.random)
+        if self.flip:
+            x = horizontalflip(x, 0.5, self.random)
+        if self.cutoutsize:
+            x = cutout(x, self.cutoutsize, self.random)
+        return x, y
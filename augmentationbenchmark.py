@@ -0,0 +1,32 @@
+import time
+import argparse
+import numpy as np
+from augmentation import Augmenter, randomcrop, horizontalflip, cutout
+
+# Images per second of the batch augmentation stage on CPU, per operation and for the full pipeline.
+
+def imagespersecond(function, x, repeats):
+    function(x)  # warm-up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function(x)
+    return repeats*len(x)/(time.perf_counter()-start)
+
+def run(batchsizes=(32, 128, 512), height=32, width=32, repeats=20, cutoutsize=8):
+    augmenter = Augmenter(4, True, cutoutsize)
+    stages = [('crop', lambda x: randomcrop(x, 4)), ('flip', horizontalflip), ('cutout', lambda x: cutout(x, cutoutsize)), ('all', lambda x: augmenter(x, None)[0])]
+    for batchsize in batchsizes:
+        x = np.random.rand(batchsize, height, width, 3).astype('float32')
+        rates = [(name, imagespersecond(function, x, repeats)) for name, function in stages]
+        print("batch %4d: " % batchsize + ", ".join("%s %9.0f img/s" % rate for rate in rates))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the batch augmentation stage")
+    parser.add_argument('--batchsizes', type=int, nargs='+', default=[32, 128, 512])
+    parser.add_argument('--height', type=int, default=32)
+    parser.add_argument('--width', type=int, default=32)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--cutout', type=int, default=8)
+    args = parser.parse_args()
+    run(args.batchsizes, args.height, args.width, args.repeats, args.cutout)
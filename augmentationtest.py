@@ -0,0 +1,56 @@
+import numpy as np
+from augmentation import randomcrop, horizontalflip, cutout, Augmenter
+
+
+def images(n=16, h=8, w=8, channels=3):
+    return np.arange(n*h*w*channels, dtype='float32').reshape(n, h, w, channels)+1  # no zeros, padding and cutout show up
+
+
+def test_randomcrop_is_a_shifted_window_of_the_padded_image():
+    x = images()
+    padding = 2
+    crops = randomcrop(x, padding, np.random.RandomState(0))
+    assert crops.shape == x.shape
+    padded = np.pad(x, ((0, 0), (padding, padding), (padding, padding), (0, 0)), mode='constant')
+    for image, crop in zip(padded, crops):
+        windows = [(oy, ox) for oy in range(2*padding+1) for ox in range(2*padding+1)
+                   if np.array_equal(image[oy:oy+x.shape[1], ox:ox+x.shape[2]], crop)]
+        assert windows
+
+
+def test_randomcrop_without_padding_is_the_identity():
+    x = images()
+    assert np.array_equal(randomcrop(x, 0), x)
+
+
+def test_horizontalflip_mirrors_some_images_and_keeps_the_rest():
+    x = images(64)
+    flipped = horizontalflip(x, 0.5, np.random.RandomState(0))
+    mirrored = np.array([np.array_equal(f, i[:, ::-1]) for f, i in zip(flipped, x)])
+    unchanged = np.array([np.array_equal(f, i) for f, i in zip(flipped, x)])
+    assert np.all(mirrored | unchanged)
+    assert mirrored.any() and unchanged.any()
+    assert np.array_equal(horizontalflip(x, 1.0), x[:, :, ::-1])
+    assert np.array_equal(horizontalflip(x, 0.0), x)
+
+
+def test_cutout_zeroes_one_clipped_square_per_image():
+    x = images(32)
+    size = 4
+    out = cutout(x, size, np.random.RandomState(0))
+    for image, masked in zip(x, out):
+        zero = np.all(masked == 0, axis=-1)
+        assert np.array_equal(masked[~zero], image[~zero])
+        rows, cols = np.nonzero(zero)
+        assert 0 < len(rows) <= size*size
+        assert len(rows) == (rows.max()-rows.min()+1)*(cols.max()-cols.min()+1)  # a rectangle
+        assert rows.max()-rows.min() < size and cols.max()-cols.min() < size
+
+
+def test_augmenter_is_reproducible_and_keeps_labels():
+    x, y = images(), np.arange(16)
+    first, labels = Augmenter(cutoutsize=4, seed=1)(x, y)
+    second, _ = Augmenter(cutoutsize=4, seed=1)(x, y)
+    assert first.shape == x.shape
+    assert labels is y
+    assert np.array_equal(first, second)
@@ -0,0 +1,176 @@
+import os
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')  # CPU numbers
+import sys
+import json
+import time
+import argparse
+import platform
+import itertools
+import multiprocessing
+
+# Benchmark suite for AttentionVGG / AttentionRN on synthetic data. Every configuration runs in its own
+# spawned process (so peak memory is per configuration) and reports:
+#   build_s       constructing the model graph
+#   compile_s     compiling and running the first training step (creates the training function)
+#   step_s        median training step at --batch
+#   latency_s     median inference latency at batch 1
+#   throughput    inference samples/s at --largebatch
+#   peak_rss_mb   peak resident memory of the process
+# Results are written as JSON. With --baseline they are compared against a stored run, and any timing
+# or memory metric worse than the baseline by more than --tolerance fails the run (exit code 1).
+#
+# Timings only compare on the same hardware, so there is no baseline in the repository: record one on the machine
+# the comparisons will run on (the CI runner, or your workstation before a change) and keep it there:
+#     python benchmarks.py --quick --write-baseline baseline.json
+#     python benchmarks.py --quick --baseline baseline.json
+# A baseline holds the results and the machine that produced them (CPU model, cores, platform, Python, TensorFlow
+# and Keras versions); comparing against one from a different machine warns that the numbers do not carry over.
+
+TIMINGS = ['build_s', 'compile_s', 'step_s', 'latency_s', 'peak_rss_mb']  # lower is better
+RATES = ['throughput']  # higher is better
+
+
+def configurations(quick=False):
+    configs = []
+    for model, att, gmode, cf, size in itertools.product(['vgg', 'rn'], ['att1', 'att2', 'att3'], ['concat', 'indep'], ['pc', 'dp'], [32, 80]):
+        for batchnorm in ([True, False] if model == 'vgg' else [True]):
+            configs.append({'model': model, 'att': att, 'gmode': gmode, 'compatibilityfunction': cf, 'batchnorm': batchnorm, 'size': size})
+    if quick:  # one representative per model and input size
+        configs = [c for c in configs if c['att'] == 'att3' and c['gmode'] == 'concat' and c['compatibilityfunction'] == 'pc' and c['batchnorm']]
+    return configs
+
+
+def configname(config):
+    return "-".join([config['model'], config['att'], config['gmode'], config['compatibilityfunction'], 'bn' if config['batchnorm'] else 'nobn', str(config['size'])])
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values)//2]
+
+
+def measure(config, batch, largebatch, repeats):
+    import resource
+    import numpy as np
+    from LearnToPayAttention import AttentionVGG, AttentionRN
+
+    options = dict(att=config['att'], gmode=config['gmode'], compatibilityfunction=config['compatibilityfunction'], height=config['size'], width=config['size'], outputclasses=10)
+    start = time.perf_counter()
+    if config['model'] == 'vgg':
+        net = AttentionVGG(batchnorm=config['batchnorm'], compileonbuild=False, **options)
+    else:
+        net = AttentionRN(compileonbuild=False, **options)
+    model = net.model  # the graph is built on first use
+    build = time.perf_counter()-start
+
+    x = np.random.rand(largebatch, config['size'], config['size'], 3).astype('float32')
+    y = np.eye(10)[np.random.randint(0, 10, largebatch)]
+    start = time.perf_counter()
+    net.compile()
+    model.train_on_batch(x[:batch], y[:batch])
+    compile = time.perf_counter()-start
+
+    steps = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model.train_on_batch(x[:batch], y[:batch])
+        steps.append(time.perf_counter()-start)
+
+    model.predict_on_batch(x[:1])
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model.predict_on_batch(x[:1])
+        latencies.append(time.perf_counter()-start)
+
+    model.predict(x, batch_size=largebatch)
+    start = time.perf_counter()
+    for _ in range(max(1, repeats//5)):
+        model.predict(x, batch_size=largebatch)
+    throughput = max(1, repeats//5)*largebatch/(time.perf_counter()-start)
+
+    return {'build_s': build, 'compile_s': compile, 'step_s': median(steps), 'latency_s': median(latencies), 'throughput': throughput,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0, 'params': model.count_params()}
+
+
+def run(configs, batch=32, largebatch=256, repeats=10):
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for config in configs:
+        name = configname(config)
+        pool = context.Pool(1)
+        try:
+            results[name] = dict(config, **pool.apply(measure, (config, batch, largebatch, repeats)))
+            print("%-40s build %6.2fs  step %7.1fms  latency %6.1fms  %8.1f samples/s  %7.0f MB" % (name, results[name]['build_s'], results[name]['step_s']*1000, results[name]['latency_s']*1000, results[name]['throughput'], results[name]['peak_rss_mb']))
+        except Exception as e:
+            results[name] = dict(config, error=repr(e))
+            print("%-40s failed: %r" % (name, e))
+        finally:
+            pool.close()
+            pool.join()
+    return results
+
+
+def machine():
+    # the hardware and software a baseline was recorded with
+    import keras
+    import tensorflow as tf
+    processor = platform.processor()
+    try:
+        with open('/proc/cpuinfo') as f:
+            processor = next((line.split(':', 1)[1].strip() for line in f if line.startswith('model name')), processor)
+    except (IOError, OSError):
+        pass
+    return {'processor': processor, 'cores': os.cpu_count(), 'platform': platform.platform(), 'python': platform.python_version(),
+            'tensorflow': tf.__version__, 'keras': keras.__version__}
+
+
+def compare(results, baseline, tolerance=0.1):
+    # returns a list of human-readable regressions
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline or 'error' in result or 'error' in baseline[name]:
+            continue
+        for metric in TIMINGS:
+            if result[metric] > baseline[name][metric]*(1+tolerance):
+                regressions.append("%s %s: %.4g -> %.4g (+%.0f%%)" % (name, metric, baseline[name][metric], result[metric], 100*(result[metric]/baseline[name][metric]-1)))
+        for metric in RATES:
+            if result[metric] < baseline[name][metric]*(1-tolerance):
+                regressions.append("%s %s: %.4g -> %.4g (%.0f%%)" % (name, metric, baseline[name][metric], result[metric], 100*(result[metric]/baseline[name][metric]-1)))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark attention model construction, training and inference on CPU")
+    parser.add_argument('--quick', action='store_true', help="only att3-concat-pc with batchnorm per model and input size")
+    parser.add_argument('--filter', default=None, help="only configurations whose name contains this")
+    parser.add_argument('--batch', type=int, default=32)
+    parser.add_argument('--largebatch', type=int, default=256)
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--out', default="benchmarks.json")
+    parser.add_argument('--baseline', default=None, help="JSON of a previous run to compare against")
+    parser.add_argument('--write-baseline', dest='writebaseline', default=None, help="also store this run, with the machine it ran on, as a baseline")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="allowed relative slowdown before a metric counts as a regression")
+    args = parser.parse_args()
+
+    configs = [c for c in configurations(args.quick) if args.filter is None or args.filter in configname(c)]
+    results = run(configs, args.batch, args.largebatch, args.repeats)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+    if args.writebaseline:
+        with open(args.writebaseline, 'w') as f:
+            json.dump({'machine': machine(), 'results': results}, f, indent=1, sort_keys=True)
+        print("Baseline written to "+args.writebaseline)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if 'machine' not in baseline:  # a plain --out file
+            baseline = {'machine': None, 'results': baseline}
+        if baseline['machine'] != machine():
+            print("WARNING: %s was recorded on %s, this is %s; the timings do not compare" % (args.baseline, baseline['machine'] or 'an unknown machine', machine()))
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for regression in regressions:
+            print("REGRESSION "+regression)
+        if regressions:
+            sys.exit(1)
+        print("No regressions against "+args.baseline)
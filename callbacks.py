@@ -0,0 +1,66 @@
+import sys
+import threading
+from keras import backend as K
+from keras.callbacks import Callback
+
+# Training callbacks shared by the StandardFit methods.
+
+
+class LearningRateScaler(Callback):
+    # multiplies the lr by multiplier every `epochs` epochs, or at each epoch listed when epochs is a list.
+    # scale multiplies initial_lr, e.g. by the number of workers for linear scaling in data-parallel training.
+    # The current lr is added to the epoch logs, so MetricsSink and TensorBoard record it.
+    
+    def __init__(self, epochs, multiplier, initial_lr=None, scale=1):
+        self.multiplier = multiplier
+        self.epochs = epochs
+        self.initial_lr = initial_lr
+        self.scale = scale
+        self.startingepoch = True
+    
+    def on_train_begin(self, logs=None):
+        if self.initial_lr == None:
+            self.initial_lr = K.get_value(self.model.optimizer.lr)
+        self.initial_lr = self.initial_lr*self.scale
+        self.scale = 1
+
+    def on_epoch_begin(self, epoch, logs=None):
+        if not hasattr(self.model.optimizer, 'lr'):
+            raise ValueError('Optimizer must have a "lr" attribute.')
+        if isinstance(self.epochs, list):
+            steps = len([e for e in self.epochs if e <= epoch])
+            boundary = epoch in self.epochs
+        else:
+            steps = epoch // self.epochs
+            boundary = epoch > 0 and epoch % self.epochs == 0
+        if boundary or self.startingepoch:  # in between, leave any ReduceLROnPlateau changes alone
+            K.set_value(self.model.optimizer.lr, self.initial_lr*self.multiplier**steps)
+            self.startingepoch = False
+    
+    def on_epoch_end(self, epoch, logs=None):
+        if logs is not None:
+            logs['lr'] = float(K.get_value(self.model.optimizer.lr))
+
+
+class Beeper(Callback):
+    # audible progress signal every `batches` batches. The sound plays on its own thread so training never
+    # waits for it; winsound is only imported (and only exists) on Windows, elsewhere the terminal bell rings.
+
+    def __init__(self, batches):
+        self.batches = batches
+        self.playing = None
+    
+    def on_batch_end(self, batch, logs=None):
+        if batch > 0 and batch % self.batches == 0 and not (self.playing and self.playing.is_alive()):
+            self.playing = threading.Thread(target=beep)
+            self.playing.daemon = True
+            self.playing.start()
+
+
+def beep():
+    try:
+        import winsound
+        winsound.Beep(440, 150)
+    except ImportError:
+        sys.stdout.write('\a')
+        sys.stdout.flush()
@@ -0,0 +1,208 @@
+import os
+import json
+import threading
+import h5py
+import keras
+from keras import backend as K
+from keras.callbacks import Callback
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+# Per model-and-dataset checkpoint index. "weights/<key>.json" records which epoch files exist, the latest
+# and the best epoch, so resuming is a single small read instead of listing and string-parsing the whole
+# weights directory. Weight files keep the "<key> <epoch>.hdf5" / "<key> early.hdf5" names.
+
+
+def atomicwrite(path, write):
+    # write(tmp) produces the file, it only replaces path once complete
+    root, extension = os.path.splitext(path)
+    tmp = root+".tmp"+str(os.getpid())+extension  # per process, so concurrent writers never share it; keeps the extension for keras
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    write(tmp)
+    os.replace(tmp, path)
+
+
+class CheckpointManager:
+
+    def __init__(self, directory, key, keep_last=3, keep_best=True, monitor=None):
+        self.directory = directory
+        self.key = key
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.monitor = monitor  # defaults to val_acc when present in the epoch logs, otherwise acc
+        self.manifestpath = os.path.join(directory, key+".json")
+        if os.path.isfile(self.manifestpath):
+            with open(self.manifestpath) as f:
+                self.manifest = json.load(f)
+        else:  # written on the first record/saveearly, reading a source key never writes
+            self.manifest = self.scan()
+
+    def scan(self):
+        # one-off migration for weights saved before the manifest existed
+        manifest = {'key': self.key, 'epochs': {}, 'best': None, 'early': None}
+        prefix = self.key+" "
+        for filename in (os.listdir(self.directory) if os.path.isdir(self.directory) else []):
+            if not filename.startswith(prefix) or not filename.endswith(".hdf5"):
+                continue
+            tag = filename[len(prefix):-len(".hdf5")]
+            if tag == "early":
+                manifest['early'] = filename
+            elif tag.isdigit():
+                manifest['epochs'][tag] = {'file': filename}
+        return manifest
+
+    def writemanifest(self):
+        def write(tmp):
+            with open(tmp, 'w') as f:
+                json.dump(self.manifest, f, indent=1, sort_keys=True)
+        atomicwrite(self.manifestpath, write)
+
+    def path(self, epoch):
+        if epoch is None:
+            raise ValueError('no epoch weights for '+self.key+' in '+self.directory)
+        return os.path.join(self.directory, self.key+" "+str(epoch)+".hdf5")
+
+    def latest(self):
+        epochs = [int(epoch) for epoch in self.manifest['epochs']]
+        return max(epochs) if epochs else None
+
+    def early(self):
+        early = self.manifest['early']
+        if early is None:
+            return None
+        return os.path.join(self.directory, early)
+
+    def trained(self):
+        # the weights to load a trained model from: early-stopped, otherwise the latest epoch
+        if self.early() is None and self.latest() is None:
+            raise ValueError('no weights for '+self.key+' in '+self.directory)
+        return self.early() or self.path(self.latest())
+
+    def save(self, model, epoch, logs=None):
+        self.record(epoch, lambda tmp: model.save_weights(tmp), logs)
+
+    def record(self, epoch, write, logs=None):
+        # write(tmp) saves the weights of epoch (1-based, like the file names)
+        logs = logs or {}
+        atomicwrite(self.path(epoch), write)
+        entry = {'file': os.path.basename(self.path(epoch))}
+        monitor = self.monitor or ('val_acc' if 'val_acc' in logs else 'acc')
+        if monitor in logs:
+            entry[monitor] = float(logs[monitor])
+            best = self.manifest['best']
+            if best is None or best['monitor'] != monitor or entry[monitor] > best['value']:
+                self.manifest['best'] = {'epoch': epoch, 'monitor': monitor, 'value': entry[monitor]}
+        self.manifest['epochs'][str(epoch)] = entry
+        self.retain()
+
+    def retain(self):
+        # the manifest stops listing the dropped epochs before their files go, so an interrupted retain leaves
+        # unlisted files behind rather than a manifest pointing at deleted ones
+        epochs = sorted(int(epoch) for epoch in self.manifest['epochs'])
+        keep = set(epochs[-self.keep_last:]) if self.keep_last else set(epochs)
+        if self.keep_best and self.manifest['best'] is not None:
+            keep.add(self.manifest['best']['epoch'])
+        dropped = [self.manifest['epochs'].pop(str(epoch))['file'] for epoch in epochs if epoch not in keep]
+        self.writemanifest()
+        for filename in dropped:
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except OSError:
+                pass
+
+    def saveearly(self, model):
+        path = os.path.join(self.directory, self.key+" early.hdf5")
+        atomicwrite(path, lambda tmp: model.save_weights(tmp))
+        self.manifest['early'] = os.path.basename(path)
+        self.writemanifest()
+
+
+def snapshot(model):
+    # copies every weight to host memory in one session call: [(layer name, weight names, values)]
+    layers = [layer for layer in model.layers if layer.weights]
+    values = K.batch_get_value([w for layer in layers for w in layer.weights])
+    result = []
+    for layer in layers:
+        result.append((layer.name, [w.name for w in layer.weights], values[:len(layer.weights)]))
+        values = values[len(layer.weights):]
+    return result
+
+
+def writesnapshot(path, layers):
+    # same layout as model.save_weights, so model.load_weights reads it back
+    with h5py.File(path, 'w') as f:
+        f.attrs['layer_names'] = [name.encode('utf8') for name, _, _ in layers]
+        f.attrs['backend'] = K.backend().encode('utf8')
+        f.attrs['keras_version'] = str(keras.__version__).encode('utf8')
+        for name, weightnames, values in layers:
+            g = f.create_group(name)
+            g.attrs['weight_names'] = [weightname.encode('utf8') for weightname in weightnames]
+            for weightname, value in zip(weightnames, values):
+                dataset = g.create_dataset(weightname, value.shape, dtype=value.dtype)
+                if not value.shape:
+                    dataset[()] = value
+                else:
+                    dataset[:] = value
+
+
+class AsyncCheckpoint(Callback):
+    # Replaces ModelCheckpoint("weights/<key> {epoch}.hdf5", save_weights_only=True) with a manager. The training
+    # thread only snapshots the weights into memory, a background thread writes the file and updates the manifest. At most queuesize snapshots wait to be written (the
+    # training thread blocks beyond that), period saves every n-th epoch, and the last epoch is always saved
+    # and flushed in on_train_end.
+
+    def __init__(self, manager, period=1, queuesize=2):
+        super(AsyncCheckpoint, self).__init__()
+        self.manager = manager
+        self.period = period
+        self.queue = queue.Queue(maxsize=queuesize)
+        self.error = None
+        self.lastsaved = None
+        self.lastepoch = None
+        self.thread = threading.Thread(target=self.write, name='AsyncCheckpoint')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                epoch, layers, logs = item
+                self.manager.record(epoch, lambda tmp: writesnapshot(tmp, layers), logs)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def enqueue(self, epoch, logs):
+        self.queue.put((epoch, snapshot(self.model), dict(logs or {})))
+        self.lastsaved = epoch
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.lastepoch = (epoch+1, dict(logs or {}))
+        if (epoch+1) % self.period == 0:
+            self.enqueue(epoch+1, logs)
+
+    def on_train_end(self, logs=None):
+        if self.lastepoch is not None and self.lastsaved != self.lastepoch[0]:
+            self.enqueue(*self.lastepoch)
+        self.flush()
+
+    def flush(self):
+        self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,75 @@
+import os
+import json
+import pytest
+pytest.importorskip('keras')
+from checkpoints import CheckpointManager
+
+# CheckpointManager's retention and manifest, with text files standing in for the weights.
+
+
+def write(text):
+    def writer(tmp):
+        with open(tmp, 'w') as f:
+            f.write(text)
+    return writer
+
+
+def files(directory):
+    return sorted(filename for filename in os.listdir(directory) if filename.endswith('.hdf5'))
+
+
+def test_keeps_the_last_and_the_best_epochs(tmp_path):
+    directory = str(tmp_path)
+    manager = CheckpointManager(directory, 'net', keep_last=2)
+    for epoch, acc in enumerate([0.5, 0.9, 0.6, 0.7, 0.8], 1):
+        manager.record(epoch, write(str(epoch)), {'acc': acc})
+    assert files(directory) == ['net 2.hdf5', 'net 4.hdf5', 'net 5.hdf5']
+    assert manager.latest() == 5
+    assert manager.manifest['best'] == {'epoch': 2, 'monitor': 'acc', 'value': 0.9}
+    with open(os.path.join(directory, 'net.json')) as f:
+        assert sorted(json.load(f)['epochs']) == ['2', '4', '5']
+
+
+def test_manifest_is_written_before_files_are_removed(tmp_path, monkeypatch):
+    directory = str(tmp_path)
+    manager = CheckpointManager(directory, 'net', keep_last=1, keep_best=False)
+    manager.record(1, write('1'))
+    listed = []
+    remove = os.remove
+    def recordingremove(path):
+        with open(os.path.join(directory, 'net.json')) as f:
+            listed.append(sorted(json.load(f)['epochs']))
+        remove(path)
+    monkeypatch.setattr(os, 'remove', recordingremove)
+    manager.record(2, write('2'))
+    assert listed == [['2']]
+    assert files(directory) == ['net 2.hdf5']
+
+
+def test_reloads_the_manifest(tmp_path):
+    directory = str(tmp_path)
+    manager = CheckpointManager(directory, 'net')
+    manager.record(1, write('1'), {'val_acc': 0.3, 'acc': 0.5})
+    reloaded = CheckpointManager(directory, 'net')
+    assert reloaded.latest() == 1
+    assert reloaded.manifest['best']['monitor'] == 'val_acc'
+    assert reloaded.trained() == reloaded.path(1)
+
+
+def test_scans_weights_saved_without_a_manifest(tmp_path):
+    directory = str(tmp_path)
+    for filename in ('net 3.hdf5', 'net 7.hdf5', 'net early.hdf5', 'other 9.hdf5'):
+        write('')(os.path.join(directory, filename))
+    manager = CheckpointManager(directory, 'net')
+    assert manager.latest() == 7
+    assert manager.early() == os.path.join(directory, 'net early.hdf5')
+    assert not os.path.exists(os.path.join(directory, 'net.json'))  # reading never writes
+
+
+def test_missing_weights(tmp_path):
+    manager = CheckpointManager(str(tmp_path/'absent'), 'net')
+    assert manager.latest() is None and manager.early() is None
+    with pytest.raises(ValueError):
+        manager.trained()
+    with pytest.raises(ValueError):
+        manager.path(None)
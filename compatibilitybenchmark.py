@@ -0,0 +1,58 @@
+import os
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')  # keep the benchmark on CPU
+import time
+import argparse
+import numpy as np
+from keras import backend as K
+from keras.models import Model
+from keras.layers import Input
+from attentionlayers import ParametrisedCompatibility
+
+# CPU microbenchmark: per-sample map_fn ParametrisedCompatibility vs the broadcast l.u + g.u version.
+# Shapes default to the first VGG attention head (32x32 local features, 512 channels).
+# The map_fn baseline only lives here, the models score with the broadcast form (parametrisedcompatibility).
+
+class MapFnCompatibility(ParametrisedCompatibility):
+    # the original per-sample form: add l and g with map_fn, dot the sum with u
+
+    def call(self, x):
+        return K.dot(K.map_fn(lambda lam: (lam[0]+lam[1]),elems=(x),dtype=K.dtype(x[0])), self.u)
+
+def buildcompatibility(height, width, channels, vectorized):
+    l = Input(shape=(height, width, channels))
+    g = Input(shape=(channels,))
+    c = (ParametrisedCompatibility if vectorized else MapFnCompatibility)(name='cpc')([l, g])
+    return Model(inputs=[l, g], outputs=c)
+
+def throughput(model, l, g, batchsize, repeats):
+    model.predict([l, g], batch_size=batchsize)  # warm-up, builds the predict function
+    start = time.perf_counter()
+    for _ in range(repeats):
+        model.predict([l, g], batch_size=batchsize)
+    return repeats*len(l)/(time.perf_counter()-start)
+
+def run(batchsizes=(1, 32, 128), height=32, width=32, channels=512, repeats=5):
+    legacy = buildcompatibility(height, width, channels, False)
+    vectorized = buildcompatibility(height, width, channels, True)
+    vectorized.set_weights(legacy.get_weights())
+    results = []
+    for batchsize in batchsizes:
+        l = np.random.rand(batchsize, height, width, channels).astype('float32')
+        g = np.random.rand(batchsize, channels).astype('float32')
+        maxdiff = np.abs(legacy.predict([l, g]).reshape(batchsize, -1) - vectorized.predict([l, g]).reshape(batchsize, -1)).max()
+        old = throughput(legacy, l, g, batchsize, repeats)
+        new = throughput(vectorized, l, g, batchsize, repeats)
+        results.append((batchsize, old, new))
+        print("batch %4d: map_fn %10.1f samples/s, vectorized %10.1f samples/s, speedup %5.2fx, max abs diff %.2e" % (batchsize, old, new, new/old, maxdiff))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark ParametrisedCompatibility on CPU")
+    parser.add_argument('--batchsizes', type=int, nargs='+', default=[1, 32, 128])
+    parser.add_argument('--height', type=int, default=32)
+    parser.add_argument('--width', type=int, default=32)
+    parser.add_argument('--channels', type=int, default=512)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+    run(args.batchsizes, args.height, args.width, args.channels, args.repeats)
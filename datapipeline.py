@@ -0,0 +1,54 @@
+import numpy as np
+import keras
+from keras import backend as K
+from keras.utils import Sequence
+
+
+class ArraySequence(Sequence):
+    # Streams (X, Y) batch by batch so X can be a memory-mapped array: only the rows of the
+    # current batches are ever read. Labels are one-hot encoded per batch. X can also be a list of arrays
+    # for a multi-input model (e.g. cached features), all indexed by the same rows.
+    # Run it through fit_generator with workers>1 to map batches in parallel, max_queue_size is the prefetch depth.
+
+    def __init__(self, X, Y, batch_size=128, outputclasses=None, shuffle=True, shufflebuffer=None, transform=None, shard=None, seed=None):
+        self.X = X
+        self.Y = Y
+        self.batch_size = batch_size
+        self.outputclasses = outputclasses
+        self.shuffle = shuffle
+        self.shufflebuffer = shufflebuffer  # None shuffles the whole epoch, otherwise only within windows of this many samples
+        self.transform = transform  # applied to every (x, y) batch before it is returned
+        self.random = np.random.RandomState(seed)
+        self.indices = np.arange(len(Y))
+        if shard is not None:  # (index, count): every count-th sample starting at index, the same number on every shard
+            self.indices = self.indices[shard[0]::shard[1]][:len(Y)//shard[1]]  # so every worker runs as many steps
+        self.order = self.indices
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(np.ceil(len(self.indices)/float(self.batch_size)))
+
+    def batchindices(self, i):
+        return np.sort(self.order[i*self.batch_size:(i+1)*self.batch_size])  # sorted rows read sequentially from a memmap
+
+    def __getitem__(self, i):
+        idx = self.batchindices(i)
+        if isinstance(self.X, (list, tuple)):
+            x = [np.asarray(X[idx], dtype=K.floatx()) for X in self.X]
+        else:
+            x = np.asarray(self.X[idx], dtype=K.floatx())
+        y = np.asarray(self.Y[idx])
+        if self.outputclasses is not None:
+            y = keras.utils.to_categorical(y, self.outputclasses)
+        if self.transform is not None:
+            x, y = self.transform(x, y)
+        return x, y
+
+    def on_epoch_end(self):
+        if not self.shuffle:
+            return
+        if self.shufflebuffer is None or self.shufflebuffer >= len(self.indices):
+            self.order = self.random.permutation(self.indices)
+            return
+        windows = [self.random.permutation(self.indices[i:i+self.shufflebuffer]) for i in range(0, len(self.indices), self.shufflebuffer)]
+        self.order = np.concatenate([windows[w] for w in self.random.permutation(len(windows))])
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+pytest.importorskip('keras')
+from datapipeline import ArraySequence
+
+
+def shards(n, count, batch_size=8, **kwargs):
+    X = np.arange(n, dtype='float32').reshape(n, 1)
+    Y = np.arange(n) % 10
+    return [ArraySequence(X, Y, batch_size, 10, shard=(rank, count), seed=rank, **kwargs) for rank in range(count)]
+
+
+def rows(sequence):
+    return np.concatenate([sequence[i][0][:, 0] for i in range(len(sequence))]).astype(int)
+
+
+@pytest.mark.parametrize('n', [64, 100, 103])
+@pytest.mark.parametrize('count', [1, 3, 4, 8])
+def test_shards_are_equal_and_disjoint(n, count):
+    sequences = shards(n, count)
+    assert len(set(len(s) for s in sequences)) == 1  # every rank runs the same number of steps
+    assert len(set(len(s.indices) for s in sequences)) == 1
+    seen = [rows(s) for s in sequences]
+    everything = np.concatenate(seen)
+    assert len(everything) == len(np.unique(everything))
+    assert len(everything) == n//count*count
+
+
+def test_shards_stay_disjoint_across_epochs():
+    sequences = shards(100, 4, shufflebuffer=16)
+    first = [set(rows(s)) for s in sequences]
+    for s in sequences:
+        s.on_epoch_end()
+    assert [set(rows(s)) for s in sequences] == first  # shuffling only reorders within a shard
+
+
+def test_labels_follow_their_rows():
+    X = np.arange(50, dtype='float32').reshape(50, 1)
+    Y = np.arange(50) % 10
+    sequence = ArraySequence(X, Y, 16, 10, seed=0)
+    for i in range(len(sequence)):
+        x, y = sequence[i]
+        assert np.array_equal(np.argmax(y, axis=1), x[:, 0].astype(int) % 10)
@@ -0,0 +1,65 @@
+import os
+import numpy as np
+from numpy.lib.format import open_memmap
+
+# name: (x, y, xtest, ytest, label offset) as saved by normalizeDatasets.py / cubdivide.py
+DATASETS = {
+    'cifar10': ('x10', 'y10', 'x10test', 'y10test', 0),
+    'cifar100': ('x100', 'y100', 'x100test', 'y100test', 0),
+    'svhn': ('xsvhn', 'ysvhn', 'xsvhntest', 'ysvhntest', 1),  # svhn labels are 1..10
+    'cub2002011': ('xcub', 'ycub', 'xcubtest', 'ycubtest', 1),  # CUB class ids are 1..200
+}
+
+
+class Dataset:
+    # Lazy train/test views of one dataset. Images are opened memory-mapped, nothing is read until
+    # the arrays are indexed, and no file is touched until train or test is first accessed.
+
+    def __init__(self, name, directory="datasets"):
+        if name not in DATASETS:
+            raise ValueError("Unknown dataset "+name+", expected one of "+", ".join(sorted(DATASETS)))
+        self.name = name
+        self.directory = directory
+        self._train = None
+        self._test = None
+
+    def _load(self, xfile, yfile):
+        x = np.load(os.path.join(self.directory, xfile+".npy"), mmap_mode='r')
+        y = np.load(os.path.join(self.directory, yfile+".npy"))  # labels are small, keep them in memory
+        offset = DATASETS[self.name][4]
+        if offset:
+            y = y - offset
+        return (x, y)
+
+    @property
+    def train(self):
+        if self._train is None:
+            self._train = self._load(DATASETS[self.name][0], DATASETS[self.name][1])
+        return self._train
+
+    @property
+    def test(self):
+        if self._test is None:
+            self._test = self._load(DATASETS[self.name][2], DATASETS[self.name][3])
+        return self._test
+
+
+def load(name, directory="datasets"):
+    return Dataset(name, directory)
+
+
+def save(path, x, dtype=None, chunksize=4096):
+    # Writes x to a .npy file chunk by chunk, converting to dtype (uint8 for raw images,
+    # float16 for normalized ones) without materializing a full converted copy.
+    dtype = np.dtype(dtype or x.dtype)
+    if not path.endswith(".npy"):
+        path = path+".npy"
+    out = open_memmap(path, mode='w+', dtype=dtype, shape=x.shape)
+    for i in range(0, len(x), chunksize):
+        chunk = x[i:i+chunksize]
+        if dtype == np.uint8:
+            chunk = np.clip(np.rint(chunk), 0, 255)
+        out[i:i+chunksize] = chunk
+    out.flush()
+    del out
+    return path
@@ -0,0 +1,174 @@
+import os
+import argparse
+import numpy as np
+from datapipeline import ArraySequence
+from modelcli import addmodelarguments, buildmodel
+
+# Knowledge distillation into a smaller AttentionRN (fewer bottleneck blocks, narrower filters). The teacher, any
+# trained AttentionVGG or AttentionRN, runs once over the data: its probabilities and attention maps go to a
+# FeatureCache under teachers/, keyed by a hash of its weights, and the student trains against the memmaps without
+# the teacher ever running again. The loss is the usual KD loss, (1-alpha)*CE(labels) + alpha*T^2*CE(teacher at T),
+# plus attention transfer: squared distance between the L2-normalised attention maps of the two, for each head the
+# student's classifier reads (a3 for att1, a2 and a3 for att2, all three for att3). The teacher must read them too,
+# the maps of a head outside its classifier were never trained.
+#
+#     python distillation.py --model rn --weights "weights/(RN-att3)-concat-pc-cifar10 early.hdf5" --dataset cifar10 --blocks 3 --widthmultiplier 0.5
+
+
+def teacheroutputs(teacher, X, split, datasetname, directory='teachers', batch_size=128):
+    # [probabilities, maps of teacher.activeheads()] of the teacher for X as memmaps, computed on the first call only.
+    # Probabilities stay float32: softened at a high temperature, float16 would round the small ones to zero.
+    from featurecache import FeatureCache, weightshash
+    names = ['probabilities']+['attention'+str(head) for head in teacher.activeheads()]
+    dtypes = dict((name, 'float16') for name in names)
+    dtypes['probabilities'] = 'float32'
+    cache = FeatureCache(directory, teacher.name+"-"+datasetname, weightshash(teacher.model), dtypes, names)
+    return cache.extract(teacher.attentionmodel(), X, split, batch_size)
+
+
+def transferred(outputs, teacher, heads):
+    # [probabilities, maps of heads] out of teacheroutputs, which hold the maps of teacher.activeheads()
+    return [outputs[0]]+[outputs[1+teacher.activeheads().index(head)] for head in heads]
+
+
+class DistillationSequence(ArraySequence):
+    # (images, targets) batches where the targets of the prediction are the one-hot labels and the teacher
+    # probabilities side by side, followed by the teacher attention maps when maps is set. The teacher outputs
+    # are read by the same rows as X. No augmentation: the cached teacher outputs are for the unaugmented images.
+
+    def __init__(self, X, Y, teacher, batch_size=128, outputclasses=None, maps=True, **kwargs):
+        ArraySequence.__init__(self, X, Y, batch_size, outputclasses, **kwargs)
+        self.teacher = teacher
+        self.maps = maps
+
+    def __getitem__(self, i):
+        x, y = ArraySequence.__getitem__(self, i)
+        idx = self.batchindices(i)
+        prediction = np.concatenate([y, np.asarray(self.teacher[0][idx], dtype='float32')], axis=1)
+        if not self.maps:
+            return x, prediction
+        return x, [prediction]+[np.asarray(a[idx], dtype='float32') for a in self.teacher[1:]]
+
+
+def soften(p, temperature):
+    # softmax(logits/T) from probabilities: log p is the logits up to a per-sample constant
+    from keras import backend as K
+    return K.softmax(K.log(K.clip(p, K.epsilon(), 1.0))/temperature)
+
+
+def distillationloss(outputclasses, temperature=4.0, alpha=0.9):
+    # y_true holds [one-hot labels, teacher probabilities]; T^2 keeps the soft gradients on the scale of the hard ones
+    from keras import backend as K
+    def loss(y_true, y_pred):
+        labels, teacher = y_true[:, :outputclasses], y_true[:, outputclasses:]
+        hard = K.categorical_crossentropy(labels, y_pred)
+        soft = K.categorical_crossentropy(soften(teacher, temperature), soften(y_pred, temperature))
+        return (1-alpha)*hard + alpha*temperature**2*soft
+    return loss
+
+
+def attentiontransferloss(y_true, y_pred):
+    from keras import backend as K
+    return K.sum(K.square(K.l2_normalize(y_pred, axis=-1)-K.l2_normalize(y_true, axis=-1)), axis=-1)
+
+
+def labelaccuracy(outputclasses):
+    # accuracy against the label part of the distillation targets, logged as acc/val_acc like the other models
+    from keras import backend as K
+    def acc(y_true, y_pred):
+        return K.cast(K.equal(K.argmax(y_true[:, :outputclasses], axis=-1), K.argmax(y_pred, axis=-1)), K.floatx())
+    return acc
+
+
+def distill(teacher, student, X, Y, datasetname, validation_data=None, temperature=4.0, alpha=0.9, attentionweight=1.0, maps=True, directory='teachers', initial_lr=0.01, batch_size=64, epochs=200, workers=4, prefetch=10, keep_last=3):
+    # trains student against teacher's cached outputs; the student's weights end up under
+    # weights/<student name>-<dataset> early.hdf5 like after StandardFit
+    from keras import backend as K
+    from keras.models import Model
+    from LearnToPayAttention import fitmodel
+    from checkpoints import CheckpointManager, AsyncCheckpoint
+    from callbacks import LearningRateScaler
+    from metrics import MetricsSink
+    checkpoints = CheckpointManager("weights", student.name+"-"+datasetname, keep_last=keep_last)
+    if checkpoints.early() is not None:
+        print("Found early-stopped weights for "+student.name+"-"+datasetname)
+        student.model.load_weights(checkpoints.early())
+        return student.model
+    classes = student.outputclasses
+    heads = []
+    if maps:  # the student's active heads learn the maps of the same teacher heads, which must have been trained
+        heads = student.activeheads()
+        missing = [head for head in heads if head not in teacher.activeheads()]
+        if missing:
+            raise ValueError(teacher.name+' does not train attention head '+', '.join(str(head) for head in missing)+' that '+student.name+' uses, distill with maps=False or a teacher with att3')
+    train = transferred(teacheroutputs(teacher, X, 'train', datasetname, directory), teacher, heads)
+    if train[0].shape[1] != classes:
+        raise ValueError('teacher has '+str(train[0].shape[1])+' classes, student '+str(classes))
+    model = student.model
+    if maps:
+        studentmaps = [student.attentionmaps[head-1] for head in heads]
+        for head, cached, a in zip(heads, train[1:], studentmaps):
+            if cached.shape[1:] != K.int_shape(a)[1:]:
+                raise ValueError('attention'+str(head)+' of teacher and student differ in size ('+str(cached.shape[1:])+' vs '+str(K.int_shape(a)[1:])+'), distill with maps=False')
+        trainer = Model(inputs=model.inputs, outputs=[model.output]+studentmaps)  # shares the student's layers
+        losses = [distillationloss(classes, temperature, alpha)]+[attentiontransferloss]*len(heads)
+        lossweights = [1.0]+[attentionweight]*len(heads)
+    else:
+        trainer = Model(inputs=model.inputs, outputs=model.output)
+        losses, lossweights = distillationloss(classes, temperature, alpha), None
+    optimizer = student.defaultoptimizer() if student.optimizer is None else student.optimizer.__class__.from_config(student.optimizer.get_config())
+    trainer.compile(optimizer=optimizer, loss=losses, loss_weights=lossweights, metrics={trainer.output_names[0]: [labelaccuracy(classes)]})
+    monitor = 'acc' if not maps else trainer.output_names[0]+'_acc'
+    trainercheckpoints = CheckpointManager("weights", student.name+"-"+datasetname+"-distill", keep_last=keep_last, monitor='val_'+monitor if validation_data is not None else monitor)
+    startingepoch = 0
+    latest = trainercheckpoints.latest()
+    if latest is not None:
+        trainer.load_weights(trainercheckpoints.path(latest))
+        startingepoch = latest
+    sequence = DistillationSequence(X, Y, train, batch_size, classes, maps)
+    validation = None
+    if validation_data is not None:
+        Xval, Yval = validation_data
+        validation = DistillationSequence(Xval, Yval, transferred(teacheroutputs(teacher, Xval, 'test', datasetname, directory), teacher, heads), batch_size, classes, maps, shuffle=False)
+    checkpoint = AsyncCheckpoint(trainercheckpoints)
+    metricsink = MetricsSink(os.path.join('./logs', student.name+"-"+datasetname+"-distill-metrics.jsonl"))
+    callbackslist = [LearningRateScaler([60, 120, 160], 0.2, initial_lr), checkpoint, metricsink]
+    try:
+        if startingepoch < epochs:
+            fitmodel(trainer, sequence, None, batch_size, epochs, classes, callbackslist, startingepoch, validation, workers=workers, prefetch=prefetch)
+    finally:
+        metricsink.close()
+        checkpoint.close()
+    if trainercheckpoints.manifest['best'] is not None:  # the best epoch by (val_)acc, not necessarily the last
+        trainer.load_weights(trainercheckpoints.path(trainercheckpoints.manifest['best']['epoch']))
+    checkpoints.saveearly(student.model)
+    if not student.compiled():
+        student.compile()
+    return student.model
+
+
+if __name__ == "__main__":
+    parser = addmodelarguments(argparse.ArgumentParser(description="Distill a trained attention model into a smaller AttentionRN"))
+    parser.add_argument('--dataset', required=True)
+    parser.add_argument('--blocks', type=int, default=3, help="student bottleneck blocks per stage")
+    parser.add_argument('--widthmultiplier', type=float, default=0.5, help="student filter count multiplier")
+    parser.add_argument('--studentatt', default=None, help="student attention, defaults to --att")
+    parser.add_argument('--temperature', type=float, default=4.0)
+    parser.add_argument('--alpha', type=float, default=0.9, help="weight of the soft targets")
+    parser.add_argument('--attentionweight', type=float, default=1.0)
+    parser.add_argument('--nomaps', action='store_true', help="KD loss only, no attention transfer")
+    parser.add_argument('--epochs', type=int, default=200)
+    parser.add_argument('--batch', type=int, default=64)
+    args = parser.parse_args()
+    import datasets
+    from LearnToPayAttention import AttentionRN
+    data = datasets.load(args.dataset)
+    teacher = buildmodel(args)
+    options = dict(gmode=args.gmode, compatibilityfunction=args.compatibility, height=args.height, width=args.width, outputclasses=args.classes, blocks=args.blocks, widthmultiplier=args.widthmultiplier)
+    if args.studentatt or args.att:
+        options['att'] = args.studentatt or args.att
+    student = AttentionRN(**options)
+    distill(teacher, student, data.train[0], data.train[1], args.dataset, data.test, args.temperature, args.alpha, args.attentionweight, not args.nomaps, epochs=args.epochs, batch_size=args.batch)
+    for net in (teacher, student):
+        sequence = ArraySequence(data.test[0], data.test[1], 128, net.outputclasses, shuffle=False)
+        print("%s: %d parameters, test accuracy %.4f" % (net.name, net.model.count_params(), net.model.evaluate_generator(sequence)[1]))
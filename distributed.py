@@ -0,0 +1,57 @@
+import numpy as np
+
+# Synchronous data-parallel training for StandardFit(distributed=True), on Horovod (optional dependency,
+# pip install horovod). Every process trains a replica on its own shard of the data, gradients are
+# allreduced each step, and rank 0 alone writes checkpoints and logs.
+#
+# Locally, on CPU, with 4 worker processes:
+#     CUDA_VISIBLE_DEVICES= horovodrun -np 4 -H localhost:4 python distributedtest.py
+# Across hosts:
+#     horovodrun -np 8 -H host1:4,host2:4 python Train.py
+
+hvd = None
+
+
+def init():
+    # initializes Horovod once per process and returns the horovod.keras module
+    global hvd
+    if hvd is None:
+        try:
+            import horovod.keras
+        except ImportError:
+            raise ImportError('distributed training needs horovod: pip install horovod')
+        horovod.keras.init()
+        hvd = horovod.keras
+    return hvd
+
+
+def rank():
+    return hvd.rank() if hvd is not None else 0
+
+
+def size():
+    return hvd.size() if hvd is not None else 1
+
+
+def agree(value):
+    # rank 0's value of an integer on every worker (the epoch to resume from, whether to train at all),
+    # so ranks with different local checkpoints still run the same epochs; the value itself without horovod
+    if hvd is None:
+        return int(value)
+    return int(hvd.broadcast(np.array(int(value)), 0))
+
+
+def ischief():
+    return rank() == 0
+
+
+def distribute(model):
+    # recompiles model with its optimizer wrapped so gradients are averaged over all workers
+    model.compile(optimizer=hvd.DistributedOptimizer(model.optimizer), loss=model.loss, metrics=model.metrics)
+    return model
+
+
+def callbacks():
+    # must come first in the callback list: sync the initial (possibly resumed) weights from rank 0,
+    # and average epoch metrics so EarlyStopping/ReduceLROnPlateau decide the same on every worker
+    return [hvd.callbacks.BroadcastGlobalVariablesCallback(0), hvd.callbacks.MetricAverageCallback()]
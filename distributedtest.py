@@ -0,0 +1,25 @@
+import os
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')
+import time
+import numpy as np
+import distributed
+from LearnToPayAttention import AttentionVGG
+
+# Local check of StandardFit(distributed=True) with CPU worker processes:
+#     horovodrun -np 4 -H localhost:4 python distributedtest.py
+# Trains a small model for two epochs on synthetic data and checks every rank ends with identical weights.
+
+hvd = distributed.init()
+random = np.random.RandomState(0)  # the same data on every rank, each one streams its own shard
+X = random.rand(512, 32, 32, 3).astype('float32')
+Y = random.randint(0, 10, 512)
+
+runid = int(hvd.broadcast(np.array(time.time()), 0))  # fresh checkpoint key per run, agreed on by all ranks
+net = AttentionVGG(att='att2', datasetname="distributedtest-"+str(runid))
+net.StandardFit(X=X, Y=Y, stream=True, workers=1, batch_size=32, epochs=2, distributed=True)
+
+checksum = np.array([sum(float(np.sum(w)) for w in net.model.get_weights())])
+checksums = hvd.allgather(checksum)  # horovod.keras evaluates the allgather and returns a numpy array
+if distributed.ischief():
+    print("Weight checksums per rank: "+str(checksums))
+    assert np.allclose(checksums, checksums[0]), "replicas diverged"
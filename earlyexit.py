@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+from modelcli import addmodelarguments, buildmodel
+
+# Confidence-based early exit for AttentionVGG. Small classifiers (global average pooling + softmax) sit on local1
+# and local2; at inference a sample leaves at the first exit whose top softmax probability reaches that exit's
+# threshold, and only the remaining samples go on through the deeper convolutions. Inference runs stage by stage
+# (one backend function per stage, fed with the tensors the next stage starts from), and the samples still left
+# after each exit are regrouped into full batches, so the deeper stages run on dense batches.
+#
+#     exits = EarlyExitVGG(net)
+#     exits.fit(X, Y)                      # after the fact: only the exits train, or joint=True for everything
+#     exits.calibrate(Xval, Yval, 0.95)    # per-exit thresholds that keep 95% accuracy on the exiting samples
+#     probabilities, taken = exits.predict(X)
+
+
+class EarlyExitVGG:
+
+    def __init__(self, net, exits=2, weight_decay=0.0005):
+        import keras
+        from keras.models import Model
+        from keras.layers import GlobalAveragePooling2D, Dense
+        model = net.model
+        if len(model.outputs) != 1 or not hasattr(net, 'backboneoutputs'):
+            raise ValueError('early exits need a single-output AttentionVGG')
+        self.net = net
+        regularizer = keras.regularizers.l2(weight_decay)
+        self.exitoutputs = []
+        for i, local in enumerate(net.backboneoutputs[:exits]):  # local1, local2
+            x = GlobalAveragePooling2D(name='exit'+str(i+1)+'pool')(local)
+            self.exitoutputs.append(Dense(net.outputclasses, activation='softmax', kernel_regularizer=regularizer, name='exit'+str(i+1))(x))
+        self.model = Model(inputs=model.inputs, outputs=self.exitoutputs+[model.output])  # exits first, the full classifier last
+        self.thresholds = [np.inf]*len(self.exitoutputs)  # never exit until calibrated
+        self._stages = None
+
+    def exitlayers(self):
+        return [layer for layer in self.model.layers if layer.name.startswith('exit')]
+
+    def fit(self, X, Y, joint=False, lossweights=None, batch_size=128, epochs=30, validation_data=None, callbacks=[], **fitargs):
+        # joint=False trains only the exits on the frozen network, joint=True trains everything with
+        # lossweights (default 0.3 per exit, 1 for the full classifier)
+        from LearnToPayAttention import fitmodel
+        net = self.net
+        trainable = dict((layer.name, layer.trainable) for layer in self.model.layers)
+        exits = set(layer.name for layer in self.exitlayers())
+        if joint:
+            lossweights = lossweights or [0.3]*len(self.exitoutputs)+[1.0]
+        else:
+            lossweights = [1.0]*len(self.exitoutputs)+[0.0]
+            for layer in self.model.layers:
+                layer.trainable = layer.name in exits
+        optimizer = net.defaultoptimizer() if net.optimizer is None else net.optimizer.__class__.from_config(net.optimizer.get_config())
+        self.model.compile(optimizer=optimizer, loss=net.loss, loss_weights=lossweights, metrics=net.metrics)  # trainable weights are fixed here
+        # the updates (BatchNormalization moving statistics) are only collected when the train function is built, which fit
+        # does lazily: build it while the backbone is still frozen, or the shared net.model's statistics drift
+        self.model._make_train_function()
+        for layer in self.model.layers:
+            layer.trainable = trainable[layer.name]
+        return fitmodel(self.model, X, Y, batch_size, epochs, net.outputclasses, callbacks, 0, validation_data, stream=True, **fitargs)
+
+    def calibrate(self, X, Y, target=0.99, batch_size=128):
+        # for each exit in turn, the lowest threshold at which the samples leaving there (of those not already gone)
+        # are still classified with accuracy >= target
+        Y = np.asarray(Y)
+        probabilities = self.model.predict(np.asarray(X), batch_size=batch_size)
+        remaining = np.ones(len(Y), dtype=bool)
+        self.thresholds = []
+        for p in probabilities[:-1]:
+            confidence = p.max(axis=1)
+            threshold = lowestthreshold(confidence[remaining], p.argmax(axis=1)[remaining] == Y[remaining], target)
+            self.thresholds.append(threshold)
+            remaining &= confidence < threshold
+        return self.thresholds
+
+    def stages(self):
+        # one backend function per stage: image -> (exit1, pool1 input), pool1 input -> (exit2, pool2 input), ...,
+        # last cut (+ local1 when the first attention head is used) -> prediction. In the batchnorm VGG pool1 takes the
+        # pre-activation tensor, not local1, so local1 is carried along separately.
+        if self._stages is None:
+            from keras import backend as K
+            model = self.net.model
+            cuts = [model.get_layer('pool'+str(i+1)).input for i in range(len(self.exitoutputs))]
+            local1 = self.net.backboneoutputs[0]
+            from attentionlayers import attentionname
+            self.carrylocal1 = any(layer.name == attentionname(self.net.compatibilityfunction, 1) for layer in model.layers)
+            self.separatelocal1 = self.carrylocal1 and local1 is not cuts[0]
+            functions = []
+            for i, (exit, cut) in enumerate(zip(self.exitoutputs, cuts)):
+                inputs = model.inputs if i == 0 else [cuts[i-1]]
+                functions.append(K.function(inputs, [exit, cut]+([local1] if i == 0 and self.separatelocal1 else [])))
+            functions.append(K.function([cuts[-1]]+([local1] if self.carrylocal1 else []), [model.output]))
+            self._stages = functions
+        return self._stages
+
+    def predict(self, X, thresholds=None, batch_size=128, chunksize=None):
+        # returns (probabilities, taken) where taken[i] is the exit sample i left at, len(exits) for the full model
+        from keras import backend as K
+        thresholds = self.thresholds if thresholds is None else thresholds
+        stages = self.stages()
+        chunksize = chunksize or batch_size*4
+        probabilities = np.zeros((len(X), self.net.outputclasses), dtype='float32')
+        taken = np.full(len(X), len(stages)-1)
+        for start in range(0, len(X), chunksize):
+            carry = np.asarray(X[start:start+chunksize], dtype=K.floatx())
+            index = np.arange(len(carry))+start
+            local1 = None
+            for stage, function in enumerate(stages[:-1]):
+                outputs = batched(function, [carry], batch_size)
+                done = outputs[0].max(axis=1) >= thresholds[stage]
+                probabilities[index[done]] = outputs[0][done]
+                taken[index[done]] = stage
+                keep = ~done
+                if stage == 0 and self.carrylocal1:
+                    local1 = outputs[2] if self.separatelocal1 else outputs[1]
+                if local1 is not None:
+                    local1 = local1[keep]
+                index, carry = index[keep], outputs[1][keep]  # the rest, regrouped into full batches for the next stage
+                if not len(index):
+                    break
+            if len(index):
+                probabilities[index] = batched(stages[-1], [carry]+([local1] if self.carrylocal1 else []), batch_size)[0]
+        return probabilities, taken
+
+    def evaluate(self, X, Y, thresholds=None, batch_size=128):
+        Y = np.asarray(Y)
+        start = time.perf_counter()
+        probabilities, taken = self.predict(X, thresholds, batch_size)
+        seconds = time.perf_counter()-start
+        return {'accuracy': float(np.mean(probabilities.argmax(axis=1) == Y)), 'seconds': seconds,
+                'exits': [float(np.mean(taken == i)) for i in range(len(self.exitoutputs)+1)]}
+
+
+def lowestthreshold(confidence, correct, target):
+    # samples sorted by confidence: the longest prefix with accuracy >= target, np.inf if there is none
+    order = np.argsort(-confidence)
+    accuracy = np.cumsum(correct[order])/np.arange(1, len(order)+1.0)
+    passing = np.nonzero(accuracy >= target)[0]
+    if not len(passing):
+        return np.inf
+    return float(confidence[order][passing[-1]])
+
+
+def batched(function, arrays, batch_size):
+    outputs = [function([a[i:i+batch_size] for a in arrays]) for i in range(0, len(arrays[0]), batch_size)]
+    return [np.concatenate([o[k] for o in outputs]) for k in range(len(outputs[0]))]
+
+
+if __name__ == "__main__":
+    parser = addmodelarguments(argparse.ArgumentParser(description="Train and calibrate early exits for an AttentionVGG"))
+    parser.add_argument('--dataset', required=True)
+    parser.add_argument('--exitweights', required=True, help="hdf5 with the exits (and model); trained and written if missing")
+    parser.add_argument('--target', type=float, default=0.99, help="accuracy the samples leaving at each exit must keep")
+    parser.add_argument('--calibration', type=int, default=5000, help="last training samples held out for calibration")
+    parser.add_argument('--joint', action='store_true', help="train the whole network with the exits instead of only the exits")
+    parser.add_argument('--epochs', type=int, default=30)
+    args = parser.parse_args()
+    import datasets
+    data = datasets.load(args.dataset)
+    (x, y), (xtest, ytest) = data.train, data.test
+    exits = EarlyExitVGG(buildmodel(args))
+    if os.path.isfile(args.exitweights):
+        exits.model.load_weights(args.exitweights)
+    else:
+        n = len(x)-args.calibration
+        exits.fit(x[:n], y[:n], joint=args.joint, epochs=args.epochs)
+        exits.model.save_weights(args.exitweights)
+    thresholds = exits.calibrate(x[-args.calibration:], y[-args.calibration:], args.target)
+    with open(os.path.splitext(args.exitweights)[0]+"-thresholds.json", 'w') as f:
+        json.dump({'target': args.target, 'thresholds': [t if np.isfinite(t) else None for t in thresholds]}, f)
+    full = exits.evaluate(xtest, ytest, [np.inf]*len(thresholds))
+    early = exits.evaluate(xtest, ytest)
+    print("Thresholds "+str(thresholds))
+    print("Full model: accuracy %.4f in %.1fs" % (full['accuracy'], full['seconds']))
+    print("Early exit: accuracy %.4f in %.1fs, leaving at %s" % (early['accuracy'], early['seconds'], ", ".join("%.1f%%" % (100*e) for e in early['exits'])))
@@ -0,0 +1,176 @@
+import os
+import csv
+import sys
+import json
+import time
+import argparse
+import itertools
+import multiprocessing
+
+# Runs a declarative grid of StandardFit experiments concurrently, one fresh process per job.
+# A job is a dict: model ('vgg'/'rn'/'multihead'), att, gmode, compatibilityfunction, dataset, plus optional
+# 'model_args' (constructor) and 'fit_args' (StandardFit) dicts, and 'after' (job names to wait for). Any value given as a list in the grid
+# is expanded into one job per value. Jobs resume from their checkpoint manifests, finished ones are
+# skipped using the results table, and every job logs to its own file.
+
+RESULTFIELDS = ['name', 'model', 'att', 'gmode', 'compatibilityfunction', 'dataset', 'status', 'seconds', 'loss', 'accuracy', 'error']
+DEFAULTS = {'gmode': 'concat', 'compatibilityfunction': 'pc', 'model_args': {}, 'fit_args': {}}
+CLASSES = {'cifar10': 10, 'cifar100': 100, 'svhn': 10, 'cub2002011': 200}
+
+
+def expand(grid):
+    jobs = []
+    for entry in (grid if isinstance(grid, list) else [grid]):
+        keys = sorted(entry)
+        values = [entry[key] if isinstance(entry[key], list) else [entry[key]] for key in keys]
+        for combination in itertools.product(*values):
+            job = dict(DEFAULTS)
+            job.update(zip(keys, combination))
+            job.setdefault('att', 'att3' if job['model'] == 'vgg' else 'att2')
+            job['name'] = jobname(job)
+            jobs.append(job)
+    return jobs
+
+
+def jobname(job):
+    # same as the model name StandardFit uses for its checkpoints, plus the dataset
+    if job['model'] == 'multihead':
+        return "(VGG-multihead)-"+job['compatibilityfunction']+"-"+job['dataset']
+    return ("("+job['model'].upper()+"-"+job['att']+")-"+job['gmode']+"-"+job['compatibilityfunction']).replace('att)', 'att1)')+"-"+job['dataset']
+
+
+def availablememory():
+    # bytes that can be allocated without swapping: MemAvailable counts the reclaimable page cache, which free pages
+    # (SC_AVPHYS_PAGES) leave out, so a machine that has read the datasets once would look full. None if unknown
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])*1024
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        return None
+
+
+def slots(workers=None, threadsperjob=2, memoryperjob=4*2**30):
+    # concurrent jobs bounded by cores and by the memory currently available
+    bycores = max(1, (os.cpu_count() or 1)//threadsperjob)
+    available = availablememory()
+    bymemory = bycores if available is None else max(1, available//memoryperjob)
+    return min(workers or bycores, bycores, bymemory)
+
+
+def runjob(job, threads, logdirectory):
+    # runs in its own spawned process, so TensorFlow state never leaks between jobs
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    log = open(os.path.join(logdirectory, job['name']+".log"), 'a')
+    sys.stdout = sys.stderr = log
+    start = time.time()
+    result = dict((field, job.get(field, '')) for field in RESULTFIELDS)
+    try:
+        import tensorflow as tf
+        from keras import backend as K
+        K.set_session(tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=2)))
+        import datasets
+        from datapipeline import ArraySequence
+        from checkpoints import CheckpointManager
+        from LearnToPayAttention import AttentionVGG, AttentionRN, MultiHeadVGG
+
+        data = datasets.load(job['dataset'])
+        modelargs = dict(att=job['att'], gmode=job['gmode'], compatibilityfunction=job['compatibilityfunction'], outputclasses=CLASSES.get(job['dataset'], 10))
+        modelargs.update(job['model_args'])
+        if job['model'] == 'multihead':  # att and gmode come from the 'heads' model_arg, every head is trained
+            del modelargs['att'], modelargs['gmode']
+        net = {'vgg': AttentionVGG, 'rn': AttentionRN, 'multihead': MultiHeadVGG}[job['model']](**modelargs)
+        fitargs = dict(validation_data=data.test, stream=True)
+        fitargs.update(job['fit_args'])
+        if net.StandardFit(job['dataset'], *data.train, **fitargs) is None:  # already trained, evaluate the stored weights
+            checkpoints = CheckpointManager("weights", net.name+"-"+job['dataset'])
+            net.model.load_weights(checkpoints.trained())
+        if job['model'] == 'multihead':  # each head is stored as an early-stopped vgg run, the row gets the best head's accuracy
+            accuracies = []
+            for head in net.saveheads(job['dataset']):
+                accuracies.append(head.compile().evaluate_generator(ArraySequence(data.test[0], data.test[1], 128, net.outputclasses, shuffle=False))[1])
+                print(head.name+" accuracy "+str(accuracies[-1]))
+            loss, accuracy = None, max(accuracies)
+        else:
+            loss, accuracy = net.model.evaluate_generator(ArraySequence(data.test[0], data.test[1], 128, net.outputclasses, shuffle=False))[:2]
+        result.update(status='done', loss=loss, accuracy=accuracy)
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        result.update(status='failed', error=repr(e))
+    result['seconds'] = round(time.time()-start, 1)
+    log.close()
+    return result
+
+
+def finished(results):
+    if not os.path.isfile(results):
+        return set()
+    with open(results) as f:
+        return set(row['name'] for row in csv.DictReader(f) if row['status'] == 'done')
+
+
+def run(grid, workers=None, threadsperjob=2, memoryperjob=4*2**30, results="experiments/results.csv", logdirectory="experiments/logs"):
+    for directory in (os.path.dirname(results), logdirectory):
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+    done = finished(results)
+    waiting = [job for job in expand(grid) if job['name'] not in done]
+    total = len(waiting)
+    n = slots(workers, threadsperjob, memoryperjob)
+    print("Running "+str(total)+" jobs, "+str(n)+" at a time")
+    if not waiting:
+        return []
+    pool = multiprocessing.get_context('spawn').Pool(n, maxtasksperchild=1)
+    running = {}
+    failed = set()
+    writeheader = not os.path.isfile(results)
+    collected = []
+    with open(results, 'a') as f:
+        writer = csv.DictWriter(f, RESULTFIELDS)
+        if writeheader:
+            writer.writeheader()
+        def record(result):
+            collected.append(result)
+            writer.writerow(result)
+            f.flush()
+            (done if result['status'] == 'done' else failed).add(result['name'])
+            print("[%d/%d] %s %s in %ss, accuracy %s" % (len(collected), total, result['name'], result['status'], result['seconds'], result['accuracy']))
+        while waiting or running:
+            for job in list(waiting):  # 'after' lists jobs (by name) that have to finish first, e.g. a transfer source
+                after = job.get('after', [])
+                after = [after] if isinstance(after, str) else after
+                if any(name in failed for name in after):
+                    waiting.remove(job)
+                    record(dict([(field, job.get(field, '')) for field in RESULTFIELDS], status='failed', seconds=0, error='dependency failed'))
+                elif all(name in done for name in after):
+                    waiting.remove(job)
+                    running[job['name']] = pool.apply_async(runjob, (job, threadsperjob, logdirectory))
+            for name in [name for name in running if running[name].ready()]:
+                record(running.pop(name).get())
+            if waiting and not running:
+                for job in waiting:
+                    record(dict([(field, job.get(field, '')) for field in RESULTFIELDS], status='failed', seconds=0, error='dependency not in grid'))
+                waiting = []
+            time.sleep(1)
+    pool.close()
+    pool.join()
+    return collected
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a grid of attention model experiments in parallel")
+    parser.add_argument('grid', help="JSON file with a job dict or a list of them, list values are expanded")
+    parser.add_argument('--workers', type=int, default=None, help="upper bound on concurrent jobs")
+    parser.add_argument('--threads', type=int, default=2, help="TensorFlow threads per job")
+    parser.add_argument('--memory', type=float, default=4, help="expected GB per job")
+    parser.add_argument('--results', default="experiments/results.csv")
+    args = parser.parse_args()
+    with open(args.grid) as f:
+        run(json.load(f), args.workers, args.threads, int(args.memory*2**30), args.results)
@@ -0,0 +1,166 @@
+import os
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')  # latency is reported for CPU serving
+import time
+import argparse
+import numpy as np
+from keras import backend as K
+from keras.models import Model, model_from_json
+from attentionlayers import custom_objects
+from modelcli import addmodelarguments, buildmodel
+
+# Inference-only export of an attention model:
+#  - every BatchNormalization that directly follows a linear Conv2D is folded into the conv kernel and bias
+#  - regularizers and the optimizer are dropped, the architecture is plain JSON (no Lambda layers)
+#  - weights are stored in an .npz as float32, float16, or int8 with one scale per output channel
+# The export is checked against the Keras model and latency/size before and after are printed.
+
+
+def consumers(config):
+    counts = {}
+    for layer in config['layers']:
+        for node in layer['inbound_nodes']:
+            for inbound in node:
+                counts[inbound[0]] = counts.get(inbound[0], 0)+1
+    return counts
+
+
+def foldbatchnorm(model):
+    # returns a new Model without the foldable BatchNormalization layers and with folded weights
+    config = model.get_config()
+    layers = dict((layer['name'], layer) for layer in config['layers'])
+    counts = consumers(config)
+    replaced = {}  # removed BN name -> conv name
+    folded = {}  # conv name -> [kernel, bias]
+    for layer in config['layers']:
+        if layer['class_name'] != 'BatchNormalization' or len(layer['inbound_nodes']) != 1 or len(layer['inbound_nodes'][0]) != 1:
+            continue
+        source = layers[layer['inbound_nodes'][0][0][0]]
+        if source['class_name'] != 'Conv2D' or source['config']['activation'] != 'linear' or counts.get(source['name']) != 1 or len(source['inbound_nodes']) != 1:
+            continue
+        bn = model.get_layer(layer['name'])
+        weights = bn.get_weights()
+        gamma = weights.pop(0) if bn.scale else 1
+        beta = weights.pop(0) if bn.center else 0
+        mean, variance = weights
+        conv = model.get_layer(source['name']).get_weights()
+        kernel = conv[0]
+        bias = conv[1] if len(conv) > 1 else np.zeros(kernel.shape[-1], dtype=kernel.dtype)
+        scale = gamma/np.sqrt(variance + bn.epsilon)
+        folded[source['name']] = [kernel*scale, (bias-mean)*scale + beta]
+        source['config']['use_bias'] = True
+        replaced[layer['name']] = source['name']
+
+    config['layers'] = [layer for layer in config['layers'] if layer['name'] not in replaced]
+    for layer in config['layers']:
+        for key in ('kernel_regularizer', 'bias_regularizer', 'activity_regularizer'):
+            if key in layer['config']:
+                layer['config'][key] = None
+        for node in layer['inbound_nodes']:
+            for inbound in node:
+                inbound[0] = replaced.get(inbound[0], inbound[0])
+    for output in config['output_layers']:
+        output[0] = replaced.get(output[0], output[0])
+
+    exported = Model.from_config(config, custom_objects=custom_objects)
+    for layer in exported.layers:
+        if layer.name in folded:
+            layer.set_weights(folded[layer.name])
+        elif layer.weights:
+            layer.set_weights(model.get_layer(layer.name).get_weights())
+    print("Folded "+str(len(folded))+" BatchNormalization layers into their convolutions")
+    return exported
+
+
+def quantize(model, precision='float32'):
+    # {layer/index: array}, int8 kernels are stored with a per-output-channel scale next to them
+    arrays = {}
+    for layer in model.layers:
+        for i, w in enumerate(layer.get_weights()):
+            key = layer.name+"/"+str(i)
+            if precision == 'int8' and w.ndim >= 2:
+                scale = np.abs(w).reshape(-1, w.shape[-1]).max(axis=0)/127.0
+                scale[scale == 0] = 1
+                arrays[key] = np.round(w/scale).astype(np.int8)
+                arrays[key+"/scale"] = scale.astype(np.float32)
+            elif precision in ('float16', 'int8'):
+                arrays[key] = w.astype(np.float16)
+            else:
+                arrays[key] = w.astype(np.float32)
+    return arrays
+
+
+def save(model, path, precision='float32'):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    with open(os.path.join(path, "model.json"), 'w') as f:
+        f.write(model.to_json())
+    np.savez_compressed(os.path.join(path, "weights.npz"), precision=precision, **quantize(model, precision))
+    return path
+
+
+def load(path):
+    with open(os.path.join(path, "model.json")) as f:
+        model = model_from_json(f.read(), custom_objects=custom_objects)
+    arrays = np.load(os.path.join(path, "weights.npz"))
+    for layer in model.layers:
+        weights = []
+        for i in range(len(layer.weights)):
+            key = layer.name+"/"+str(i)
+            w = arrays[key].astype(np.float32)
+            if key+"/scale" in arrays:
+                w = w*arrays[key+"/scale"]
+            weights.append(w)
+        if weights:
+            layer.set_weights(weights)
+    return model
+
+
+def latency(model, x, batch_size, repeats=10):
+    model.predict(x[:batch_size], batch_size=batch_size)  # warm-up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        model.predict(x[:batch_size], batch_size=batch_size)
+    return (time.perf_counter()-start)/repeats
+
+
+def directorysize(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+def export(net, path, precision='float32', samples=None, tolerance=None, batch_size=128):
+    exported = foldbatchnorm(net.model)
+    save(exported, path, precision)
+    restored = load(path)
+
+    if samples is None:
+        samples = np.random.rand(*((batch_size,)+K.int_shape(net.model.input)[1:])).astype(K.floatx())
+    tolerance = tolerance or {'float32': 1e-4, 'float16': 1e-2, 'int8': 5e-2}[precision]
+    reference = net.model.predict(samples, batch_size=batch_size)
+    maxdiff = np.abs(reference-restored.predict(samples, batch_size=batch_size)).max()
+    agreement = np.mean(reference.argmax(-1) == restored.predict(samples, batch_size=batch_size).argmax(-1))
+    print("Max abs output difference %.2e (tolerance %.0e), top-1 agreement %.4f" % (maxdiff, tolerance, agreement))
+
+    original = path+".original.hdf5"
+    net.model.save_weights(original)
+    originalsize = os.path.getsize(original)
+    os.remove(original)
+    print("Size: keras weights %.2f MB, export %.2f MB" % (originalsize/2.0**20, directorysize(path)/2.0**20))
+    for n in (1, batch_size):
+        before, after = latency(net.model, samples, n), latency(restored, samples, n)
+        print("Latency batch %d: keras %.2f ms, export %.2f ms" % (n, before*1000, after*1000))
+    if maxdiff > tolerance:
+        raise ValueError("Exported model differs from the Keras model by %g, more than %g" % (maxdiff, tolerance))
+    return restored
+
+
+if __name__ == "__main__":
+    parser = addmodelarguments(argparse.ArgumentParser(description="Export an attention model for inference"))
+    parser.add_argument('--out', required=True, help="output directory")
+    parser.add_argument('--precision', choices=['float32', 'float16', 'int8'], default='float32')
+    parser.add_argument('--samples', default=None, help=".npy inputs used to check the export, random if omitted")
+    parser.add_argument('--tolerance', type=float, default=None)
+    args = parser.parse_args()
+    samples = None
+    if args.samples:
+        samples = np.asarray(np.load(args.samples, mmap_mode='r')[:512], dtype=K.floatx())
+    export(buildmodel(args, compileonbuild=False), args.out, args.precision, samples, args.tolerance)
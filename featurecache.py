@@ -0,0 +1,76 @@
+import os
+import shutil
+import hashlib
+import numpy as np
+from numpy.lib.format import open_memmap
+
+# On-disk cache of backbone outputs for frozen-backbone transfer (AttentionVGG.FrozenTransferFit). The backbone
+# runs once over a dataset, local1/local2/local3/pregflatten go to float16 .npy memmaps under
+# <directory>/<dataset>-<weights hash>/, and the heads train from the memmaps without touching the convolutions.
+# The key includes a hash of the backbone weights, so retrained source weights never reuse stale features.
+# At 80x80 the locals are large (local1 alone is 80*80*256 values, 3.3 MB in float16, per image), which is why they
+# stay on disk, why FrozenTransferFit only caches the locals of the heads its classifier reads, and why extract()
+# reports the size up front and refuses to start what would not fit on the disk (or under limit).
+# Other outputs can be cached the same way with names (and dtype per name), e.g. the teacher outputs in distillation.py.
+
+FEATURES = ['local1', 'local2', 'local3', 'pregflatten']  # globalg is trained with the heads
+FLOAT16MAX = 65504
+
+
+def weightshash(model):
+    from keras import backend as K
+    digest = hashlib.sha1()
+    for w in K.batch_get_value(model.weights):
+        digest.update(np.ascontiguousarray(w).tobytes())
+    return digest.hexdigest()[:16]
+
+
+class FeatureCache:
+
+    def __init__(self, directory, dataset, weightshash, dtype='float16', names=FEATURES):
+        self.path = os.path.join(directory, dataset+"-"+weightshash)
+        self.names = names
+        self.dtypes = dtype if isinstance(dtype, dict) else dict((name, dtype) for name in names)
+
+    def filename(self, split, feature):
+        return os.path.join(self.path, split+"-"+feature+".npy")
+
+    def complete(self, split):
+        return os.path.isfile(os.path.join(self.path, split+".done"))
+
+    def load(self, split):
+        # [local1, local2, local3, pregflatten] (or the outputs in names) of a split as read-only memmaps
+        return [np.load(self.filename(split, name), mmap_mode='r') for name in self.names]
+
+    def sizes(self, backbone, count):
+        # bytes per name for count images of backbone's outputs
+        from keras import backend as K
+        return [(name, count*int(np.prod(K.int_shape(t)[1:]))*np.dtype(self.dtypes[name]).itemsize) for name, t in zip(self.names, backbone.outputs)]
+
+    def extract(self, backbone, X, split, batch_size=128, chunksize=None, limit=None):
+        # runs backbone (image -> [local1, local2, local3, pregflatten], or any model with one output per name) over X once,
+        # unless this split is already cached. limit (bytes) caps the size of the split.
+        if self.complete(split):
+            return self.load(split)
+        from keras import backend as K
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        sizes = self.sizes(backbone, len(X))
+        size = sum(nbytes for _, nbytes in sizes)
+        print("Caching %s (%d images) in %s: %.2f GB, %s" % (split, len(X), self.path, size/2.0**30, ", ".join("%s %.2f GB" % (name, nbytes/2.0**30) for name, nbytes in sizes)))
+        if limit is not None and size > limit:
+            raise ValueError('the %s features need %.2f GB, over the limit of %.2f GB' % (split, size/2.0**30, limit/2.0**30))
+        if size > shutil.disk_usage(self.path).free:  # the memmaps are sparse, running out of disk would only show mid-extraction
+            raise ValueError('the %s features need %.2f GB, %s has %.2f GB free' % (split, size/2.0**30, self.path, shutil.disk_usage(self.path).free/2.0**30))
+        chunksize = chunksize or batch_size*16
+        outputs = [open_memmap(self.filename(split, name), mode='w+', dtype=self.dtypes[name], shape=(len(X),)+K.int_shape(t)[1:])
+                   for name, t in zip(self.names, backbone.outputs)]
+        for i in range(0, len(X), chunksize):
+            values = backbone.predict(np.asarray(X[i:i+chunksize], dtype=K.floatx()), batch_size=batch_size)
+            for output, value in zip(outputs, values):
+                output[i:i+len(value)] = np.clip(value, -FLOAT16MAX, FLOAT16MAX) if output.dtype == np.float16 else value
+        for output in outputs:
+            output.flush()
+        del outputs
+        open(os.path.join(self.path, split+".done"), 'w').close()  # an interrupted extraction is redone, never half-used
+        return self.load(split)
@@ -0,0 +1,57 @@
+import os
+import numpy as np
+import pytest
+pytest.importorskip('keras')
+from featurecache import FeatureCache, weightshash
+
+
+def backbone():
+    from keras.models import Model
+    from keras.layers import Input, Conv2D, Flatten
+    inp = Input(shape=(4, 4, 3))
+    local = Conv2D(2, (3, 3), padding='same')(inp)
+    return Model(inputs=inp, outputs=[local, Flatten()(local)])
+
+
+def images(n=10):
+    return np.random.RandomState(0).rand(n, 4, 4, 3).astype('float32')
+
+
+def test_extract_matches_predict_and_is_reused(tmp_path):
+    model = backbone()
+    X = images()
+    cache = FeatureCache(str(tmp_path), 'data', weightshash(model), names=['local', 'flat'])
+    local, flat = cache.extract(model, X, 'train', batch_size=4, chunksize=3)
+    expected = model.predict(X)
+    assert local.dtype == np.float16 and local.shape == (10, 4, 4, 2)
+    assert np.allclose(local, expected[0], atol=1e-2)
+    assert np.allclose(flat, expected[1], atol=1e-2)
+    assert cache.complete('train')
+    class Unused:
+        outputs = model.outputs
+        def predict(self, *args, **kwargs):
+            raise AssertionError('a complete split is loaded, not extracted again')
+    assert np.array_equal(cache.extract(Unused(), X, 'train')[0], local)
+
+
+def test_sizes_per_name(tmp_path):
+    model = backbone()
+    cache = FeatureCache(str(tmp_path), 'data', 'hash', dtype={'local': 'float16', 'flat': 'float32'}, names=['local', 'flat'])
+    assert cache.sizes(model, 10) == [('local', 10*32*2), ('flat', 10*32*4)]
+
+
+def test_limit_stops_before_extracting(tmp_path):
+    model = backbone()
+    cache = FeatureCache(str(tmp_path), 'data', 'hash', names=['local', 'flat'])
+    with pytest.raises(ValueError):
+        cache.extract(model, images(), 'train', limit=100)
+    assert not cache.complete('train')
+    assert not os.path.exists(cache.filename('train', 'local'))
+
+
+def test_weights_hash_follows_the_weights():
+    model = backbone()
+    before = weightshash(model)
+    assert weightshash(model) == before
+    model.set_weights([w+1 for w in model.get_weights()])
+    assert weightshash(model) != before
@@ -0,0 +1,133 @@
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+
+# Training memory and step time of AttentionRN with and without activation recomputation (checkpointing=True),
+# at 32x32 and 80x80 inputs. For every (size, checkpointing) it reports, at the reference batch, the median
+# step time and the peak memory (GPU bytes in use when there is a GPU, peak resident memory otherwise), and it
+# searches the largest batch that still trains: doubling from --startbatch until a step runs out of memory (or
+# goes over --memorylimit MB, to emulate a device budget on CPU), then bisecting down to --resolution.
+# Every trial runs in its own spawned process, so an out-of-memory failure or a fragmented allocator does not
+# carry over to the next one, and a trial the kernel's OOM killer ends counts as a batch that does not fit.
+#
+#     python memorybenchmark.py --sizes 32 80 --batch 32 --out memory.json
+
+
+def trial(size, batch, checkpointing, steps, att='att3', classes=10):
+    # runs in the spawned process; None when the batch does not fit (TensorFlow errors do not pickle back)
+    import tensorflow as tf
+    try:
+        return measure(size, batch, checkpointing, steps, att, classes)
+    except (tf.errors.ResourceExhaustedError, MemoryError):
+        return None
+
+
+def measure(size, batch, checkpointing, steps, att, classes):
+    import resource
+    import numpy as np
+    import tensorflow as tf
+    from keras import backend as K
+    from LearnToPayAttention import AttentionRN
+    net = AttentionRN(att=att, height=size, width=size, outputclasses=classes, checkpointing=checkpointing)
+    model = net.model
+    x = np.random.rand(batch, size, size, 3).astype(K.floatx())
+    y = np.eye(classes)[np.random.randint(0, classes, batch)]
+    model.train_on_batch(x, y)  # builds the training function, recomputation included
+    times = []
+    for _ in range(steps):
+        start = time.perf_counter()
+        model.train_on_batch(x, y)
+        times.append(time.perf_counter()-start)
+    step = sorted(times)[len(times)//2]
+    if tf.test.is_gpu_available():
+        from tensorflow.contrib.memory_stats import MaxBytesInUse
+        peak, device = K.get_session().run(MaxBytesInUse())/2.0**20, 'gpu'
+    else:
+        peak, device = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0, 'cpu'
+    return {'step_s': step, 'peak_mb': peak, 'device': device, 'samples_per_sec': batch/step}
+
+
+def report(connection, size, batch, checkpointing, steps):
+    # the spawned process: sends the trial's result back through the pipe
+    connection.send(trial(size, batch, checkpointing, steps))
+    connection.close()
+
+
+def attempt(size, batch, checkpointing, steps, memorylimit=None):
+    # the trial's result, or None when it ran out of memory (or over memorylimit). A child killed outright, by the
+    # OOM killer or a crash in the allocator, never reports back and counts as not fitting as well
+    context = multiprocessing.get_context('spawn')
+    receive, send = context.Pipe(duplex=False)
+    process = context.Process(target=report, args=(send, size, batch, checkpointing, steps))
+    process.start()
+    send.close()
+    process.join()
+    result = None
+    if process.exitcode == 0 and receive.poll():
+        result = receive.recv()
+    elif process.exitcode != 0:
+        print("batch %d at %dx%d died with exit code %s, counted as out of memory" % (batch, size, size, process.exitcode))
+    receive.close()
+    if result is None or memorylimit is not None and result['peak_mb'] > memorylimit:
+        return None
+    return result
+
+
+def largestbatch(size, checkpointing, steps, start=16, maximum=4096, resolution=8, memorylimit=None):
+    feasible, infeasible = None, None
+    batch = start
+    while batch <= maximum:
+        if attempt(size, batch, checkpointing, steps, memorylimit) is None:
+            infeasible = batch
+            break
+        feasible = batch
+        batch *= 2
+    if feasible is None or infeasible is None:
+        return feasible
+    while infeasible-feasible > resolution:
+        batch = (feasible+infeasible)//2
+        if attempt(size, batch, checkpointing, steps, memorylimit) is None:
+            infeasible = batch
+        else:
+            feasible = batch
+    return feasible
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="AttentionRN training memory and speed with and without activation recomputation")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[32, 80])
+    parser.add_argument('--batch', type=int, default=32, help="reference batch for step time and peak memory")
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--startbatch', type=int, default=16)
+    parser.add_argument('--maxbatch', type=int, default=4096)
+    parser.add_argument('--resolution', type=int, default=8, help="precision of the largest batch search")
+    parser.add_argument('--memorylimit', type=float, default=None, help="MB; a batch peaking above it counts as not fitting")
+    parser.add_argument('--nosearch', action='store_true', help="only the reference batch")
+    parser.add_argument('--out', default="memory.json")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        for checkpointing in (False, True):
+            row = {'size': size, 'checkpointing': checkpointing, 'batch': args.batch}
+            reference = attempt(size, args.batch, checkpointing, args.steps, args.memorylimit)
+            if reference is None:
+                row['error'] = 'out of memory at batch '+str(args.batch)
+            else:
+                row.update(reference)
+            if not args.nosearch:
+                row['largest_batch'] = largestbatch(size, checkpointing, args.steps, args.startbatch, args.maxbatch, args.resolution, args.memorylimit)
+            results.append(row)
+            print("%3dx%-3d %-13s step %8s  peak %9s  largest batch %s" % (size, size, 'recompute' if checkpointing else 'store all',
+                  "%.1fms" % (1000*row['step_s']) if 'step_s' in row else '-', "%.0fMB" % row['peak_mb'] if 'peak_mb' in row else '-', row.get('largest_batch', '-')))
+            sys.stdout.flush()
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+    for size in args.sizes:
+        base, recomputed = [r for r in results if r['size'] == size]
+        if 'step_s' in base and 'step_s' in recomputed:
+            print("%dx%d: recomputation uses %.0f%% of the memory at %.0f%% of the speed" % (size, size, 100*recomputed['peak_mb']/base['peak_mb'], 100*base['step_s']/recomputed['step_s']))
+        if base.get('largest_batch') and recomputed.get('largest_batch'):
+            print("%dx%d: largest batch %d -> %d" % (size, size, base['largest_batch'], recomputed['largest_batch']))
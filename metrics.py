@@ -0,0 +1,106 @@
+import os
+import json
+import time
+import threading
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+import numpy as np
+from keras import backend as K
+from keras.callbacks import Callback
+
+# Training metrics as JSON lines, one object per event:
+#     {"event": "batch", "epoch": 3, "batch": 120, "loss": 1.2, "acc": 0.61, "lr": 0.01, "step_ms": 41.3, "samples_per_sec": 3099.2, "time": ...}
+#     {"event": "epoch", "epoch": 3, "loss": ..., "val_acc": ..., "lr": 0.01, "seconds": 95.1, "samples_per_sec": 2630.4, "time": ...}
+# Events are queued and encoded/written by a background thread, so the training loop never waits on disk.
+
+
+class MetricsSink(Callback):
+
+    def __init__(self, path, batchevery=1, flushevery=100):
+        super(MetricsSink, self).__init__()
+        self.path = path
+        self.batchevery = batchevery  # write every n-th batch event, epoch events are always written
+        self.flushevery = flushevery
+        self.queue = queue.Queue()
+        self.thread = None
+        self.epoch = 0
+        self.lr = None
+
+    def emit(self, event, logs):
+        record = {'event': event, 'time': time.time()}
+        for key, value in (logs or {}).items():
+            if isinstance(value, (np.generic, np.ndarray)):
+                value = value.tolist()
+            record[key] = value
+        self.queue.put(record)
+
+    def write(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.path, 'a') as f:
+            pending = 0
+            while True:
+                record = self.queue.get()
+                if record is None:
+                    break
+                f.write(json.dumps(record)+"\n")
+                pending += 1
+                if pending >= self.flushevery or record['event'] != 'batch':
+                    f.flush()
+                    pending = 0
+
+    def readlr(self):
+        if hasattr(self.model.optimizer, 'lr'):
+            self.lr = float(K.get_value(self.model.optimizer.lr))
+
+    def on_train_begin(self, logs=None):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.write, name='metrics-sink')
+            self.thread.daemon = True
+            self.thread.start()
+        self.emit('train_begin', dict(logs or {}, epochs=self.params.get('epochs')))
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self.epochstart = time.perf_counter()
+        self.samples = 0
+        self.readlr()  # schedulers set the lr at epoch begin (ReduceLROnPlateau at the end of the previous one)
+
+    def on_batch_begin(self, batch, logs=None):
+        self.batchstart = time.perf_counter()
+
+    def on_batch_end(self, batch, logs=None):
+        logs = logs or {}
+        step = time.perf_counter()-self.batchstart
+        size = logs.get('size', 0)
+        self.samples += size
+        if batch % self.batchevery == 0:
+            record = dict((key, value) for key, value in logs.items() if key not in ('batch', 'size'))
+            record.update(epoch=self.epoch, batch=batch, lr=self.lr, step_ms=1000*step, samples_per_sec=size/step if step > 0 else None)
+            self.emit('batch', record)
+
+    def on_epoch_end(self, epoch, logs=None):
+        seconds = time.perf_counter()-self.epochstart
+        record = dict(logs or {})
+        record.setdefault('lr', self.lr)
+        record.update(epoch=epoch, seconds=seconds, samples_per_sec=self.samples/seconds if seconds > 0 else None)
+        self.emit('epoch', record)
+
+    def on_train_end(self, logs=None):
+        self.emit('train_end', logs)
+        self.close()
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+
+def read(path):
+    # the events of a metrics file, e.g. [r for r in read(path) if r['event'] == 'epoch']
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
@@ -0,0 +1,82 @@
+import tensorflow as tf
+from keras import backend as K
+
+# precision='mixed_float16' for AttentionVGG and AttentionRN on Keras 2.x / TensorFlow 1.14+. TensorFlow's automatic
+# mixed precision graph rewrite runs the convolutions and matmuls in float16 and keeps softmax, reductions and the
+# weights in float32, casting between them where needed; it is a session option, so enable() moves keras to a
+# session with it switched on. The rewrite only acts on NVIDIA GPUs of compute capability 7.0+ (tensor cores): there is
+# no reduced precision path for CPUs (TensorFlow 1.x has no bfloat16 rewrite), so enable() refuses to run without one.
+# lossscaled() adds dynamic loss scaling to a keras optimizer, float16 gradients underflow without it.
+
+session = None  # the keras session with the rewrite, once enabled
+
+
+def enable(precision='mixed_float16'):
+    global session
+    if precision != 'mixed_float16':
+        raise ValueError('precision must be None or "mixed_float16", got '+str(precision))
+    if session is not None and K.get_session() is session:
+        return session
+    if not hasattr(tf.train, 'experimental') or not hasattr(tf.train.experimental, 'enable_mixed_precision_graph_rewrite'):
+        raise ValueError('precision=mixed_float16 needs the mixed precision graph rewrite of TensorFlow 1.14+')
+    if not tf.test.is_gpu_available(cuda_only=True, min_cuda_compute_capability=(7, 0)):
+        raise ValueError('precision=mixed_float16 needs a GPU of compute capability 7.0+, elsewhere the rewrite leaves the graph in float32')
+    if tf.global_variables():  # a new session would silently re-initialise the weights already in the graph
+        raise ValueError('precision=mixed_float16 has to be the first model built in the process')
+    from tensorflow.core.protobuf import rewriter_config_pb2
+    config = tf.ConfigProto()
+    config.graph_options.rewrite_options.auto_mixed_precision = rewriter_config_pb2.RewriterConfig.ON
+    session = tf.Session(config=config)
+    K.set_session(session)
+    return session
+
+
+def skippable(updates, finite):
+    # the optimizer's assignments rebuilt to leave their variable as it is unless finite, so on an overflow step
+    # neither the weights nor the momenta, iterations or decay move. Only the rebuilt ops are fetched, the originals
+    # never run.
+    conditional = []
+    for update in updates:
+        op = getattr(update, 'op', update)
+        variable, value = op.inputs[0], op.inputs[1]
+        if op.type == 'Assign':
+            conditional.append(tf.assign(variable, tf.where(finite, value, variable)))
+        elif op.type in ('AssignAdd', 'AssignSub'):
+            step = tf.where(finite, value, tf.zeros_like(value))
+            conditional.append(tf.assign_add(variable, step) if op.type == 'AssignAdd' else tf.assign_sub(variable, step))
+        else:
+            raise ValueError('loss scaling cannot skip a '+op.type+' update of the optimizer')
+    return conditional
+
+
+def lossscaled(optimizer, initialscale=2.0**15, growthinterval=2000):
+    # a copy of optimizer that scales the loss before differentiating and the gradients back after. A step with
+    # non-finite gradients changes nothing but halves the scale, growthinterval finite steps in a row double it.
+    # Like recompute.checkpointed this is a subclass, so Horovod's DistributedOptimizer still reaches it through super.
+    base = optimizer.__class__
+
+    def get_updates(self, loss, params):
+        self.lossscale = K.variable(initialscale, name='loss_scale')
+        self.goodsteps = K.variable(0, dtype='int64', name='good_steps')
+        # finiteness of the gradients the update uses, after any allreduce of a subclass, so all ranks skip alike
+        gradients, applied = self.get_gradients, []
+        def recorded(loss, params):
+            applied.extend(gradients(loss, params))
+            return applied
+        self.get_gradients = recorded
+        try:
+            updates = super(cls, self).get_updates(loss, params)
+        finally:
+            del self.get_gradients
+        finite = tf.reduce_all(tf.stack([tf.reduce_all(tf.is_finite(g)) for g in applied]))
+        grow = tf.logical_and(finite, self.goodsteps+1 >= growthinterval)
+        scaleupdates = [K.update(self.lossscale, tf.where(finite, tf.where(grow, self.lossscale*2, self.lossscale), self.lossscale/2)),
+                        K.update(self.goodsteps, tf.where(tf.logical_and(finite, tf.logical_not(grow)), self.goodsteps+1, tf.zeros_like(self.goodsteps)))]
+        return skippable(updates, finite)+scaleupdates
+
+    def get_gradients(self, loss, params):
+        grads = super(cls, self).get_gradients(loss*self.lossscale, params)
+        return [g/self.lossscale for g in grads]
+
+    cls = type(base.__name__, (base,), {'get_updates': get_updates, 'get_gradients': get_gradients})
+    return cls(**optimizer.get_config())
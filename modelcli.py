@@ -0,0 +1,32 @@
+from LearnToPayAttention import AttentionVGG, AttentionRN
+
+# command-line options shared by the tools that build an attention model from a checkpoint
+
+
+def addmodelarguments(parser):
+    parser.add_argument('--model', choices=['vgg', 'rn'], default='vgg')
+    parser.add_argument('--att', default=None, help="att1, att2 or att3 (defaults to the constructor default)")
+    parser.add_argument('--gmode', choices=['concat', 'indep'], default='concat')
+    parser.add_argument('--compatibility', choices=['pc', 'dp'], default='pc')
+    parser.add_argument('--height', type=int, default=32)
+    parser.add_argument('--width', type=int, default=32)
+    parser.add_argument('--classes', type=int, default=10)
+    parser.add_argument('--nobatchnorm', action='store_true', help="VGG backbone without BatchNormalization")
+    parser.add_argument('--weights', default=None, help="hdf5 weights to load")
+    return parser
+
+
+def buildmodel(args, **kwargs):
+    options = dict(gmode=args.gmode, compatibilityfunction=args.compatibility, height=args.height, width=args.width, outputclasses=args.classes)
+    if args.att:
+        options['att'] = args.att
+    if args.model == 'vgg':
+        options['batchnorm'] = not args.nobatchnorm
+        options.update(kwargs)
+        net = AttentionVGG(**options)
+    else:
+        options.update(kwargs)
+        net = AttentionRN(**options)
+    if args.weights:
+        net.model.load_weights(args.weights)
+    return net
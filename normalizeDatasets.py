@@ -2,14 +2,16 @@ from keras.datasets import cifar10
 from keras.datasets import cifar100
 import numpy as np
 import scipy.io as sio
-from scipy import linalg
-from keras.preprocessing.image import ImageDataGenerator
+from numpy.lib.format import open_memmap
+from whitening import ZCAWhitening
+import datasets
 
-def normalizeDataset(x):
-    x=x.astype('float32')
-    g = ImageDataGenerator(featurewise_center=True,featurewise_std_normalization=True,zca_epsilon=1e-6,zca_whitening=True)
-    g.fit(x)
-    return g.standardize(x)
+def normalizeDataset(x, xtest, name):
+    # fit ZCA on the training set only, apply the same saved transform to both splits
+    w = ZCAWhitening(epsilon=1e-6).fit(x)
+    w.save("datasets/"+name+"zca.npz")
+    w.transform(x, open_memmap("datasets/"+name+".npy", mode='w+', dtype=np.float16, shape=x.shape)).flush()
+    w.transform(xtest, open_memmap("datasets/"+name+"test.npy", mode='w+', dtype=np.float16, shape=xtest.shape)).flush()
 
 
 #todo: normalize and save STL-train, STL-test, Caltech-101, Caltech-256, Event-8, Action-40, Scene-67, Object Discovery 
@@ -27,24 +29,16 @@ ysvhntest = svhn_data['y']
 xsvhntest = np.rollaxis(xsvhntest,3,-4)
 ysvhntest = np.squeeze(ysvhntest)
 
-x10 = normalizeDataset(x10)
+normalizeDataset(x10, x10test, "x10")
 print("x10 normalized")
-x10test = normalizeDataset(x10test)
-print("x10test normalized")
-x100 = normalizeDataset(x100)
+normalizeDataset(x100, x100test, "x100")
 print("x100 normalized")
-x100test = normalizeDataset(x100test)
-print("x100test normalized")
 
-np.save("datasets/x10", x10)
-np.save("datasets/x10test",x10test)
 np.save("datasets/y10", y10)
 np.save("datasets/y10test", y10test)
-np.save("datasets/x100", x100)
-np.save("datasets/x100test", x100test)
 np.save("datasets/y100", y100)
 np.save("datasets/y100test", y100test)
-np.save("datasets/xsvhn", xsvhn)
-np.save("datasets/xsvhntest", xsvhntest)
+datasets.save("datasets/xsvhn", xsvhn, np.uint8)
+datasets.save("datasets/xsvhntest", xsvhntest, np.uint8)
 np.save("datasets/ysvhn", ysvhn)
 np.save("datasets/ysvhntest", ysvhntest)
@@ -0,0 +1,204 @@
+import re
+import json
+import time
+import contextlib
+import numpy as np
+import tensorflow as tf
+from keras.callbacks import Callback
+
+# Where the training time goes. Profiler is a callback that records, for every batch, the compute time
+# (inside the Keras training function) and the input wait (the gap since the previous batch, i.e. the
+# generator / data pipeline). For a window of batches it also runs the training function with a full
+# TensorFlow trace and attributes op time to the model layers, forward and backward separately, so the
+# backbone, the compatibility functions and the attention pooling can be told apart.
+#
+#     net.model.fit(X, Y, callbacks=[Profiler(start=20, batches=10, trace='trace.json')])
+#
+# or around any code calling the model's train/predict function (train_on_batch, predict, ...):
+#
+#     with profile(net.model, 'predict', trace='predict.json') as profiler:
+#         net.model.predict(X, batch_size=256)
+#
+# The trace file opens in chrome://tracing.
+
+
+class Profiler(Callback):
+
+    def __init__(self, start=10, batches=10, trace=None, verbose=True, function='train'):
+        super(Profiler, self).__init__()
+        self.start = start  # first traced step, counted over all epochs; skips the warm-up steps
+        self.batches = batches
+        self.trace = trace
+        self.verbose = verbose
+        self.function = function
+        self.reset()
+
+    def reset(self):
+        self.step = 0
+        self.steptimes = []
+        self.waittimes = []
+        self.stepstats = []
+        self.lastend = None
+        self.began = None
+
+    def tracing(self):
+        return self.start <= self.step < self.start+self.batches
+
+    def kerasfunction(self):
+        f = getattr(self.model, self.function+'_function')
+        return getattr(f, 'function', f)  # unwrap profile()'s timing wrapper
+
+    def on_train_begin(self, logs=None):
+        self.reset()
+
+    def on_batch_begin(self, batch, logs=None):
+        if self.tracing():
+            settrace(self.kerasfunction(), True)
+        now = time.perf_counter()
+        if self.lastend is not None:
+            self.waittimes.append(now-self.lastend)
+        self.began = now
+
+    def on_batch_end(self, batch, logs=None):
+        now = time.perf_counter()
+        self.steptimes.append(now-self.began)
+        self.lastend = now
+        if self.tracing():
+            f = self.kerasfunction()
+            metadata = getattr(f, 'run_metadata', None) or f.session_kwargs.get('run_metadata')
+            if metadata is not None and metadata.HasField('step_stats'):
+                self.stepstats.append(metadata.step_stats)
+            if self.step+1 == self.start+self.batches:
+                settrace(f, False)
+        self.step += 1
+
+    def on_train_end(self, logs=None):
+        settrace(self.kerasfunction(), False)
+        if self.trace is not None and self.stepstats:
+            writetrace(self.stepstats, self.trace)
+        if self.verbose:
+            print(self.table())
+
+    def layertimes(self):
+        # {layer: [forward ms, backward ms]} per traced step, from the TensorFlow step stats
+        layers = set(layer.name for layer in self.model.layers)
+        times = {}
+        for stats in self.stepstats:
+            for device in opdevices(stats):
+                for node in device.node_stats:
+                    layer, backward = layerof(node.node_name, layers)
+                    times.setdefault(layer, [0.0, 0.0])[backward] += node.all_end_rel_micros/1000.0
+        n = max(1, len(self.stepstats))
+        return dict((layer, [forward/n, backward/n]) for layer, (forward, backward) in times.items())
+
+    def summary(self):
+        steps = np.array(self.steptimes[1:] or self.steptimes)*1000  # the first step includes graph setup
+        wait = np.array(self.waittimes)*1000
+        types = dict((layer.name, type(layer).__name__) for layer in self.model.layers)
+        layers = self.layertimes()
+        return {'steps': len(self.steptimes), 'step_ms': float(np.median(steps)) if len(steps) else None,
+                'step_mean_ms': float(steps.mean()) if len(steps) else None, 'wait_ms': float(np.median(wait)) if len(wait) else None,
+                'wait_fraction': float(wait.sum()/(wait.sum()+steps.sum())) if len(wait) else None, 'traced_steps': len(self.stepstats),
+                'layers': [{'layer': layer, 'type': types.get(layer, ''), 'forward_ms': forward, 'backward_ms': backward}
+                           for layer, (forward, backward) in sorted(layers.items(), key=lambda item: -sum(item[1]))]}
+
+    def table(self):
+        summary = self.summary()
+        if summary['step_ms'] is None:
+            return "No batches profiled"
+        lines = ["Profiled %d steps: median step %.1f ms (mean %.1f ms)" % (summary['steps'], summary['step_ms'], summary['step_mean_ms'])]
+        if summary['wait_ms'] is not None:
+            lines.append("Median input wait %.1f ms, %.0f%% of the time spent waiting for input" % (summary['wait_ms'], 100*summary['wait_fraction']))
+        if summary['layers']:
+            total = sum(row['forward_ms']+row['backward_ms'] for row in summary['layers'])
+            lines.append("Op time per layer, mean over %d traced steps (%.1f ms of ops per step):" % (summary['traced_steps'], total))
+            lines.append("%-28s %-26s %10s %11s %9s %6s" % ('layer', 'type', 'forward ms', 'backward ms', 'total ms', '%'))
+            for row in summary['layers']:
+                rowtotal = row['forward_ms']+row['backward_ms']
+                lines.append("%-28s %-26s %10.2f %11.2f %9.2f %5.1f%%" % (row['layer'][:28], row['type'][:26], row['forward_ms'], row['backward_ms'], rowtotal, 100*rowtotal/max(total, 1e-9)))
+            bytype = {}
+            for row in summary['layers']:
+                bytype[row['type'] or row['layer']] = bytype.get(row['type'] or row['layer'], 0)+row['forward_ms']+row['backward_ms']
+            lines.append("Per layer type: "+", ".join("%s %.1f%%" % (name, 100*t/max(total, 1e-9)) for name, t in sorted(bytype.items(), key=lambda item: -item[1])))
+        return "\n".join(lines)
+
+
+class TimedFunction(object):
+    # stands in for model.<name>_function inside profile(), calling the profiler around every call
+
+    def __init__(self, function, profiler):
+        self.function = function
+        self.profiler = profiler
+
+    def __call__(self, inputs):
+        self.profiler.on_batch_begin(self.profiler.step)
+        outputs = self.function(inputs)
+        self.profiler.on_batch_end(self.profiler.step)
+        return outputs
+
+
+@contextlib.contextmanager
+def profile(model, function='train', start=1, batches=10, trace=None, verbose=True):
+    # profiles every call of the model's train or predict function made inside the block
+    getattr(model, '_make_'+function+'_function')()
+    profiler = Profiler(start, batches, trace, verbose, function)
+    profiler.set_model(model)
+    original = getattr(model, function+'_function')
+    setattr(model, function+'_function', TimedFunction(original, profiler))
+    try:
+        yield profiler
+    finally:
+        setattr(model, function+'_function', original)
+        profiler.on_train_end()
+
+
+def settrace(function, trace):
+    # switches full tracing of a Keras backend function on or off
+    options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE) if trace else None
+    metadata = tf.RunMetadata() if trace else None
+    if hasattr(function, 'run_options'):  # Keras 2.2 Function: the options are baked into its cached callable
+        if (function.run_options is not None) == trace:
+            return
+        function.run_options = options
+        function.run_metadata = metadata
+        function._callable_fn = None
+    else:  # older Keras passes session_kwargs straight to session.run
+        function.session_kwargs.pop('options', None)
+        function.session_kwargs.pop('run_metadata', None)
+        if trace:
+            function.session_kwargs.update(options=options, run_metadata=metadata)
+
+
+def opdevices(stats):
+    # on GPU, kernel times come from the aggregated stream and the per-op launch entries are skipped
+    devices = [device for device in stats.dev_stats if 'memcpy' not in device.device]
+    streams = [device for device in devices if device.device.endswith('stream:all')]
+    if streams:
+        gpus = set(device.device.split('/stream')[0] for device in streams)
+        devices = streams+[device for device in devices if '/stream' not in device.device and device.device not in gpus]
+    return devices
+
+
+def layerof(nodename, layers):
+    # maps an op to (layer name, backward): gradient ops live under .../gradients/<layer scope>/...
+    parts = nodename.split('/')
+    backward = 'gradients' in parts
+    if backward:
+        parts = parts[parts.index('gradients')+1:]
+    for part in parts:
+        for candidate in (part, re.sub(r'_\d+$', '', part)):
+            if candidate in layers:
+                return candidate, int(backward)
+    if parts and parts[0] == 'training':
+        return '(optimizer)', 0
+    return '(other)', int(backward)
+
+
+def writetrace(stepstats, path):
+    # one chrome trace with all traced steps; timestamps are absolute, so the steps line up one after another
+    from tensorflow.python.client import timeline
+    events = []
+    for stats in stepstats:
+        events += json.loads(timeline.Timeline(stats).generate_chrome_trace_format())['traceEvents']
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events}, f)
@@ -0,0 +1,163 @@
+import re
+import copy
+import json
+import argparse
+import numpy as np
+from modelcli import addmodelarguments, buildmodel
+
+# Structured channel pruning for AttentionVGG and AttentionRN. Filters of the prunable convolutions are ranked by
+# |gamma| of the BatchNormalization that follows them (or by their L1 norm), the lowest ranked are removed, and the
+# surviving weights are copied into a narrower model built with the constructors' widths option, slicing the input
+# channels of whatever consumes the pruned outputs (BatchNormalization, the next convolution, l1connectordense, the
+# Dense after pregflatten). Channels the attention heads compare with g stay: conv10/conv13 in VGG, the residual
+# streams (resblock conv3, dimchangeconv) in the ResNet.
+#
+#     python pruning.py --model vgg --weights "weights/(VGG-att3)-concat-pc-cifar10 early.hdf5" --dataset cifar10 --finetune 20
+
+PRUNABLE = re.compile(r'^(conv([1-9]|11|12|14|15)|block1conv[12]|block[234]resblock\d+conv[12]|outconv)$')
+
+
+def prunable(layername):
+    return PRUNABLE.match(layername) is not None
+
+
+def scores(model, criterion='bn'):
+    # per prunable convolution, one importance score per filter. 'bn' uses |gamma| of the BatchNormalization right
+    # after the convolution and falls back to the L1 norm of the filters where there is none (VGG without batchnorm)
+    consumers = {}
+    for layer in model.get_config()['layers']:
+        for node in layer['inbound_nodes']:
+            for inbound in node:
+                consumers.setdefault(inbound[0], []).append(layer)
+    result = {}
+    for layer in model.layers:
+        if not prunable(layer.name):
+            continue
+        after = consumers.get(layer.name, [])
+        if criterion == 'bn' and len(after) == 1 and after[0]['class_name'] == 'BatchNormalization':
+            result[layer.name] = np.abs(model.get_layer(after[0]['name']).get_weights()[0])
+        else:
+            result[layer.name] = np.abs(layer.get_weights()[0]).sum(axis=(0, 1, 2))
+    return result
+
+
+def prune(net, ratio, criterion='bn'):
+    # a copy of net with `ratio` of the filters of every prunable convolution removed, weights carried over
+    keep = {}
+    for name, score in scores(net.model, criterion).items():
+        n = max(1, int(round(len(score)*(1-ratio))))
+        keep[name] = np.sort(np.argsort(-score)[:n])
+    pruned = copy.copy(net)
+    pruned.model = None  # built again, narrower, on first use
+    pruned.widths = dict((name, len(filters)) for name, filters in keep.items())
+    pruned.name = net.name+"-pruned"+str(int(round(100*ratio)))
+    transfer(net.model, pruned.model, keep)
+    return pruned
+
+
+def transfer(source, target, keep):
+    # copies source's weights into target, which has the same layers with the filters in keep (layer name -> kept
+    # filter indices) only; the kept channels are followed through the graph to slice the layers consuming them
+    channels = {}  # layer name -> kept output channels, None for all
+    for config, old, new in zip(source.get_config()['layers'], source.layers, target.layers):
+        inputs = [channels.get(inbound[0]) for node in config['inbound_nodes'] for inbound in node]
+        inkeep = inputs[0] if inputs else None
+        kind = config['class_name']
+        weights = old.get_weights()
+        out = inkeep
+        if kind == 'Conv2D':
+            kernel = weights[0] if inkeep is None else weights[0][:, :, inkeep, :]
+            out = keep.get(old.name)
+            weights = [kernel]+weights[1:] if out is None else [kernel[..., out]]+[b[out] for b in weights[1:]]
+        elif kind == 'BatchNormalization':
+            if inkeep is not None:
+                weights = [w[inkeep] for w in weights]
+        elif kind == 'Dense':
+            if inkeep is not None:
+                weights = [weights[0][inkeep]]+weights[1:]
+            out = None
+        elif kind == 'Flatten':
+            if inkeep is not None:  # channels last: flat index = position*channels + channel
+                height, width, depth = old.input_shape[1:]
+                out = (np.arange(height*width)[:, None]*depth+inkeep[None, :]).ravel()
+        elif kind not in ('InputLayer', 'Activation', 'MaxPooling2D', 'AveragePooling2D'):
+            if any(i is not None for i in inputs):
+                raise ValueError(old.name+' ('+kind+') can not take pruned channels')
+            out = None
+        if weights:
+            new.set_weights(weights)
+        channels[old.name] = out
+    return target
+
+
+def flops(model):
+    # floating point operations per image of the convolutions, dense layers and attention pooling
+    total = 0
+    for layer in model.layers:
+        kind = type(layer).__name__
+        if kind == 'Conv2D':
+            height, width, filters = layer.output_shape[1:]
+            total += 2*height*width*np.prod(layer.kernel_size)*layer.input_shape[-1]*filters
+        elif kind == 'Dense':
+            positions = np.prod(layer.input_shape[1:-1]) if len(layer.input_shape) > 2 else 1
+            total += 2*positions*layer.input_shape[-1]*layer.units
+        elif kind == 'AttentionPooling':
+            height, width, depth = layer.input_shape[0][1:]
+            total += 2*2*height*width*depth  # compatibility scores and the weighted sum
+    return int(total)
+
+
+def report(net, samples, batch_sizes=(1, 128)):
+    from export import latency
+    row = {'name': net.name, 'params': net.model.count_params(), 'flops': flops(net.model)}
+    for batch_size in batch_sizes:
+        row['latency_ms_'+str(batch_size)] = 1000*latency(net.model, samples, batch_size)
+    return row
+
+
+if __name__ == "__main__":
+    parser = addmodelarguments(argparse.ArgumentParser(description="Prune attention model filters and report size, FLOPs and latency"))
+    parser.add_argument('--ratios', type=float, nargs='+', default=[0.25, 0.5, 0.75], help="fraction of the filters removed per layer")
+    parser.add_argument('--criterion', choices=['bn', 'l1'], default='bn')
+    parser.add_argument('--dataset', default=None, help="fine-tune and evaluate on this dataset")
+    parser.add_argument('--finetune', type=int, default=0, help="fine-tuning epochs after pruning")
+    parser.add_argument('--lr', type=float, default=0.001)
+    parser.add_argument('--out', default=None, help="JSON report")
+    args = parser.parse_args()
+
+    import os
+    os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')  # latency is measured on CPU
+    from keras import backend as K
+    net = buildmodel(args)
+    samples = np.random.rand(*((128,)+K.int_shape(net.model.input)[1:])).astype(K.floatx())
+    data = None
+    if args.dataset:
+        import datasets
+        from datapipeline import ArraySequence
+        from checkpoints import CheckpointManager
+        data = datasets.load(args.dataset)
+    def accuracy(net):
+        return net.model.evaluate_generator(ArraySequence(data.test[0], data.test[1], 128, net.outputclasses, shuffle=False))[1]
+
+    rows = [dict(report(net, samples), ratio=0.0)]
+    if data is not None:
+        rows[0]['accuracy'] = accuracy(net)
+    for ratio in args.ratios:
+        pruned = prune(net, ratio, args.criterion)
+        row = dict(report(pruned, samples), ratio=ratio)
+        if data is not None:
+            row['accuracy_pruned'] = accuracy(pruned)
+            if args.finetune:
+                if pruned.StandardFit(args.dataset, *data.train, validation_data=data.test, stream=True, epochs=args.finetune, initial_lr=args.lr) is None:
+                    checkpoints = CheckpointManager("weights", pruned.name+"-"+args.dataset)
+                    pruned.model.load_weights(checkpoints.trained())
+                row['accuracy'] = accuracy(pruned)
+        rows.append(row)
+
+    print("%-6s %12s %14s %12s %12s %10s" % ('ratio', 'params', 'MFLOPs', 'batch 1 ms', 'batch 128 ms', 'accuracy'))
+    for row in rows:
+        rowaccuracy = row.get('accuracy', row.get('accuracy_pruned'))
+        print("%-6.2f %12d %14.1f %12.2f %12.1f %10s" % (row['ratio'], row['params'], row['flops']/1e6, row['latency_ms_1'], row['latency_ms_128'], '' if rowaccuracy is None else "%.4f" % rowaccuracy))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(rows, f, indent=1, default=float)
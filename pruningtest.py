@@ -0,0 +1,33 @@
+import pytest
+from pruning import prunable, flops
+
+
+def test_prunable_layers():
+    # conv10/conv13 feed the attention heads and the ResNet's residual streams carry the block sums, they keep their width
+    kept = ['conv10', 'conv13', 'block2resblock1conv3', 'block3dimchangeconv', 'l1connectordense', 'globalg']
+    pruned = ['conv%d' % i for i in (1, 2, 3, 4, 5, 6, 7, 8, 9, 11, 12, 14, 15)]+['block1conv1', 'block1conv2', 'block4resblock18conv1', 'block2resblock3conv2', 'outconv']
+    assert [name for name in pruned if not prunable(name)] == []
+    assert [name for name in kept if prunable(name)] == []
+
+
+def test_flops_of_convolutions_and_dense_layers():
+    pytest.importorskip('keras')
+    from keras.models import Model
+    from keras.layers import Input, Conv2D, Dense, Flatten
+    inp = Input(shape=(8, 8, 3))
+    x = Conv2D(4, (3, 3), padding='same')(inp)  # 2*8*8*9*3*4
+    x = Dense(6)(x)  # per position: 2*8*8*4*6
+    out = Dense(10)(Flatten()(x))  # 2*384*10
+    assert flops(Model(inputs=inp, outputs=out)) == 2*8*8*9*3*4 + 2*8*8*4*6 + 2*384*10
+
+
+def test_flops_of_attention_pooling():
+    pytest.importorskip('tensorflow')
+    pytest.importorskip('keras')
+    from keras.models import Model
+    from keras.layers import Input
+    from attentionlayers import AttentionPooling
+    l = Input(shape=(4, 5, 8))
+    g = Input(shape=(8,))
+    out = AttentionPooling('dp')([l, g])
+    assert flops(Model(inputs=[l, g], outputs=out)) == 2*2*4*5*8
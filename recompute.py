@@ -0,0 +1,62 @@
+import tensorflow as tf
+from keras import backend as K
+
+# Activation recomputation (gradient checkpointing) for AttentionRN(checkpointing=True). Of the forward pass only
+# the tensors at the residual block boundaries are kept for backprop. Gradients go block by block from the loss
+# back to the input: each block's forward is built again from its saved input, with the same layers and weights,
+# and runs only once backprop has reached that block, so the activations inside a single block are alive at a
+# time instead of those of all 3*18. A step costs about one extra forward pass of the blocks.
+#
+# The attention heads read l1/l2/l3, which are block outputs and so boundaries themselves: the gradient of the
+# loss reaches each boundary directly through the heads as well as through the blocks above it.
+
+
+def checkpointedgradients(loss, params, stem, segments):
+    # stem is the first boundary, segments are (input boundary, block function, output boundary) in forward order,
+    # the input of each segment being the output of the one before (stem for the first)
+    boundaries = [stem]+[output for _, _, output in segments]
+    total = [[] for _ in params]
+    def add(values):
+        for i, value in enumerate(values):
+            if value is not None:
+                total[i].append(value)
+    # the loss to the boundaries and to the parameters outside the blocks (heads, regularizers), not through blocks
+    head = tf.gradients(loss, boundaries+params, stop_gradients=boundaries)
+    upstream = [[] if g is None else [g] for g in head[:len(boundaries)]]
+    add(head[len(boundaries):])
+    for k in reversed(range(len(segments))):
+        start, block, _ = segments[k]
+        if not upstream[k+1]:
+            continue
+        grad = tf.add_n(upstream[k+1])
+        with tf.control_dependencies([grad]):  # recompute the block only once its output gradient exists
+            x = tf.identity(tf.stop_gradient(start))
+        values = tf.gradients(block(x), [x]+params, grad_ys=grad)
+        if values[0] is not None:
+            upstream[k].append(values[0])
+        add(values[1:])
+    if upstream[0]:  # the layers before the first block, from the kept forward activations
+        add(tf.gradients(stem, params, grad_ys=tf.add_n(upstream[0])))
+    return [tf.add_n(g) if g else None for g in total]
+
+
+def checkpointed(optimizer, stem, segments):
+    # a copy of optimizer whose get_gradients recomputes the segments. The recomputation lives in a subclass rather
+    # than an instance attribute, so wrappers that subclass the optimizer again (Horovod's DistributedOptimizer)
+    # still call it through super().get_gradients
+    from keras.optimizers import clip_norm
+    base = optimizer.__class__
+
+    def get_gradients(self, loss, params):
+        grads = checkpointedgradients(loss, params, stem, segments)
+        if None in grads:
+            raise ValueError('An operation has `None` for gradient, recomputation only covers differentiable layers')
+        if getattr(self, 'clipnorm', 0) > 0:  # the clipping of keras' Optimizer.get_gradients
+            norm = K.sqrt(sum([K.sum(K.square(g)) for g in grads]))
+            grads = [clip_norm(g, self.clipnorm, norm) for g in grads]
+        if getattr(self, 'clipvalue', 0) > 0:
+            grads = [K.clip(g, -self.clipvalue, self.clipvalue) for g in grads]
+        return grads
+
+    cls = type(base.__name__, (base,), {'get_gradients': get_gradients})
+    return cls(**optimizer.get_config())
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+tf = pytest.importorskip('tensorflow')
+pytest.importorskip('keras')
+from recompute import checkpointedgradients
+
+# checkpointedgradients against plain tf.gradients on a toy residual net, with a head reading an inner boundary
+# like the attention heads read l1/l2/l3.
+
+v1 = tf.compat.v1 if hasattr(tf, 'compat') and hasattr(tf.compat, 'v1') else tf
+
+
+def toynet():
+    random = np.random.RandomState(0)
+    x = tf.constant(random.rand(4, 6).astype('float32'))
+    stemweights = tf.constant(random.rand(6, 6).astype('float32'))
+    blockweights = [tf.constant(random.rand(6, 6).astype('float32')-0.5) for _ in range(3)]
+    headweights = tf.constant(random.rand(6, 1).astype('float32'))
+    stem = tf.tanh(tf.matmul(x, stemweights))
+    segments = []
+    boundary = stem
+    for w in blockweights:
+        block = (lambda w: lambda t: t+tf.tanh(tf.matmul(t, w)))(w)
+        output = block(boundary)
+        segments.append((boundary, block, output))
+        boundary = output
+    loss = tf.reduce_sum(tf.matmul(boundary, headweights))+0.5*tf.reduce_sum(tf.square(segments[0][2]))
+    return loss, [stemweights]+blockweights+[headweights], stem, segments
+
+
+def test_matches_tf_gradients():
+    with tf.Graph().as_default():
+        loss, params, stem, segments = toynet()
+        expected = tf.gradients(loss, params)
+        recomputed = checkpointedgradients(loss, params, stem, segments)
+        with v1.Session() as session:
+            expected, recomputed = session.run([expected, recomputed])
+    for e, r in zip(expected, recomputed):
+        assert np.allclose(e, r, rtol=1e-5, atol=1e-6)
+
+
+def test_unused_parameters_have_no_gradient():
+    with tf.Graph().as_default():
+        loss, params, stem, segments = toynet()
+        unused = tf.constant(np.ones((2, 2), dtype='float32'))
+        assert checkpointedgradients(loss, params+[unused], stem, segments)[-1] is None
@@ -0,0 +1,78 @@
+import numpy as np
+
+
+class ZCAWhitening:
+    # Out-of-core version of ImageDataGenerator(featurewise_center=True, featurewise_std_normalization=True, zca_whitening=True).
+    # fit streams over x in chunks, accumulating per-feature sums and the raw Gram matrix in float64 in one pass.
+    # The per-channel mean/std and the covariance of the standardized data are derived from those at the end,
+    # so x can be a memmap of any length. The fitted transform is saved once and reused for test and inference data.
+
+    def __init__(self, epsilon=1e-6):
+        self.epsilon = epsilon
+        self.n = 0
+        self.shape = None
+        self.sum = None
+        self.gram = None
+        self.mean = None
+        self.std = None
+        self.principal_components = None
+
+    def partial_fit(self, x):
+        if self.shape is None:
+            self.shape = x.shape[1:]
+            features = int(np.prod(self.shape))
+            self.sum = np.zeros(features)
+            self.gram = np.zeros((features, features))
+        flat = np.asarray(x, dtype=np.float64).reshape(len(x), -1)
+        self.n += len(flat)
+        self.sum += flat.sum(axis=0)
+        self.gram += np.dot(flat.T, flat)
+        return self
+
+    def fit(self, x, chunksize=2048):
+        for i in range(0, len(x), chunksize):
+            self.partial_fit(x[i:i+chunksize])
+        return self.finalize()
+
+    def finalize(self):
+        channels = self.shape[-1]
+        featuremean = self.sum/self.n
+        featuresquare = np.diag(self.gram)/self.n
+        self.mean = featuremean.reshape(-1, channels).mean(axis=0)  # per channel, like axis=(0, 1, 2)
+        self.std = np.sqrt(featuresquare.reshape(-1, channels).mean(axis=0) - self.mean**2)
+        mu = np.tile(self.mean, len(featuremean)//channels)
+        scale = 1/np.tile(self.std + self.epsilon, len(featuremean)//channels)
+        # covariance of z = (x - mu)*scale, from sum(x x^T) and sum(x)
+        centered = self.gram - np.outer(mu, self.sum) - np.outer(self.sum, mu) + self.n*np.outer(mu, mu)
+        sigma = centered*np.outer(scale, scale)/self.n
+        s, u = np.linalg.eigh(sigma)
+        s = np.clip(s, 0, None)
+        self.principal_components = np.dot(u*(1.0/np.sqrt(s + self.epsilon)), u.T).astype(np.float32)
+        self.sum = None
+        self.gram = None
+        return self
+
+    def transform(self, x, out=None, chunksize=2048):
+        # out may be a preallocated (memory-mapped) array, e.g. float16, the whitened chunks are written into it
+        if out is None:
+            out = np.empty(x.shape, dtype=np.float32)
+        mean = self.mean.astype(np.float32)
+        std = (self.std + self.epsilon).astype(np.float32)
+        for i in range(0, len(x), chunksize):
+            chunk = (np.asarray(x[i:i+chunksize], dtype=np.float32) - mean)/std
+            out[i:i+chunksize] = np.dot(chunk.reshape(len(chunk), -1), self.principal_components).reshape(chunk.shape)
+        return out
+
+    def save(self, path):
+        np.savez(path, epsilon=self.epsilon, n=self.n, shape=self.shape, mean=self.mean, std=self.std, principal_components=self.principal_components)
+
+    @staticmethod
+    def load(path):
+        data = np.load(path)
+        whitening = ZCAWhitening(float(data['epsilon']))
+        whitening.n = int(data['n'])
+        whitening.shape = tuple(data['shape'])
+        whitening.mean = data['mean']
+        whitening.std = data['std']
+        whitening.principal_components = data['principal_components']
+        return whitening
@@ -0,0 +1,60 @@
+import numpy as np
+from whitening import ZCAWhitening
+
+# ZCAWhitening against the in-memory statistics ImageDataGenerator(featurewise_center, featurewise_std_normalization,
+# zca_whitening) computes: chunked fitting must not change them.
+
+
+def images(n=300, seed=0):
+    random = np.random.RandomState(seed)
+    return (random.rand(n, 4, 4, 3)*np.array([1.0, 2.0, 0.5])+np.array([0.1, 0.5, 0.2])).astype('float32')
+
+
+def reference(x, epsilon=1e-6):
+    x = x.astype(np.float64)
+    mean = x.mean(axis=(0, 1, 2))
+    std = x.std(axis=(0, 1, 2))
+    z = ((x-mean)/(std+epsilon)).reshape(len(x), -1)
+    s, u = np.linalg.eigh(np.dot(z.T, z)/len(z))
+    return mean, std, np.dot(u*(1.0/np.sqrt(np.clip(s, 0, None)+epsilon)), u.T)
+
+
+def test_chunked_fit_matches_in_memory_statistics():
+    x = images()
+    mean, std, components = reference(x)
+    whitening = ZCAWhitening().fit(x, chunksize=64)
+    assert np.allclose(whitening.mean, mean)
+    assert np.allclose(whitening.std, std)
+    assert np.allclose(whitening.principal_components, components, atol=1e-3)
+
+
+def test_chunk_size_does_not_matter():
+    x = images()
+    whole = ZCAWhitening().fit(x, chunksize=len(x)).transform(x)
+    chunked = ZCAWhitening().fit(x, chunksize=7).transform(x, chunksize=13)
+    assert np.allclose(whole, chunked, atol=1e-4)
+
+
+def test_whitened_covariance_is_identity():
+    x = images(2000)
+    z = ZCAWhitening(epsilon=1e-8).fit(x).transform(x).reshape(len(x), -1).astype(np.float64)
+    z = z-z.mean(axis=0)
+    assert np.allclose(np.dot(z.T, z)/len(z), np.eye(z.shape[1]), atol=1e-2)
+
+
+def test_transform_into_preallocated_float16():
+    x = images()
+    whitening = ZCAWhitening().fit(x)
+    out = np.zeros(x.shape, dtype='float16')
+    assert whitening.transform(x, out=out) is out
+    assert np.allclose(out, whitening.transform(x), atol=1e-2)
+
+
+def test_save_and_load(tmp_path):
+    x = images()
+    whitening = ZCAWhitening().fit(x)
+    path = str(tmp_path/'zca.npz')
+    whitening.save(path)
+    loaded = ZCAWhitening.load(path)
+    assert loaded.shape == x.shape[1:]
+    assert np.allclose(loaded.transform(x), whitening.transform(x))